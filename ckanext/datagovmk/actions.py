@@ -16,20 +16,20 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import os
-import uuid
 import requests
-import zipfile
 import hashlib
 import subprocess
 import cgi
 import json
+import datetime
 
 from ckan.plugins import toolkit
-from ckan.views.admin import _get_sysadmins
 from ckanext.datagovmk import helpers as h
 from ckanext.datagovmk import logic as l
+from ckanext.datagovmk import bundle
 from logging import getLogger
 from ckan.plugins.toolkit import config, request
+from ckan import model
 from ckan.model import State as model_state
 import ckan.authz as authz
 import sqlalchemy
@@ -37,6 +37,7 @@ import sqlalchemy
 import ckan.logic as logic
 import ckan.plugins as plugins
 import ckan.lib.uploader as uploader
+import ckan.lib.munge as munge
 from ckan.common import is_flask_request
 from ckan.logic.action.create import user_create as _user_create
 from ckan.logic.action.update import user_update as _user_update
@@ -49,7 +50,7 @@ from ckanext.datagovmk.model.sort_organizations import SortOrganizations as Sort
 from ckanext.datagovmk.model.sort_groups import SortGroups as SortGroupsModel
 from ckanext.datagovmk.model.stats import get_total_package_downloads
 from ckanext.datagovmk.lib import request_activation
-from ckanext.datagovmk.solr.stats import update_package_stats
+from ckanext.datagovmk.solr.stats import queue_package_stats_update
 from ckan.lib import helpers as core_helpers
 from ckan.logic.action.get import package_search as _package_search
 from ckan.logic.action.get import resource_show as _resource_show
@@ -61,7 +62,8 @@ from ckan.logic.action.update import organization_update as ckan_organization_up
 from ckan.logic.action.update import group_update as _group_update
 from ckan.logic.action.delete import group_delete as _group_delete
 from ckan.logic import chained_action
-from ckanext.datagovmk.model.stats import increment_downloads
+from ckanext.datagovmk.downloads import record_downloads
+from ckanext.datagovmk.cache import related_datasets_cache, organization_titles_cache, get_caches_stats
 
 log = getLogger(__name__)
 
@@ -72,65 +74,10 @@ get_or_bust = toolkit.get_or_bust
 check_access = toolkit.check_access
 NotFound = logic.NotFound
 
-SUPPORTED_RESOURCE_MIMETYPES = [
-    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-    'application/x-msdownload',
-    'application/msword',
-    'application/vnd.google-earth.kml+xml',
-    'application/vnd.ms-excel',
-    'application/msexcel',
-    'application/x-msexcel',
-    'application/x-ms-excel',
-    'application/x-excel',
-    'application/x-dos_ms_excel',
-    'application/xls',
-    'application/x-xls',
-    'wcs',
-    'application/x-javascript',
-    'application/x-msaccess',
-    'application/netcdf',
-    'text/tab-separated-values',
-    'text/x-perl',
-    'application/vnd.google-earth.kmz+xml',
-    'application/vnd.google-earth.kmz',
-    'application/owl+xml',
-    'application/x-n3',
-    'application/zip',
-    'application/gzip',
-    'application/x-gzip',
-    'application/x-qgis',
-    'application/vnd.oasis.opendocument.spreadsheet',
-    'application/vnd.oasis.opendocument.text',
-    'application/json',
-    'image/x-ms-bmp',
-    'application/rar',
-    'image/tiff',
-    'application/vnd.oasis.opendocument.database',
-    'text/plain',
-    'application/x-director',
-    'application/vnd.oasis.opendocument.formula',
-    'application/vnd.oasis.opendocument.graphics',
-    'application/xml',
-    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-    'application/octet-stream',
-    'application/xslt+xml',
-    'image/svg+xml',
-    'application/vnd.ms-powerpoint',
-    'application/vnd.oasis.opendocument.presentation',
-    'image/jpeg',
-    'application/sparql-results+xml',
-    'image/gif',
-    'application/rdf+xml',
-    'application/pdf',
-    'text/csv',
-    'application/vnd.oasis.opendocument.chart',
-    'application/atom+xml',
-    'application/x-tar',
-    'image/png',
-    'application/rss+xml',
-    'application/geo+json'
-]
+
+# How much more a shared group weighs than a shared tag when looking for
+# related datasets.
+RELATED_DATASETS_GROUP_BOOST = 4
 
 
 @toolkit.side_effect_free
@@ -139,6 +86,11 @@ def get_related_datasets(context, data_dict):
     '''This is an action function which returns related datasets for a single dataset, based
     on groups and tags which are parts of the dataset itself.
 
+    The related datasets are fetched with a single ``package_search`` query
+    in which datasets sharing a group with the dataset are boosted over the
+    ones sharing only tags. Only ``limit`` datasets are returned, straight
+    from the search index.
+
     :param id: id od the single dataset for which we would like to return
         the related datasets
     :type id: string
@@ -153,128 +105,134 @@ def get_related_datasets(context, data_dict):
 
     id = data_dict.get('id')
     limit = int(data_dict.get('limit', 3))
-    related_datasets = []
-    related_datasets_ids = []
 
     if id is None:
         raise ValidationError(_('Missing dataset id'))
 
     dataset = get_action('package_show')(data_dict={'id': id})
 
-    groups = dataset.get('groups')
-    tags = dataset.get('tags')
+    query = _related_datasets_query(dataset)
+    if not query or limit < 1:
+        return []
 
-    for group in groups:
-        data_dict = {
-            'id': group.get('id'),
-            'include_datasets': True
-        }
-        group_dict = get_action('group_show')(data_dict=data_dict)
+    search_dict = {
+        'q': query,
+        'fq': '+dataset_type:dataset -id:"{0}"'.format(dataset['id']),
+        'sort': 'score desc, metadata_modified desc',
+        'rows': limit,
+    }
+    result = get_action('package_search')(
+        {'ignore_auth': True}, search_dict)
 
-        group_datasets = group_dict.get('packages')
+    # ``package_search`` has already translated the title and the notes
+    return result.get('results', [])
 
-        for group_dataset in group_datasets:
-            group_dataset_id = group_dataset.get('id')
-            if group_dataset_id != dataset.get('id') and \
-               group_dataset_id not in related_datasets_ids and \
-               group_dataset['type'] == 'dataset':
-                related_datasets.append(group_dataset)
-                related_datasets_ids.append(group_dataset_id)
 
-    for tag in tags:
-        data_dict = {
-            'id': tag.get('id'),
-            'include_datasets': True
-        }
-
-        tag_dict = get_action('tag_show')(data_dict=data_dict)
+def _related_datasets_query(dataset):
+    """Builds the Solr query matching the datasets that share a group or a
+    tag with the given dataset. Matches on groups weigh more than matches on
+    tags, same as the order in which they used to be listed.
+    """
+    clauses = []
 
-        tag_datasets = tag_dict.get('packages')
+    groups = [group['name'] for group in dataset.get('groups') or []
+              if group.get('name')]
+    if groups:
+        clauses.append('groups:({0})^{1}'.format(
+            ' OR '.join(_solr_phrase(name) for name in groups),
+            RELATED_DATASETS_GROUP_BOOST))
 
-        for tag_dataset in tag_datasets:
-            tag_dataset_id = tag_dataset.get('id')
-            if tag_dataset_id != dataset.get('id') and \
-               tag_dataset_id not in related_datasets_ids and \
-               tag_dataset['type'] == 'dataset':
-                related_datasets.append(get_action('package_show')({'ignore_auth': True}, data_dict={'id': tag_dataset_id}))
-                related_datasets_ids.append(tag_dataset_id)
+    tags = [tag['name'] for tag in dataset.get('tags') or []
+            if tag.get('name')]
+    if tags:
+        clauses.append('tags:({0})'.format(
+            ' OR '.join(_solr_phrase(name) for name in tags)))
 
-    related_datasets = related_datasets[:limit]
+    return ' OR '.join(clauses)
 
-    for dataset in related_datasets:
-        dataset['title'] = h.translate_field(dataset, 'title')
-        dataset['notes'] = h.translate_field(dataset, 'notes')
 
-    return related_datasets
+def _solr_phrase(value):
+    return '"{0}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
 
 
 @toolkit.side_effect_free
 def prepare_zip_resources(context, data_dict):
     """Creates zip archive and stores it under CKAN's storage path.
 
+    Archives are cached by the ids and versions of the resources they
+    contain, so the same set of resources is served from the cache until
+    any of them changes.
+
+    When ``async`` is requested and the asynchronous mode is enabled with
+    ``ckanext.datagovmk.zip.async``, the archive is built by a background
+    job and the id of the job is returned instead. The progress of the job
+    can be followed with
+    :py:func:`~ckanext.datagovmk.actions.zip_resources_status`.
+
     :param resources: a list of ids of the resources
     :type resources: list
+    :param async: build the archive in a background job, default is False
+    :type async: bool
 
-    :return: a dictionary containing the zip_id of the created archive
+    :return: a dictionary containing the zip_id of the created archive, or
+        the job_id of the background job building it
     :rtype: dict
     """
-    file_name = uuid.uuid4().hex + '.{ext}'.format(ext='zip')
-    file_path = h.get_storage_path_for('temp-datagovmk') + '/' + file_name
-    resourceArchived = False
-    package_id = None
-
+    resource_ids = data_dict.get('resources') or []
     try:
-        resource_ids = data_dict.get('resources')
-        with zipfile.ZipFile(file_path, 'w') as zip:
-            for resource_id in resource_ids:
-                data_dict = {'id': resource_id}
-                resource = toolkit.get_action('resource_show')({}, data_dict)
-
-                url = resource.get('url')
-                if resource['url_type'] == 'upload':
-                    name = url.split('/')[-1]
-                else:
-                    name = resource['name']
-                    if os.path.splitext(name)[-1] == '':
-                        _format = resource['format']
-                        if _format:
-                            name += '.{ext}'.format(ext=_format.lower())
-
-                if package_id is None:
-                    package_id = resource['package_id']
-
-                headers = {'Authorization': _get_sysadmins()[0].apikey}
-                try:
-                    r = requests.get(url, headers=headers, timeout=5, verify=False)
-                except Exception:
-                    continue
-
-                content_type = r.headers['Content-Type'].split(';')[0]
-
-                if content_type in SUPPORTED_RESOURCE_MIMETYPES:
-                    resourceArchived = True
-                    zip.writestr(name, r.content)
+        # resource_show checks that the user can access the resources
+        resources = [toolkit.get_action('resource_show')({}, {'id': resource_id})
+                     for resource_id in resource_ids]
+
+        if toolkit.asbool(data_dict.get('async')) and toolkit.asbool(
+                config.get('ckanext.datagovmk.zip.async', False)):
+            limits = bundle.get_bundle_config()
+            job = toolkit.enqueue_job(
+                bundle.build_zip_job, [resource_ids],
+                title='datagovmk zip resources',
+                queue=config.get('ckanext.datagovmk.zip.queue', 'default'),
+                rq_kwargs={'timeout': int(limits['deadline']) + 60})
+            return {'zip_id': None, 'job_id': job.id}
+
+        return bundle.bundle_resources(resources)
     except Exception as ex:
         log.error('An error occured while preparing zip archive. Error: %s' % ex)
         raise
 
-    zip_id = file_name
-    try:
-        package = toolkit.get_action('package_show')({}, {'id': package_id})
-        package_name = package['name']
 
-        zip_id += '::{name}'.format(name=package_name)
-    except:
-        pass
+@toolkit.side_effect_free
+def zip_resources_status(context, data_dict):
+    """Returns the status of a background job building a zip archive,
+    started with :py:func:`~ckanext.datagovmk.actions.prepare_zip_resources`.
+
+    :param id: the id of the job
+    :type id: string
 
-    if resourceArchived:
-        for resource_id in resource_ids:
-            increment_downloads(resource_id)
-        return {'zip_id': zip_id}
+    :returns: the job ``status`` (``queued``, ``started``, ``finished`` or
+        ``failed``), the progress as ``resources_total``, ``resources_done``
+        and ``bytes_done``, and the ``zip_id`` once the job has finished.
+    :rtype: dict
+    """
+    from ckan.lib.jobs import job_from_id
 
-    os.remove(file_path)
+    id = get_or_bust(data_dict, 'id')
+    try:
+        job = job_from_id(id)
+    except KeyError:
+        raise NotFound(_('Job not found'))
+    if job.func_name != 'ckanext.datagovmk.bundle.build_zip_job':
+        raise NotFound(_('Job not found'))
 
-    return {'zip_id': None}
+    status = job.get_status()
+    result = job.result if status == 'finished' else None
+
+    return {
+        'status': status,
+        'resources_total': job.meta.get('resources_total', len(job.args[0])),
+        'resources_done': job.meta.get('resources_done', 0),
+        'bytes_done': job.meta.get('bytes_done', 0),
+        'zip_id': (result or {}).get('zip_id'),
+    }
 
 
 def safe_override(action):
@@ -381,6 +339,10 @@ def add_spatial_data(package_action, context, data_dict):
 
     dataset = package_action(context, data_dict)
 
+    # Groups and tags may have changed, so the related datasets of any
+    # dataset could be different now.
+    related_datasets_cache().clear()
+
     if package_action.__name__ == 'package_create' and \
        dataset_type == 'dataset':
         if data_dict.get('authority_file_url'):
@@ -533,7 +495,7 @@ def resource_create(context, data_dict):
         skip_update_package_stats = data_dict.get('skip_update_package_stats')
 
         if not skip_update_package_stats:
-            update_package_stats(resource['package_id'])
+            queue_package_stats_update(resource['package_id'])
     except Exception as e:
         log.error(e)
 
@@ -654,13 +616,72 @@ def resource_update(context, data_dict):
         plugin.after_update(context, resource)
 
     try:
-        update_package_stats(resource['package_id'])
+        queue_package_stats_update(resource['package_id'])
     except Exception as e:
         log.error(e)
         log.exception(e)
 
     return resource
 
+
+def _update_sort_package_counts(package_ids=None, group_ids=None,
+                                commit=True):
+    # Within an action that commits later (commit=False) only the update of
+    # the counts is rolled back on failure, not the changes of the action.
+    savepoint = None if commit else model.Session.begin_nested()
+    try:
+        l.update_sort_package_counts(package_ids=package_ids,
+                                     group_ids=group_ids)
+        if commit:
+            model.Session.commit()
+        else:
+            savepoint.commit()
+    except Exception as e:
+        if commit:
+            model.Session.rollback()
+        else:
+            savepoint.rollback()
+        log.error('Failed to update the number of datasets of %s: %s',
+                  package_ids or group_ids, e)
+
+
+@chained_action
+def member_create(action, context, data_dict):
+    result = action(context, data_dict)
+    if data_dict.get('object_type') == 'package':
+        _update_sort_package_counts(group_ids=[data_dict.get('id')])
+    return result
+
+
+@chained_action
+def member_delete(action, context, data_dict):
+    result = action(context, data_dict)
+    if data_dict.get('object_type') == 'package':
+        _update_sort_package_counts(group_ids=[data_dict.get('id')])
+    return result
+
+
+@chained_action
+def bulk_update_private(action, context, data_dict):
+    result = action(context, data_dict)
+    _update_sort_package_counts(package_ids=data_dict.get('datasets'))
+    return result
+
+
+@chained_action
+def bulk_update_public(action, context, data_dict):
+    result = action(context, data_dict)
+    _update_sort_package_counts(package_ids=data_dict.get('datasets'))
+    return result
+
+
+@chained_action
+def bulk_update_delete(action, context, data_dict):
+    result = action(context, data_dict)
+    _update_sort_package_counts(package_ids=data_dict.get('datasets'))
+    return result
+
+
 @chained_action
 def resource_delete(action, context, data_dict):
     package_id = None
@@ -675,7 +696,7 @@ def resource_delete(action, context, data_dict):
 
     try:
         if package_id:
-            update_package_stats(package_id)
+            queue_package_stats_update(package_id)
     except Exception as e:
         log.error(e)
         log.exception(e)
@@ -967,21 +988,24 @@ def group_show(context, data_dict):
     return data
 
 
-def get_package_stats(package_id):
+def get_package_stats(package_id, pkg_dict=None):
     """ This function returns the dataset statictics
     :param package_id: the id of the dataset
     :type package_id: str
+    :param pkg_dict: the dataset, if already available. Otherwise the dataset
+        is fetched with package_show
+    :type pkg_dict: dict
     :returns: The largest resource in file size and the total number
     of downloads of all resources that belong to this dataset
     :rtype: dict
 
     """
 
-    pkg_dict = {}
-    try:
-        pkg_dict = get_action('package_show')({'ignore_auth': True}, {'id': package_id})
-    except toolkit.NotFound:
-        return None
+    if pkg_dict is None:
+        try:
+            pkg_dict = get_action('package_show')({'ignore_auth': True}, {'id': package_id})
+        except toolkit.NotFound:
+            return None
 
     sizes = [rc.get('size', 0) if rc.get('size', 0) else 0 for rc in pkg_dict.get('resources', [])]
     max_file_size = 0
@@ -1005,22 +1029,121 @@ def increment_downloads_for_resource(context, data_dict):
 
     """
     resource_id = data_dict.get('resource_id')
-    increment_downloads(resource_id)
-    # Also, update the stats in dataset indexed metadata
-    try:
-        resource = get_action('resource_show')({'ignore_auth': True}, {'id': resource_id})
-        update_package_stats(resource['package_id'])
-    except Exception as e:
-        log.debug(e)
-        import traceback
-        traceback.print_exc()
+    # Also updates the stats in dataset indexed metadata, right away or on
+    # the next flush when the downloads are buffered.
+    record_downloads([resource_id])
 
     return 'success'
 
+
+@chained_action
+def package_delete(action, context, data_dict):
+    result = action(context, data_dict)
+    # The deleted dataset must not be listed as related to other datasets
+    related_datasets_cache().clear()
+    return result
+
+
+@toolkit.side_effect_free
+def cache_stats(context, data_dict):
+    """ Returns the hit and miss counters of the datagovmk caches used in
+    the current CKAN process (or in all processes for the ``redis`` cache
+    backend). Only available for system administrators.
+
+    :returns: the statistics per cache name
+    :rtype: dict
+    """
+    check_access('datagovmk_cache_stats', context, data_dict)
+
+    return get_caches_stats()
+
+
+@toolkit.side_effect_free
+def outdated_notifications_stats(context, data_dict):
+    """ Returns the number of datasets currently due for an update and the
+    counts from the outdated datasets notification ledger. Only available
+    for system administrators.
+
+    :returns: ``overdue`` - datasets due for an update, ``notified`` -
+        datasets ever notified, ``notified_recently`` - datasets notified
+        within the backoff window (these are not notified again for the same
+        due date), ``pending`` - overdue datasets that will be notified on
+        the next run (estimate), ``last_notified_at``
+    :rtype: dict
+    """
+    from ckanext.datagovmk.commands import get_notifications_backoff
+    from ckanext.datagovmk.model.outdated_notification import OutdatedNotification
+
+    check_access('datagovmk_outdated_notifications_stats', context, data_dict)
+
+    backoff = get_notifications_backoff()
+    stats = OutdatedNotification.get_stats(datetime.datetime.utcnow() - backoff)
+    overdue = get_action('package_search')({'ignore_auth': True}, {
+        'fq': '+next_update_due:[* TO NOW]',
+        'include_private': True,
+        'rows': 0,
+    })['count']
+    stats.update({
+        'overdue': overdue,
+        'pending': max(overdue - stats['notified_recently'], 0),
+        'backoff_days': backoff.days,
+    })
+    return stats
+
+
+def _group_list_summary(rows, id_field, is_organization):
+    """ Builds the entries of organization_list/group_list in summary mode
+    out of the rows of ``get_summary`` of the sort models.
+
+    :param rows: tuples of the sort model object, name, title, image url
+        and number of datasets of the organization or group
+    :type rows: list
+    :param id_field: the attribute of the sort model holding the id
+    :type id_field: str
+    :param is_organization: whether the rows are organizations or groups
+    :type is_organization: bool
+    :returns: the list entries with id, name, translated title, image and
+        number of datasets
+    :rtype: list
+    """
+    try:
+        lang = core_helpers.lang() or 'mk'
+    except (TypeError, RuntimeError):
+        lang = 'mk'
+
+    group_list = []
+    for sort_row, name, title, image_url, package_count in rows:
+        title_translated = dict(
+            (code, getattr(sort_row, 'title_' + code) or '')
+            for code in ('mk', 'en', 'sq'))
+        display_name = title_translated.get(lang) or title or name
+
+        image_display_url = image_url
+        if image_url and not image_url.startswith('http'):
+            image_display_url = core_helpers.url_for_static(
+                'uploads/group/%s' % munge.munge_filename_legacy(image_url),
+                qualified=True)
+
+        group_list.append({
+            'id': getattr(sort_row, id_field),
+            'name': name,
+            'title': display_name,
+            'display_name': display_name,
+            'title_translated': title_translated,
+            'image_url': image_url,
+            'image_display_url': image_display_url,
+            'package_count': package_count or 0,
+            'is_organization': is_organization,
+            'type': 'organization' if is_organization else 'group',
+        })
+
+    return group_list
+
+
 def organization_list(context, data_dict):
 
     q = data_dict.get('q', '')
-    sort = data_dict.get('sort', None)
+    sort = (data_dict.get('sort') or '').strip()
     try:
         if not sort:
             sort = 'title_' + core_helpers.lang() + ' asc'
@@ -1034,6 +1157,11 @@ def organization_list(context, data_dict):
     kwargs['offset'] = int(data_dict.get('offset', 0))
     kwargs['order_by'] = sort
 
+    if toolkit.asbool(data_dict.get('summary', False)):
+        return _group_list_summary(
+            SortOrganizationsModel.get_summary(**kwargs).all(), 'org_id',
+            is_organization=True)
+
     groups = []
 
     groups = SortOrganizationsModel.get(**kwargs).all()
@@ -1122,6 +1250,7 @@ def organization_delete(context, data_dict):
         item.delete(group)
 
     model.repo.commit()
+    organization_titles_cache().clear()
 
     try:
         filter = {'org_id': id }
@@ -1134,6 +1263,7 @@ def organization_delete(context, data_dict):
 def organization_create(context, data_dict):
 
     org = ckan_organization_create(context, data_dict)
+    organization_titles_cache().clear()
 
     sort_org = {
         'org_id': org.get('id', ''),
@@ -1149,6 +1279,7 @@ def organization_create(context, data_dict):
 def organization_update(context, data_dict):
 
     org = ckan_organization_update(context, data_dict)
+    organization_titles_cache().clear()
 
     try:
         for extra in org.get('extras',[]):
@@ -1169,39 +1300,32 @@ def organization_update(context, data_dict):
 
 def group_list(context, data_dict):
 
-    model = context['model']
-
     q = data_dict.get('q', '')
     limit = int(data_dict.get('limit', 1000))
     offset = int(data_dict.get('offset', 0))
-    sort = data_dict.get('sort') or 'title_{0} asc'.format(core_helpers.lang())
+    sort = (data_dict.get('sort') or '').strip() or \
+        'title_{0} asc'.format(core_helpers.lang())
 
     sort_info = sort.split()
 
-    if sort_info[0] == 'package_count':
-
-        sort_model_field = sqlalchemy.func.count(SortGroupsModel.group_id)
+    # Sorting by the number of datasets leaves out the empty groups
+    non_empty = sort_info[0] == 'package_count'
+    if non_empty:
+        sort = 'package_count desc'
 
-        query = model.Session.query(SortGroupsModel.group_id, sqlalchemy.func.count(SortGroupsModel.group_id)) \
-            .filter(model.Member.group_id == SortGroupsModel.group_id) \
-            .filter(model.Member.table_id == model.Package.id) \
-            .filter(model.Member.table_name == 'package') \
-            .filter(model.Package.state == 'active') \
-            .group_by(SortGroupsModel.group_id) \
-            .order_by(sqlalchemy.desc(sort_model_field)) \
-            .limit(limit) \
-            .offset(offset)
+    kwargs = {}
 
-        groups = query.all()
-    else:
-        kwargs = {}
+    kwargs['q'] = q
+    kwargs['limit'] = limit
+    kwargs['offset'] = offset
+    kwargs['order_by'] = sort
+    kwargs['non_empty'] = non_empty
 
-        kwargs['q'] = q
-        kwargs['limit'] = limit
-        kwargs['offset'] = offset
-        kwargs['order_by'] = sort
+    if toolkit.asbool(data_dict.get('summary', False)):
+        return _group_list_summary(SortGroupsModel.get_summary(**kwargs).all(),
+                                   'group_id', is_organization=False)
 
-        groups = SortGroupsModel.get(**kwargs).all()
+    groups = SortGroupsModel.get(**kwargs).all()
 
     group_list = []
     for group in groups:
@@ -1219,6 +1343,7 @@ def group_list(context, data_dict):
 def group_delete(context, data_dict):
 
     group = _group_delete(context, data_dict)
+    related_datasets_cache().clear()
 
     try:
         filter = {'group_id': data_dict['id'] }
@@ -1246,6 +1371,7 @@ def group_create(context, data_dict):
 def group_update(context, data_dict):
 
     gr = _group_update(context, data_dict)
+    related_datasets_cache().clear()
 
     try:
         for extra in gr.get('extras',[]):
@@ -67,9 +67,50 @@ $(document).ready(function () {
     toggleDownloadButtons();
   });
 
+  var resetDownloadButton = function () {
+    downloadResourcesBtn.removeAttr('disabled');
+    downloadResourcesBtn.text(_('Download'));
+  };
+
+  var downloadZip = function (zip_id) {
+    resetDownloadButton();
+
+    if (zip_id) {
+      clickLinkInBackground(window.location.origin + '/dataset/download/zip/' + zip_id);
+    } else {
+      window.ckan.notify(_('Could not create a zip archive.'));
+    }
+  };
+
+  var failZip = function () {
+    resetDownloadButton();
+    window.ckan.notify(_('An error occured while preparing zip archive.'));
+  };
+
+  // The archive is built by a background job, poll its status until it is done.
+  var pollZipStatus = function (job_id) {
+    var url = window.location.origin + '/api/action/datagovmk_zip_resources_status';
+
+    $.getJSON(url, { id: job_id }, function (response) {
+      var result = response.result;
+
+      if (result.status === 'finished') {
+        downloadZip(result.zip_id);
+      } else if (result.status === 'failed') {
+        failZip();
+      } else {
+        downloadResourcesBtn.text(_('Preparing zip archive...') + ' ' +
+          result.resources_done + '/' + result.resources_total);
+        setTimeout(function () {
+          pollZipStatus(job_id);
+        }, 1000);
+      }
+    }).fail(failZip);
+  };
+
   downloadResourcesBtn.click(function (e) {
     var url = window.location.origin + '/api/action/datagovmk_prepare_zip_resources';
-    var data = { resources: [] };
+    var data = { resources: [], async: true };
 
     downloadResourcesBtn.attr('disabled', 'disabled');
     downloadResourcesBtn.text(_('Preparing zip archive...'));
@@ -81,28 +122,12 @@ $(document).ready(function () {
     });
 
     $.post(url, JSON.stringify(data), function (response) {
-      var zip_id = response.result.zip_id;
-
-      downloadResourcesBtn.removeAttr('disabled');
-      downloadResourcesBtn.text(_('Download'));
-
-      if (zip_id) {
-        var link = document.createElement('a');
-        url = window.location.origin + '/download/zip/' + zip_id;
-        link.style.display = 'none';
-        link.href = url;
-        document.body.appendChild(link);
-        link.click();
-        document.body.removeChild(link);
+      if (response.result.job_id) {
+        pollZipStatus(response.result.job_id);
       } else {
-        window.ckan.notify(_('Could not create a zip archive.'));
+        downloadZip(response.result.zip_id);
       }
-    }).fail(function (response) {
-      downloadResourcesBtn.removeAttr('disabled');
-      downloadResourcesBtn.text(_('Download'));
-
-      window.ckan.notify(_('An error occured while preparing zip archive.'));
-    });
+    }).fail(failZip);
   });
 
   downloadMetadata.click(function(e){
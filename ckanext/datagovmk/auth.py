@@ -31,3 +31,13 @@ def start_script(context, data_dict):
     """ This is a sensitive action, so only sysadmins are allowed to execute
     it """
     return {'success': False}
+
+
+def cache_stats(context, data_dict):
+    """ Only sysadmins can see the cache statistics """
+    return {'success': False}
+
+
+def outdated_notifications_stats(context, data_dict):
+    """ Only sysadmins can see the outdated datasets notification statistics """
+    return {'success': False}
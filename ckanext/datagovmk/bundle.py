@@ -0,0 +1,664 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Building of the ZIP archives with resources offered for download on the
+dataset page.
+"""
+
+import os
+import re
+import time
+import uuid
+import hashlib
+import shutil
+import mimetypes
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from logging import getLogger
+
+import requests
+
+import ckan.lib.uploader as uploader
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+from ckan.views.admin import _get_sysadmins
+
+from ckanext.datagovmk.helpers import get_storage_path_for
+from ckanext.datagovmk.downloads import record_downloads
+
+
+log = getLogger(__name__)
+
+# Size of the chunks in which the resources are streamed into the archive.
+CHUNK_SIZE = 64 * 1024
+
+# Buffer size used when copying uploaded resources from the local disk.
+LOCAL_CHUNK_SIZE = 1024 * 1024
+
+# Directory (within CKAN's storage path) for the archives that are removed
+# after being downloaded, and the one for the cached archives.
+TEMP_DIR = 'temp-datagovmk'
+CACHE_DIR = 'temp-datagovmk-cache'
+
+# Seconds after which the archives that are not cached are removed, when
+# they were not downloaded completely.
+TEMP_MAX_AGE = 24 * 3600
+
+# Archive file names, as used in the ``zip_id``.
+ARCHIVE_NAME_PATTERN = re.compile(r'^[0-9a-f]{32,64}\.zip$')
+
+# Fetched resources smaller than this are kept in memory, the larger ones
+# are spooled to a temporary file.
+SPOOL_SIZE = 1024 * 1024
+
+SUPPORTED_RESOURCE_MIMETYPES = [
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/x-msdownload',
+    'application/msword',
+    'application/vnd.google-earth.kml+xml',
+    'application/vnd.ms-excel',
+    'application/msexcel',
+    'application/x-msexcel',
+    'application/x-ms-excel',
+    'application/x-excel',
+    'application/x-dos_ms_excel',
+    'application/xls',
+    'application/x-xls',
+    'wcs',
+    'application/x-javascript',
+    'application/x-msaccess',
+    'application/netcdf',
+    'text/tab-separated-values',
+    'text/x-perl',
+    'application/vnd.google-earth.kmz+xml',
+    'application/vnd.google-earth.kmz',
+    'application/owl+xml',
+    'application/x-n3',
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-qgis',
+    'application/vnd.oasis.opendocument.spreadsheet',
+    'application/vnd.oasis.opendocument.text',
+    'application/json',
+    'image/x-ms-bmp',
+    'application/rar',
+    'image/tiff',
+    'application/vnd.oasis.opendocument.database',
+    'text/plain',
+    'application/x-director',
+    'application/vnd.oasis.opendocument.formula',
+    'application/vnd.oasis.opendocument.graphics',
+    'application/xml',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/octet-stream',
+    'application/xslt+xml',
+    'image/svg+xml',
+    'application/vnd.ms-powerpoint',
+    'application/vnd.oasis.opendocument.presentation',
+    'image/jpeg',
+    'application/sparql-results+xml',
+    'image/gif',
+    'application/rdf+xml',
+    'application/pdf',
+    'text/csv',
+    'application/vnd.oasis.opendocument.chart',
+    'application/atom+xml',
+    'application/x-tar',
+    'image/png',
+    'application/rss+xml',
+    'application/geo+json'
+]
+
+
+def get_bundle_config():
+    """Returns the limits used while building an archive, read from the CKAN
+    configuration.
+
+    :returns: ``max_workers`` - number of resources fetched concurrently,
+        ``timeout`` - timeout in seconds for a single HTTP request,
+        ``deadline`` - seconds available for building the whole archive,
+        ``max_resource_size`` - maximal size of a single resource in bytes,
+        ``cache_enabled`` - whether the archives are cached,
+        ``cache_size`` - the size budget of the archive cache in bytes,
+        ``cache_max_age`` - seconds after which a cached archive containing
+        link resources is rebuilt.
+    :rtype: dict
+    """
+    return {
+        'cache_enabled': toolkit.asbool(
+            config.get('ckanext.datagovmk.zip.cache_enabled', True)),
+        'cache_size': int(
+            config.get('ckanext.datagovmk.zip.cache_size', 2048)) * 1024 * 1024,
+        'cache_max_age': float(
+            config.get('ckanext.datagovmk.zip.cache_max_age', 24)) * 3600,
+        'max_workers': int(config.get('ckanext.datagovmk.zip.max_workers', 4)),
+        'timeout': float(config.get('ckanext.datagovmk.zip.request_timeout', 5)),
+        'deadline': float(config.get('ckanext.datagovmk.zip.deadline', 60)),
+        'max_resource_size': int(
+            config.get('ckanext.datagovmk.zip.max_resource_size', 500)) * 1024 * 1024,
+    }
+
+
+def get_archive_name(resource):
+    """Returns the name of the file for the resource within the archive.
+
+    :param resource: the resource metadata.
+    :type resource: dict
+
+    :rtype: str
+    """
+    url = resource.get('url')
+    if resource['url_type'] == 'upload':
+        return url.split('/')[-1]
+
+    name = resource['name']
+    if os.path.splitext(name)[-1] == '':
+        _format = resource['format']
+        if _format:
+            name += '.{ext}'.format(ext=_format.lower())
+    return name
+
+
+def _unique_name(name, names):
+    base, ext = os.path.splitext(name)
+    counter = 1
+    while name in names:
+        name = '{0}_{1}{2}'.format(base, counter, ext)
+        counter += 1
+    names.add(name)
+    return name
+
+
+def fetch_resource(resource, headers, limits, deadline):
+    """Streams the resource body over HTTP into a temporary file.
+
+    :param resource: the resource metadata.
+    :type resource: dict
+    :param headers: HTTP headers sent with the request.
+    :type headers: dict
+    :param limits: the limits as returned by :py:func:`get_bundle_config`.
+    :type limits: dict
+    :param deadline: the time (as in ``time.time()``) by which the fetching
+        must finish.
+    :type deadline: float
+
+    :returns: the temporary file positioned at the beginning, or ``None``
+        if the resource is not available, not supported or too large.
+    :rtype: file object
+    """
+    timeout = min(limits['timeout'], max(deadline - time.time(), 0.1))
+    max_size = limits['max_resource_size']
+
+    try:
+        r = requests.get(resource.get('url'), headers=headers, timeout=timeout,
+                         verify=False, stream=True)
+    except Exception as e:
+        log.debug('Failed to fetch resource %s: %s', resource['id'], e)
+        return None
+
+    with r:
+        content_type = r.headers.get('Content-Type', '').split(';')[0]
+        if content_type not in SUPPORTED_RESOURCE_MIMETYPES:
+            return None
+
+        content_length = r.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and \
+           int(content_length) > max_size:
+            log.warning('Resource %s is larger than %d bytes, skipped.',
+                        resource['id'], max_size)
+            return None
+
+        tmp = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        size = 0
+        try:
+            for chunk in r.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    log.warning('Resource %s is larger than %d bytes, skipped.',
+                                resource['id'], max_size)
+                    tmp.close()
+                    return None
+                if time.time() > deadline:
+                    log.warning('Deadline reached while fetching resource %s.',
+                                resource['id'])
+                    tmp.close()
+                    return None
+                tmp.write(chunk)
+        except Exception as e:
+            log.debug('Failed to fetch resource %s: %s', resource['id'], e)
+            tmp.close()
+            return None
+
+    tmp.seek(0)
+    return tmp
+
+
+def get_local_path(resource):
+    """Returns the path on the local disk of an uploaded resource.
+
+    :param resource: the resource metadata.
+    :type resource: dict
+
+    :returns: the path of the uploaded file, or ``None`` if the resource is
+        a link or its file is not stored on the local disk (for example
+        when a cloud storage uploader is used).
+    :rtype: str
+    """
+    if resource.get('url_type') != 'upload':
+        return None
+    try:
+        upload = uploader.get_resource_uploader(dict(resource))
+        path = upload.get_path(resource['id'])
+    except Exception as e:
+        log.debug('No local path for resource %s: %s', resource['id'], e)
+        return None
+    if path and os.path.isfile(path):
+        return path
+    return None
+
+
+def is_site_url(url):
+    """Checks whether the URL points to this CKAN site (``ckan.site_url``).
+
+    :param url: the URL to check.
+    :type url: str
+
+    :rtype: bool
+    """
+    site_url = (config.get('ckan.site_url') or '').rstrip('/')
+    if not url or not site_url:
+        return False
+    return url == site_url or url.startswith(site_url + '/')
+
+
+def _is_supported_local(resource, path, limits):
+    content_type = resource.get('mimetype') or \
+        mimetypes.guess_type(get_archive_name(resource))[0]
+    if content_type not in SUPPORTED_RESOURCE_MIMETYPES:
+        return False
+    if os.path.getsize(path) > limits['max_resource_size']:
+        log.warning('Resource %s is larger than %d bytes, skipped.',
+                    resource['id'], limits['max_resource_size'])
+        return False
+    return True
+
+
+def _write_entry(zip, name, fileobj, chunk_size=CHUNK_SIZE):
+    # seek() of SpooledTemporaryFile returns None on Python 3.6
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    with zip.open(name, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as entry:
+        shutil.copyfileobj(fileobj, entry, chunk_size)
+    return size
+
+
+def build_zip_archive(file_path, resources, progress=None):
+    """Builds a ZIP archive with the given resources.
+
+    Uploaded resources stored on the local disk are copied into the archive
+    straight from their files. The other resources are fetched over HTTP,
+    concurrently by a bounded pool of threads. Each body is streamed in
+    chunks to a spooled temporary file, so no resource is held in memory as a
+    whole, and then copied in chunks into its own entry in the archive.
+    Resources that are not available, have an unsupported content type, are
+    larger than the configured limit or are not fetched before the deadline
+    are left out.
+
+    :param file_path: the path of the archive to be created.
+    :type file_path: str
+    :param resources: the metadata of the resources to put in the archive.
+    :type resources: list
+    :param progress: optional callable, called with the number of processed
+        resources and the number of bytes written after each resource.
+    :type progress: function
+
+    :returns: the ids of the resources written to the archive.
+    :rtype: list
+    """
+    limits = get_bundle_config()
+    deadline = time.time() + limits['deadline']
+    progress = progress or (lambda resources_done, bytes_done: None)
+
+    archived = []
+    done = [0, 0]
+    names = set()
+    local_resources = []
+    remote_resources = []
+    for resource in resources:
+        path = get_local_path(resource)
+        if path:
+            local_resources.append((resource, path))
+        else:
+            remote_resources.append(resource)
+
+    # The API key is only sent to this site, never to third-party links
+    site_headers = {}
+    if any(is_site_url(resource.get('url')) for resource in remote_resources):
+        site_headers['Authorization'] = _get_sysadmins()[0].apikey
+
+    executor = ThreadPoolExecutor(max_workers=limits['max_workers'])
+    futures = dict(
+        (executor.submit(fetch_resource, resource,
+                         site_headers if is_site_url(resource.get('url')) else {},
+                         limits, deadline),
+         resource)
+        for resource in remote_resources)
+
+    try:
+        with zipfile.ZipFile(file_path, 'w') as zip:
+            def _add(resource, fileobj, chunk_size=CHUNK_SIZE):
+                done[0] += 1
+                if fileobj is not None:
+                    with fileobj:
+                        done[1] += _write_entry(
+                            zip, _unique_name(get_archive_name(resource), names),
+                            fileobj, chunk_size)
+                    archived.append(resource['id'])
+                progress(done[0], done[1])
+
+            for resource, path in local_resources:
+                fileobj = None
+                if _is_supported_local(resource, path, limits):
+                    fileobj = open(path, 'rb')
+                _add(resource, fileobj, LOCAL_CHUNK_SIZE)
+
+            try:
+                for future in as_completed(futures,
+                                           timeout=max(deadline - time.time(), 0)):
+                    _add(futures[future], future.result())
+            except TimeoutError:
+                log.warning('Deadline reached while preparing zip archive, '
+                            '%d of %d resources archived.',
+                            len(archived), len(resources))
+    finally:
+        # The spooled files of the futures not consumed, including the ones
+        # finishing after the deadline, are closed as soon as they are done.
+        for future in futures:
+            if not future.cancel():
+                future.add_done_callback(_close_result)
+        executor.shutdown(wait=False)
+
+    return archived
+
+
+def _close_result(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    fileobj = future.result()
+    if fileobj is not None:
+        fileobj.close()
+
+
+def get_archive_key(resources):
+    """Computes the key under which the archive with the given resources is
+    cached. The key changes whenever any of the resources changes: uploaded
+    resources carry the MD5 ``checksum`` of their file, and for all resources
+    the modification time and the URL are taken into account.
+
+    :param resources: the metadata of the resources in the archive.
+    :type resources: list
+
+    :returns: hex digest identifying the set of resources and their versions.
+    :rtype: str
+    """
+    parts = sorted(u'{0}:{1}:{2}:{3}'.format(
+        resource['id'],
+        resource.get('checksum') or '',
+        resource.get('last_modified') or resource.get('created') or '',
+        resource.get('url') or '') for resource in resources)
+    return hashlib.sha1(u'\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_archive_path(file_name):
+    """Resolves the archive file name from a ``zip_id``.
+
+    :param file_name: the archive file name.
+    :type file_name: str
+
+    :returns: a tuple ``(path, cached)`` with the full path of the archive
+        and whether it belongs to the archive cache, or ``(None, False)`` if
+        there is no such archive.
+    :rtype: tuple
+    """
+    if not file_name or not ARCHIVE_NAME_PATTERN.match(file_name):
+        return None, False
+
+    path = os.path.join(get_storage_path_for(CACHE_DIR), file_name)
+    if os.path.isfile(path):
+        return path, True
+
+    path = os.path.join(get_storage_path_for(TEMP_DIR), file_name)
+    if os.path.isfile(path):
+        return path, False
+
+    return None, False
+
+
+def touch_archive(path):
+    """Marks a cached archive as recently used. The access time is used for
+    the LRU eviction, the modification time stays the time of the build.
+    """
+    try:
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+    except OSError:
+        pass
+
+
+def prepare_zip_archive(resources, progress=None, cache=True):
+    """Returns an archive with the given resources, building it only if there
+    is no valid cached one.
+
+    Cached archives are shared by all users and are reused for as long as
+    none of the resources has changed. Archives containing link resources
+    are rebuilt once they are older than the configured maximal age, since
+    the remote content may change without CKAN knowing.
+
+    :param resources: the metadata of the resources to put in the archive.
+    :type resources: list
+    :param progress: optional progress callback, see
+        :py:func:`build_zip_archive`.
+    :type progress: function
+    :param cache: whether the archive may be cached. Archives of private
+        datasets must not be, since the cached ones are served to anyone
+        with the link.
+    :type cache: bool
+
+    :returns: the archive file name, or ``None`` if none of the resources
+        could be archived.
+    :rtype: str
+    """
+    limits = get_bundle_config()
+
+    if not limits['cache_enabled'] or not cache:
+        sweep_temp_archives()
+        file_name = uuid.uuid4().hex + '.zip'
+        file_path = os.path.join(get_storage_path_for(TEMP_DIR), file_name)
+        if build_zip_archive(file_path, resources, progress):
+            return file_name
+        os.remove(file_path)
+        return None
+
+    cache_dir = get_storage_path_for(CACHE_DIR)
+    file_name = get_archive_key(resources) + '.zip'
+    file_path = os.path.join(cache_dir, file_name)
+
+    if os.path.isfile(file_path):
+        has_links = any(resource.get('url_type') != 'upload'
+                        for resource in resources)
+        age = time.time() - os.path.getmtime(file_path)
+        if not has_links or age < limits['cache_max_age']:
+            touch_archive(file_path)
+            return file_name
+
+    # Build under a temporary name, so concurrent requests never see a
+    # partially written archive.
+    tmp_path = '{0}.{1}.tmp'.format(file_path, uuid.uuid4().hex)
+    try:
+        archived = build_zip_archive(tmp_path, resources, progress)
+        if not archived:
+            return None
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    sweep_archive_cache(limits['cache_size'])
+    return file_name
+
+
+def sweep_archive_cache(cache_size):
+    """Evicts the least recently used archives from the cache until the
+    total size of the cache fits in ``cache_size`` bytes. Leftovers of
+    interrupted builds older than a day are removed as well.
+
+    :param cache_size: the size budget of the cache in bytes.
+    :type cache_size: int
+    """
+    cache_dir = get_storage_path_for(CACHE_DIR)
+    now = time.time()
+    archives = []
+    total_size = 0
+
+    for file_name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, file_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if file_name.endswith('.tmp'):
+            if now - stat.st_mtime > 24 * 3600:
+                _remove_quietly(path)
+            continue
+        archives.append((stat.st_atime, stat.st_size, path))
+        total_size += stat.st_size
+
+    for _, size, path in sorted(archives):
+        if total_size <= cache_size:
+            break
+        _remove_quietly(path)
+        total_size -= size
+
+
+def sweep_temp_archives(max_age=TEMP_MAX_AGE):
+    """Removes the archives that are not cached and were not downloaded
+    completely (their download is removed once the whole file is sent)
+    within ``max_age`` seconds.
+
+    :param max_age: the age in seconds after which the archives are removed.
+    :type max_age: int
+    """
+    temp_dir = get_storage_path_for(TEMP_DIR)
+    now = time.time()
+    for file_name in os.listdir(temp_dir):
+        path = os.path.join(temp_dir, file_name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                _remove_quietly(path)
+        except OSError:
+            continue
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        log.debug('Failed to remove %s: %s', path, e)
+
+
+def bundle_resources(resources, progress=None):
+    """Prepares the archive with the given resources and counts a download
+    for each of them.
+
+    :param resources: the metadata of the resources to put in the archive.
+    :type resources: list
+    :param progress: optional progress callback, see
+        :py:func:`build_zip_archive`.
+    :type progress: function
+
+    :returns: a dictionary containing the ``zip_id`` of the archive, or
+        ``None`` if none of the resources could be archived.
+    :rtype: dict
+    """
+    package_ids = set(resource['package_id'] for resource in resources)
+    packages = {}
+    for package_id in package_ids:
+        try:
+            packages[package_id] = toolkit.get_action('package_show')(
+                {'ignore_auth': True}, {'id': package_id})
+        except Exception:
+            pass
+
+    # Only archives of public datasets are cached and shared, the others
+    # get a random single-use name.
+    cache = len(packages) == len(package_ids) and \
+        not any(package.get('private') for package in packages.values())
+
+    file_name = prepare_zip_archive(resources, progress, cache=cache)
+    if not file_name:
+        return {'zip_id': None}
+
+    zip_id = file_name
+    package = packages.get(resources[0]['package_id'])
+    if package:
+        zip_id += '::{name}'.format(name=package['name'])
+
+    record_downloads([resource['id'] for resource in resources],
+                     reindex=False)
+    return {'zip_id': zip_id}
+
+
+def build_zip_job(resource_ids):
+    """Background job building the archive with the given resources.
+
+    The progress is reported in the job's ``meta`` as ``resources_total``,
+    ``resources_done`` and ``bytes_done``. Access to the resources must be
+    checked before the job is enqueued.
+
+    :param resource_ids: the ids of the resources to put in the archive.
+    :type resource_ids: list
+
+    :returns: a dictionary containing the ``zip_id`` of the archive.
+    :rtype: dict
+    """
+    import rq
+
+    job = rq.get_current_job()
+
+    def _progress(resources_done, bytes_done):
+        if job is None:
+            return
+        job.meta.update({
+            'resources_total': len(resource_ids),
+            'resources_done': resources_done,
+            'bytes_done': bytes_done,
+        })
+        job.save_meta()
+
+    resources = [toolkit.get_action('resource_show')({'ignore_auth': True},
+                                                     {'id': resource_id})
+                 for resource_id in resource_ids]
+    _progress(0, 0)
+
+    try:
+        return bundle_resources(resources, _progress)
+    except Exception as e:
+        log.error('An error occured while preparing zip archive. Error: %s', e)
+        raise
@@ -0,0 +1,276 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Small caching layer used by the datagovmk helpers and actions.
+
+Two backends are available:
+
+* ``memory`` - a process-local LRU cache with TTL. Invalidation is only
+  visible in the process where it happened, the TTL bounds the staleness
+  in the other processes.
+* ``redis`` - shared between all CKAN processes, using CKAN's Redis
+  connection. Invalidation is visible everywhere.
+
+The backend is chosen with ``ckanext.datagovmk.cache.backend`` (default
+``memory``). Every named cache can override its size and TTL with
+``ckanext.datagovmk.cache.<name>.size`` and
+``ckanext.datagovmk.cache.<name>.ttl``.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+from ckan.plugins.toolkit import config
+
+
+log = getLogger(__name__)
+
+_MISSING = object()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class MemoryCache(object):
+    """Thread-safe, process-local LRU cache with time-to-live.
+
+    :param name: the name of the cache.
+    :type name: str
+    :param maxsize: maximal number of entries kept in the cache.
+    :type maxsize: int
+    :param ttl: number of seconds an entry is valid. ``None`` or ``0`` keeps
+        the entries until they are evicted or invalidated.
+    :type ttl: int
+    """
+
+    backend = 'memory'
+
+    def __init__(self, name, maxsize=1000, ttl=300):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires, value = entry
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data = OrderedDict()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+        }
+
+
+class RedisCache(object):
+    """Cache stored in CKAN's Redis, shared by all CKAN processes.
+
+    The values must be JSON serializable. Clearing the cache bumps a
+    generation counter which is part of every key, so the old entries are
+    never read again and expire on their own. Hit and miss counters are
+    kept in Redis as well, so they cover all processes.
+
+    Any Redis error is logged and handled as a cache miss.
+
+    :param name: the name of the cache.
+    :type name: str
+    :param ttl: number of seconds an entry is valid.
+    :type ttl: int
+    """
+
+    backend = 'redis'
+
+    def __init__(self, name, ttl=300):
+        self.name = name
+        self.ttl = ttl
+        self._prefix = 'ckanext-datagovmk:cache:{0}'.format(name)
+
+    def _redis(self):
+        from ckan.lib.redis import connect_to_redis
+        return connect_to_redis()
+
+    def _key(self, redis, key):
+        generation = redis.get(self._prefix + ':generation') or b'0'
+        if isinstance(generation, bytes):
+            generation = generation.decode('utf-8')
+        return '{0}:{1}:{2}'.format(self._prefix, generation, key)
+
+    def _count(self, redis, counter):
+        redis.hincrby(self._prefix + ':stats', counter, 1)
+
+    def get(self, key, default=None):
+        try:
+            redis = self._redis()
+            value = redis.get(self._key(redis, key))
+            if value is None:
+                self._count(redis, 'misses')
+                return default
+            self._count(redis, 'hits')
+            return json.loads(value)
+        except Exception as e:
+            log.warning('Failed to read from cache %s: %s', self.name, e)
+            return default
+
+    def set(self, key, value):
+        try:
+            redis = self._redis()
+            redis.set(self._key(redis, key), json.dumps(value),
+                      ex=self.ttl or None)
+        except Exception as e:
+            log.warning('Failed to write to cache %s: %s', self.name, e)
+
+    def delete(self, key):
+        try:
+            redis = self._redis()
+            redis.delete(self._key(redis, key))
+        except Exception as e:
+            log.warning('Failed to delete from cache %s: %s', self.name, e)
+
+    def clear(self):
+        try:
+            self._redis().incr(self._prefix + ':generation')
+        except Exception as e:
+            log.warning('Failed to clear cache %s: %s', self.name, e)
+
+    def reset_stats(self):
+        try:
+            self._redis().delete(self._prefix + ':stats')
+        except Exception as e:
+            log.warning('Failed to reset stats for cache %s: %s', self.name, e)
+
+    def stats(self):
+        stats = {'backend': self.backend, 'hits': 0, 'misses': 0,
+                 'ttl': self.ttl}
+        try:
+            counters = self._redis().hgetall(self._prefix + ':stats')
+        except Exception as e:
+            log.warning('Failed to read stats for cache %s: %s', self.name, e)
+            return stats
+        for counter, value in counters.items():
+            if isinstance(counter, bytes):
+                counter = counter.decode('utf-8')
+            stats[counter] = int(value)
+        return stats
+
+
+def get_backend():
+    """Returns the configured cache backend, ``memory`` or ``redis``.
+
+    :rtype: str
+    """
+    return config.get('ckanext.datagovmk.cache.backend', 'memory')
+
+
+def get_cache(name, maxsize=1000, ttl=300, backend=None):
+    """Returns the named cache, creating it on first use with the backend,
+    size and TTL from the CKAN configuration.
+
+    :param name: the name of the cache.
+    :type name: str
+    :param maxsize: default maximal number of entries (``memory`` backend).
+    :type maxsize: int
+    :param ttl: default number of seconds an entry is valid.
+    :type ttl: int
+    :param backend: use this backend instead of the configured one, for
+        caches that only make sense in one of them.
+    :type backend: str
+
+    :returns: the cache
+    :rtype: MemoryCache or RedisCache
+    """
+    cache = _caches.get(name)
+    if cache is not None:
+        return cache
+
+    with _caches_lock:
+        if name not in _caches:
+            option = 'ckanext.datagovmk.cache.{0}.'.format(name)
+            ttl = int(config.get(option + 'ttl', ttl))
+            maxsize = int(config.get(option + 'size', maxsize))
+            backend = backend or get_backend()
+
+            if backend == 'redis':
+                _caches[name] = RedisCache(name, ttl=ttl)
+            else:
+                _caches[name] = MemoryCache(name, maxsize=maxsize, ttl=ttl)
+        return _caches[name]
+
+
+def get_caches_stats():
+    """Returns the hit/miss statistics for all caches used so far in this
+    process.
+
+    :rtype: dict
+    """
+    return dict((name, cache.stats()) for name, cache in _caches.items())
+
+
+def related_datasets_cache():
+    """The cache for :py:func:`ckanext.datagovmk.helpers.get_related_datasets`.
+
+    Any change of a dataset or group clears the whole cache. With the
+    ``memory`` backend only the process making the change sees it, the
+    other processes serve stale entries until they expire, so the default
+    TTL is 5 minutes instead of an hour.
+    """
+    ttl = 300 if get_backend() == 'memory' else 3600
+    return get_cache('related_datasets', maxsize=5000, ttl=ttl)
+
+
+def organization_titles_cache():
+    """The cache for :py:func:`ckanext.datagovmk.helpers.get_org_titles`.
+    """
+    return get_cache('organization_titles', maxsize=5000, ttl=3600)
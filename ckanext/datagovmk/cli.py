@@ -27,9 +27,80 @@ def get_commands():
             commands.fetch_most_active_orgs()
 
     @datagovmk.command()
-    def check_outdated_datasets():
+    @click.option(u'--dry-run', is_flag=True,
+                  help=u'Only log the notification emails, do not send them')
+    def check_outdated_datasets(dry_run):
         app = Flask(__name__)
         with app.test_request_context():
-            commands._processl_all_datasets()
+            result = commands.check_outdated_datasets(dry_run=dry_run)
+        click.secho(u'Outdated datasets: {pending} pending, {sent_datasets} '
+                    u'notified, {suppressed} suppressed'.format(**result),
+                    fg=u"green")
+        click.secho(u'Emails: {sent} of {recipients} recipients sent, '
+                    u'{failed} failed'.format(**result), fg=u"green")
+
+    @datagovmk.command()
+    def flush_downloads():
+        from ckanext.datagovmk.downloads import flush_downloads
+        counts = flush_downloads()
+        click.secho(u'Flushed {0} downloads of {1} resources'.format(
+            sum(counts.values()), len(counts)), fg=u"green")
+
+    @datagovmk.command()
+    @click.option(u'-f', u'--force', is_flag=True,
+                  help=u'Ignore exceptions when indexing the datasets')
+    @click.option(u'-w', u'--workers', default=1, type=int,
+                  help=u'Number of worker processes')
+    @click.option(u'-c', u'--chunk-size', default=100, type=int,
+                  help=u'Number of datasets handed to a worker at once')
+    def reindex(force, workers, chunk_size):
+        def _progress(done, total, elapsed):
+            click.echo(u'{0}/{1} datasets, {2:.1f} datasets/s'.format(
+                done, total, done / elapsed if elapsed else 0))
+
+        indexed, failed, memo_stats = commands.reindex_datasets(
+            force=force, workers=workers, chunk_size=chunk_size,
+            progress=_progress)
+        click.echo(u'Spatial lookups: {0} memoized, {1} resolved in {2:.1f}s, '
+                   u'saved about {3:.1f}s'.format(
+                       memo_stats.get('hits', 0), memo_stats.get('misses', 0),
+                       memo_stats.get('resolve_seconds', 0),
+                       memo_stats.get('saved_seconds', 0)))
+        if failed:
+            click.secho(u'Failed to index: {0}'.format(u', '.join(failed)),
+                        fg=u"red")
+        click.secho(u'Search index rebuilt, {0} datasets indexed'.format(
+            indexed), fg=u"green")
+
+    @datagovmk.command()
+    def sort_organizations():
+        count = commands.create_sort_organizations()
+        click.secho(u'Sort table filled with {0} organizations'.format(count),
+                    fg=u"green")
+
+    @datagovmk.command()
+    def sort_groups():
+        count = commands.create_sort_groups()
+        click.secho(u'Sort table filled with {0} groups'.format(count),
+                    fg=u"green")
+
+    @datagovmk.command()
+    def update_package_counts():
+        commands.update_package_counts()
+        click.secho(u'Updated the number of datasets of organizations and '
+                    u'groups', fg=u"green")
+
+    @datagovmk.command()
+    @click.argument(u'path', required=False)
+    def seed_osm_geometries(path):
+        count = commands.seed_osm_geometries(path)
+        click.secho(u'Seeded {0} OSM geometries'.format(count), fg=u"green")
+
+    @datagovmk.command()
+    @click.argument(u'path')
+    def export_osm_geometries(path):
+        count = commands.export_osm_geometries(path)
+        click.secho(u'Exported {0} OSM geometries to {1}'.format(count, path),
+                    fg=u"green")
 
     return [datagovmk]
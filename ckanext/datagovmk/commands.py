@@ -22,14 +22,13 @@ import io
 import inspect
 import json
 
+from functools import partial
 from logging import getLogger
 from datetime import timedelta, datetime
-from dateutil import parser
 
 from ckan.cli.cli import CkanCommand
 from ckan.plugins import toolkit
 import ckan.lib.helpers as h
-import ckan.lib.mailer as ckan_mailer
 from ckan.plugins.toolkit import config
 
 from ckanext.datagovmk.model.user_authority \
@@ -42,66 +41,40 @@ from ckanext.datagovmk.model.sort_organizations \
     import setup as setup_sort_organizations_table
 from ckanext.datagovmk.model.sort_groups \
     import setup as setup_sort_groups_table
+from ckanext.datagovmk.model.osm_geometry \
+    import setup as setup_osm_geometry_table
+from ckanext.datagovmk.model.outdated_notification \
+    import setup as setup_outdated_notification_table
 from ckanext.datagovmk.model.most_active_organizations \
     import MostActiveOrganizations
-from ckanext.datagovmk.model.sort_organizations import \
-    SortOrganizations as SortOrganizationsModel
-from ckanext.datagovmk.model.sort_groups import SortGroups as SortGroupsModel
+from ckanext.datagovmk.model.sort_organizations import sort_organizations_table
+from ckanext.datagovmk.model.sort_groups import sort_groups_table
+from ckanext.datagovmk.utils import (PERIODICITY, IGNORE_PERIODICITY,
+                                     get_last_modified, get_update_schedule)
 from ckan.model.meta import Session
-from ckan.views.admin import _get_sysadmins
-from ckan.logic.action.get import organization_list as ckan_organization_list
-from ckan.logic.action.get import group_list as _group_list
 
 
 log = getLogger('ckanext.datagovmk')
 ValidationError = toolkit.ValidationError
 
-BULK_SIZE = 5
 
-
-PERIODICITY = {
-    'ANNUAL': timedelta(days=365),
-    'ANNUAL_2': timedelta(days=365/2),
-    'ANNUAL_3': timedelta(days=365/3),
-    'BIENNIAL': timedelta(days=2*365),
-    'BIMONTHLY': timedelta(days=2*30),
-    'BIWEEKLY': timedelta(weeks=2),
-    'CONT': timedelta(minutes=1),
-    'DAILY': timedelta(days=1),
-    'DAILY_2': timedelta(days=2),
-    'MONTHLY': timedelta(days=4*30),
-    'MONTHLY_2': timedelta(days=15),
-    'MONTHLY_3': timedelta(days=10),
-    'QUARTERLY': timedelta(days=3*30),
-    'TRIENNIAL': timedelta(days=3*365),
-    'UPDATE_CONT': timedelta(minutes=1),
-    'WEEKLY': timedelta(weeks=1),
-    'WEEKLY_2': timedelta(weeks=0.5),
-    'WEEKLY_3': timedelta(weeks=3),
-}
-
-IGNORE_PERIODICITY = {'IRREG', 'OTHER', 'UNKNOWN', 'NEVER'}
-
-
-def _check_dataset_if_outdated(dataset):
+def _check_dataset_if_outdated(dataset, notify):
 
     frequency = dataset.get('frequency')
     if not frequency:
         return  # ignore, not scheduled for periodic updates
-    print("Frequency is: " + frequency)
+    log.debug('Dataset %s has frequency %s', dataset['id'], frequency)
 
     frequency = frequency.split('/')[-1]
     if frequency in IGNORE_PERIODICITY:
-        print("Does it return here?! Frequency in ignore_periodicity")
         return  # not scheduled by choice
     periodicity = PERIODICITY.get(frequency.upper())
     if not periodicity:
-        print("Not periodicity return!")
         log.warning('Dataset %s has periodicity %s which we do not handle', dataset['id'], frequency)
         return  # we don't know how to handle this periodicity
-    last_modified = _get_last_modified(dataset)
+    last_modified = get_last_modified(dataset)
     if not last_modified:
-        print("not last modified, return!")
+        log.debug('Dataset %s has no modified resources', dataset['id'])
         return  # ignore this one
 
     now = datetime.now()
@@ -109,103 +82,195 @@ def _check_dataset_if_outdated(dataset):
     diff = now - last_modified
     if diff >= periodicity:
         log.debug('Dataset %s needs to be updated.', dataset['id'])
-        notify_dataset_outdated(dataset, last_modified)
-        log.info('Notifications for dataset update has beed sent. Dataset: %s', dataset['id'])
+        notify(dataset, last_modified)
 
 
-def _get_last_modified(dataset):
-    resources = dataset.get('resources')
-    if resources:
-        last_modified = []
-        for resource in resources:
-            lm = resource.get('last_modified') or resource.get('created')
-            if lm:
-                last_modified.append(parser.parse(lm))
+def check_outdated_datasets(dry_run=False):
+    """Sends the notifications for the datasets which are due for an update,
+    found with a range query on their indexed ``next_update_due`` date.
 
-        return max(last_modified)
-    return None
+    Every recipient gets a single email listing all of their outdated
+    datasets. Datasets already notified for the same due date within the
+    last ``ckanext.datagovmk.notifications.backoff_days`` days are skipped.
 
-def _get_dataset_users(dataset):
-    users = []
+    :param dry_run: only log the emails, don't send them or record them.
+    :type dry_run: bool
+
+    :returns: the number of outdated (``pending``), notified (``sent``) and
+        skipped (``suppressed``) datasets, and the number of recipients,
+        sent and failed emails.
+    :rtype: dict
+    """
+    from ckanext.datagovmk.notifications import (NotificationDigest,
+                                                 UserCache, send_digests)
+    from ckanext.datagovmk.model.outdated_notification import OutdatedNotification
+
+    digest = NotificationDigest()
+    users = UserCache()
+    ledger = OutdatedNotification.get_all()
+    backoff_since = datetime.utcnow() - get_notifications_backoff()
+    due_dates = {}
+    counts = {'pending': 0, 'suppressed': 0}
+
+    def _collect(dataset, last_modified):
+        counts['pending'] += 1
+        due_date = get_update_schedule(dataset)[1]
+        notification = ledger.get(dataset['id'])
+        if notification and notification.is_suppressed(due_date, backoff_since):
+            counts['suppressed'] += 1
+            return
+        due_dates[dataset['id']] = due_date
+        dataset_url, dataset_update_url, dataset_title = _dataset_links(dataset)
+        for user in _get_dataset_users(dataset, users):
+            digest.add(user, dataset_url, dataset_update_url, dataset_title,
+                       dataset_id=dataset['id'])
+
+    _processl_all_datasets(partial(_check_dataset_if_outdated, notify=_collect),
+                           fq=['+next_update_due:[* TO NOW]'])
+    result = send_digests(digest, dry_run=dry_run)
+
+    notified = result.pop('notified_datasets')
+    if not dry_run:
+        OutdatedNotification.record(dict((dataset_id, due_dates[dataset_id])
+                                         for dataset_id in notified))
+    result.update(counts, sent_datasets=len(notified))
+    log.info('Outdated datasets: %(pending)d pending, %(sent_datasets)d '
+             'notified, %(suppressed)d suppressed', result)
+    return result
+
+
+def get_notifications_backoff():
+    return timedelta(days=float(
+        config.get('ckanext.datagovmk.notifications.backoff_days', 7)))
+
+
+def _get_dataset_users(dataset, user_cache=None):
+    dataset_users = []
     if dataset.get('maintainer_email'):
         maintainer = {'email': dataset['maintainer_email']}
         maintainer['username'] = dataset.get('maintainer') or dataset['maintainer_email'].split('@')[0]
 
-        users.append(maintainer)
+        dataset_users.append(maintainer)
 
     if dataset.get('creator_user_id'):
         try:
-            creator = toolkit.get_action('user_show')({'ignore_auth' :True}, {'id': dataset['creator_user_id']})
-            users.append({
-                'email': creator['email'],
-                'username': creator.get('fullname') or creator.get('name')
-            })
+            if user_cache is not None:
+                creator = user_cache.get(dataset['creator_user_id'])
+            else:
+                creator = toolkit.get_action('user_show')({'ignore_auth' :True}, {'id': dataset['creator_user_id']})
+            if creator:
+                dataset_users.append({
+                    'email': creator['email'],
+                    'username': creator.get('fullname') or creator.get('name')
+                })
 
         except toolkit.NotFound:
             pass
 
-    return users
+    return dataset_users
 
-def notify_dataset_outdated(dataset, last_modified):
-    """ This function will notify if a dataset is outdated
-    :param dataset: the dataset that needs to be checked if it is outdated
-    :type dataset: dict
-    :param last_modified: date of the last time the dataset was modified
-    :type last_modified: str
-    """
+
+def _dataset_links(dataset):
     dataset_url = h.url_for('dataset.read', id=dataset['name'], qualified=True)
     dataset_update_url = h.url_for('dataset.edit', id=dataset['name'], qualified=True)
     dataset_title = dataset.get('title') or dataset.get('name')
+    return dataset_url, dataset_update_url, dataset_title
 
-    dataset_users = _get_dataset_users(dataset)
 
-    for user in dataset_users:
+def _processl_all_datasets(process_dataset, fq=None):
+    from ckanext.datagovmk.solr.datasets import iter_datasets
+
+    for dataset in iter_datasets(fq=fq, include_private=True):
         try:
-            _send_notification(dataset_url, dataset_update_url, dataset_title, user)
+            process_dataset(dataset)
         except Exception as e:
-            log.error('Failed to send email notification for dataset %s: %s', dataset['id'], e)
+            log.debug('An error has occured while processing dataset. Error: %s', e)
 
-def _send_notification(dataset_url, dataset_update_url, dataset_title, user):
-    subject = u'CKAN: Потсетување за ажурирање на податочниот сет „{title}“ | '\
-                u'Kujtesë për përditësimin e të dhënave "{title}" | '\
-                u'Reminder to update dataset "{title}"'.format(title=dataset_title)
-    try:
-        body =_load_resource_from_path('ckanext.datagovmk:templates/datagovmk/outdated_dataset_email.html').format(**{
-            'username': user['username'],
-            'dataset_url': dataset_url,
-            'dataset_title': dataset_title,
-            'dataset_update_url': dataset_update_url,
-            'site_title': config.get('ckan.site_title', 'CKAN')
-        })
 
-        ckan_mailer.mail_recipient(user['email'], user['email'], subject,
-                                    body, headers={
-                                        'Content-Type': 'text/html; charset=UTF-8',
-                                    })
-    except ckan_mailer.MailerException as e:
-        log.error('Failed to send notification message for updating the obsolete dataset %s: %s', dataset_title, e)
-
-def _processl_all_datasets(process_dataset=_check_dataset_if_outdated):
-        context = {'ignore_auth': True}
-        page = 0
-
-        while True:
-            query = {
-                'include_private': True,
-                'rows': BULK_SIZE,
-                'start': page*BULK_SIZE
-            }
-            datasets = toolkit.get_action('package_search')(context, query)
-
-            for result in datasets['results']:
-                dataset = toolkit.get_action('package_show')(context, {'id': result['id']})
-                try:
-                    process_dataset(dataset)
-                except Exception as e:
-                    log.debug('An error has occured while processing dataset. Error: %s', e)
-            page += 1
-            if page*BULK_SIZE >= datasets['count']:
-                break
+def reindex_datasets(force=False, workers=1, chunk_size=100, progress=None):
+    """Rebuilds the search index of all datasets, without clearing it first.
+
+    The download totals needed by ``before_index`` are loaded for all
+    datasets upfront with a single query, the datasets are indexed in chunks
+    by ``workers`` processes and Solr is committed once at the end.
+
+    :param force: continue indexing when a dataset fails to index.
+    :type force: bool
+    :param workers: number of worker processes.
+    :type workers: int
+    :param chunk_size: number of datasets handed to a worker at once.
+    :type chunk_size: int
+    :param progress: progress callback, see
+        :py:func:`ckanext.datagovmk.solr.reindex.rebuild`.
+    :type progress: function
+
+    :returns: the number of indexed datasets, the ids of the datasets that
+        failed to index and the statistics of the memoized spatial lookups.
+    :rtype: tuple
+    """
+    from ckanext.datagovmk.model.stats import preloaded_package_downloads
+    from ckanext.datagovmk.solr import reindex
+
+    # Loaded before the workers are forked, so they all share it
+    with preloaded_package_downloads():
+        return reindex.rebuild(workers=workers, chunk_size=chunk_size,
+                               force=force, progress=progress)
+
+
+def update_package_counts():
+    """Recomputes the number of datasets of all organizations and groups
+    kept in the sort tables.
+    """
+    from ckanext.datagovmk.logic import update_sort_package_counts
+
+    update_sort_package_counts()
+    Session.commit()
+    log.info('Updated the number of datasets of organizations and groups')
+
+
+def seed_osm_geometries(path=None):
+    """Stores the geometries from the OSM gazetteer in the geometry cache.
+
+    :param path: path to a gazetteer JSON file, mapping OSM relation ids to
+        GeoJSON geometries. Defaults to the configured gazetteer.
+    :type path: str
+
+    :returns: the number of stored geometries.
+    :rtype: int
+    """
+    from ckanext.datagovmk.model.osm_geometry import OsmGeometry
+    from ckanext.datagovmk.utils import get_osm_gazetteer
+
+    if path:
+        with io.open(path, mode='r', encoding='utf-8') as gazetteer_file:
+            gazetteer = json.load(gazetteer_file)
+    else:
+        gazetteer = get_osm_gazetteer()
+
+    for relation_id, geometry in gazetteer.items():
+        OsmGeometry.store(relation_id, json.dumps(geometry))
+    log.info('Seeded %d OSM geometries', len(gazetteer))
+    return len(gazetteer)
+
+
+def export_osm_geometries(path):
+    """Writes the cached OSM geometries to a gazetteer JSON file, which can
+    be bundled or used with ``ckanext.datagovmk.osm_gazetteer``.
+
+    :param path: path of the gazetteer JSON file.
+    :type path: str
+
+    :returns: the number of exported geometries.
+    :rtype: int
+    """
+    from ckanext.datagovmk.model.osm_geometry import OsmGeometry
+
+    gazetteer = dict((geometry.relation_id, json.loads(geometry.geometry))
+                     for geometry in OsmGeometry.get_all()
+                     if geometry.geometry)
+    with io.open(path, mode='w', encoding='utf-8') as gazetteer_file:
+        gazetteer_file.write(json.dumps(gazetteer, indent=2, sort_keys=True))
+    return len(gazetteer)
 
 
 def _load_resource_from_path(url):
@@ -230,6 +295,8 @@ def tables_init():
     setup_most_active_organizations_table()
     setup_sort_organizations_table()
     setup_sort_groups_table()
+    setup_osm_geometry_table()
+    setup_outdated_notification_table()
 
     log.info('datagovmk DB tables initialized')
 
@@ -267,38 +334,14 @@ class SortOrganizations(CkanCommand):
             create_sort_organizations()
 
 def create_sort_organizations():
-    
-    sysadmin = _get_sysadmins()[0].name
-    context = {
-            'user': sysadmin,
-            'ignore_auth': True
-    }
-    orgs = ckan_organization_list(context, {})
-    sort_org = []
-
-    for org_name in orgs:
-        org = toolkit.get_action('organization_show')({'user': None}, {
-            'id': org_name,
-            'include_datasets': True,
-            'include_dataset_count': False,
-            'include_extras': True,
-            'include_users': False,
-            'include_groups': False,
-            'include_tags': False,
-            'include_followers': False
-        })
-        if org.get('state') == 'active':
-            sort_org = {
-                'org_id': org.get('id', ''),
-                'title_mk': org.get('title_translated', {}).get('mk', ''),
-                'title_en': org.get('title_translated', {}).get('en', ''),
-                'title_sq': org.get('title_translated', {}).get('sq', '')
-            }
-        
-            so = SortOrganizationsModel(**sort_org)
-            so.save()
-
-    return
+    """Fills the sort table of the organizations. Can be run again, the
+    table is replaced in a single transaction.
+
+    :returns: the number of organizations.
+    :rtype: int
+    """
+    return _backfill_sort_table(sort_organizations_table, 'org_id',
+                                is_organization=True)
 
 class SortGroups(CkanCommand):
     ''' Sorts groups. '''
@@ -313,37 +356,59 @@ class SortGroups(CkanCommand):
             create_sort_groups()
 
 def create_sort_groups():
-    
-    sysadmin = _get_sysadmins()[0].name
-    context = {
-            'user': sysadmin,
-            'ignore_auth': True
-    }
-    groups = _group_list(context, {})
-
-    for group_name in groups:
-        gr = toolkit.get_action('group_show')({'user': None}, {
-            'id': group_name,
-            'include_datasets': True,
-            'include_dataset_count': False,
-            'include_extras': True,
-            'include_users': False,
-            'include_groups': False,
-            'include_tags': False,
-            'include_followers': False
+    """Fills the sort table of the groups. Can be run again, the table is
+    replaced in a single transaction.
+
+    :returns: the number of groups.
+    :rtype: int
+    """
+    return _backfill_sort_table(sort_groups_table, 'group_id',
+                                is_organization=False)
+
+
+def _backfill_sort_table(table, id_column, is_organization):
+    from sqlalchemy import and_
+    from ckan import model
+    from ckan.model.types import make_uuid
+    from ckanext.datagovmk.logic import update_sort_package_counts
+
+    query = Session.query(model.Group.id, model.GroupExtra.value).\
+        outerjoin(model.GroupExtra,
+                  and_(model.GroupExtra.group_id == model.Group.id,
+                       model.GroupExtra.key == 'title_translated',
+                       model.GroupExtra.state == 'active')).\
+        filter(model.Group.is_organization == is_organization).\
+        filter(model.Group.state == 'active')
+
+    rows = []
+    for group_id, title_translated in query:
+        try:
+            titles = json.loads(title_translated) if title_translated else {}
+        except ValueError:
+            titles = {}
+        if not isinstance(titles, dict):
+            titles = {}
+        rows.append({
+            'id': make_uuid(),
+            id_column: group_id,
+            'title_mk': titles.get('mk', ''),
+            'title_en': titles.get('en', ''),
+            'title_sq': titles.get('sq', ''),
         })
-        if gr.get('state') == 'active':
-            sort_gr = {
-                'group_id': gr.get('id', ''),
-                'title_mk': gr.get('title_translated', {}).get('mk', ''),
-                'title_en': gr.get('title_translated', {}).get('en', ''),
-                'title_sq': gr.get('title_translated', {}).get('sq', '')
-            }
-        
-            sg = SortGroupsModel(**sort_gr)
-            sg.save()
-
-    return
+
+    try:
+        Session.execute(table.delete())
+        if rows:
+            Session.execute(table.insert(), rows)
+        update_sort_package_counts()
+        Session.commit()
+    except Exception:
+        Session.rollback()
+        raise
+
+    log.info('Filled %s with %d rows', table.name, len(rows))
+    return len(rows)
+
 
 class FetchMostActiveOrganizations(CkanCommand):
     ''' Fetches most active organizations. '''
@@ -359,74 +424,6 @@ class FetchMostActiveOrganizations(CkanCommand):
 
 
 def fetch_most_active_orgs():
-    orgs = toolkit.get_action('organization_list')({}, {})
-    last_updated_orgs = []
-
-    for org_name in orgs:
-        org = toolkit.get_action('organization_show')({'user': None}, {
-            'id': org_name['id'],
-            'include_datasets': True,
-            'include_dataset_count': False,
-            'include_extras': True,
-            'include_users': False,
-            'include_groups': False,
-            'include_tags': False,
-            'include_followers': False,
-        })
-
-        last_updated_datasets = []
-
-        for dataset in org.get('packages'):
-            dataset_full = toolkit.get_action('package_show')({}, {
-                'id': dataset.get('id'),
-            })
-            last_modified_resource = ''
-
-            for resource in dataset_full.get('resources'):
-                field = 'last_modified'
-                if resource.get('last_modified') is None:
-                    field = 'created'
-
-                if resource.get(field) > last_modified_resource:
-                    last_modified_resource = resource.get(field)
-
-            last_updated_datasets.append(last_modified_resource)
-        last_updated_datasets = sorted(last_updated_datasets, reverse=True)
-
-        if last_updated_datasets:
-            last_modified_dataset = last_updated_datasets[0]
-            last_updated_orgs.append({
-                'org': org, 'last_modified': last_modified_dataset
-            })
-
-    sorted_orgs = sorted(
-        last_updated_orgs,
-        key=lambda k: k['last_modified'],
-        reverse=True
-    )
-
-    orgs = map(lambda x: x.get('org'), sorted_orgs)
-
-    Session.query(MostActiveOrganizations).delete()
-
-    s = Session()
-    objects = []
-
-    for org in orgs:
-        data = {
-            'org_id': org.get('id'),
-            'org_name': org.get('name'),
-            'org_display_name': json.dumps(org.get('title_translated', None)),
-        }
-        objects.append(MostActiveOrganizations(**data))
-
-    try:
-        s.bulk_save_objects(objects)
-        s.commit()
-    except:
-        s.rollback()
-        raise
-    finally:
-        s.close()
+    MostActiveOrganizations.refresh()
 
     log.info('Successfully cached most active organizations.')
@@ -0,0 +1,162 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Counting of resource downloads.
+
+When ``ckanext.datagovmk.downloads.buffered`` is enabled, the downloads are
+counted in Redis and written to the ``resource_stats`` table in batches, at
+most once every ``ckanext.datagovmk.downloads.flush_interval`` seconds (and
+whenever ``ckan datagovmk flush_downloads`` runs). Each flush is a single
+upsert statement followed by a single search index update of the affected
+datasets.
+"""
+
+import uuid
+from collections import Counter
+from logging import getLogger
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+from ckanext.datagovmk.model.stats import upsert_downloads
+from ckanext.datagovmk.solr.stats import queue_packages_stats_update
+
+
+log = getLogger(__name__)
+
+PENDING_KEY = 'ckanext-datagovmk:downloads:pending'
+FLUSH_LOCK_KEY = 'ckanext-datagovmk:downloads:flush-lock'
+
+
+def _redis():
+    from ckan.lib.redis import connect_to_redis
+    return connect_to_redis()
+
+
+def is_buffered():
+    return toolkit.asbool(
+        config.get('ckanext.datagovmk.downloads.buffered', False))
+
+
+def record_downloads(resource_ids, reindex=True):
+    """Counts one download for each of the given resources.
+
+    :param resource_ids: the ids of the downloaded resources.
+    :type resource_ids: list
+    :param reindex: update the download stats in the search index of the
+        datasets right away. Only used when the downloads are not buffered,
+        a flush of the buffer always updates the search index.
+    :type reindex: bool
+
+    """
+    counts = Counter(resource_ids)
+
+    if is_buffered():
+        try:
+            pipe = _redis().pipeline()
+            for resource_id, count in counts.items():
+                pipe.hincrby(PENDING_KEY, resource_id, count)
+            pipe.execute()
+        except Exception as e:
+            log.warning('Failed to buffer downloads, writing them directly: %s', e)
+        else:
+            _maybe_flush()
+            return
+
+    upsert_downloads(counts)
+    model.Session.commit()
+
+    if reindex:
+        _update_packages_stats(list(counts))
+
+
+def _maybe_flush():
+    interval = int(config.get('ckanext.datagovmk.downloads.flush_interval', 60))
+    try:
+        # Only the first caller after the interval gets the lock
+        if not _redis().set(FLUSH_LOCK_KEY, '1', nx=True, ex=interval):
+            return
+    except Exception as e:
+        log.warning('Failed to check the downloads flush lock: %s', e)
+        return
+
+    try:
+        flush_downloads()
+    except Exception as e:
+        log.error('Failed to flush the downloads: %s', e)
+
+
+def flush_downloads():
+    """Writes the buffered downloads to the database in one batch and updates
+    the search index of the affected datasets in a single batch.
+
+    :returns: the number of downloads written, per resource id.
+    :rtype: dict
+
+    """
+    redis = _redis()
+    flushing_key = '{0}:{1}'.format(PENDING_KEY, uuid.uuid4().hex)
+
+    # Take the pending counts atomically, the downloads counted from now on
+    # go to a new hash.
+    if not redis.exists(PENDING_KEY):
+        return {}
+    try:
+        redis.rename(PENDING_KEY, flushing_key)
+    except Exception:
+        # Flushed by someone else in the meantime
+        return {}
+
+    counts = {}
+    for resource_id, count in redis.hgetall(flushing_key).items():
+        if isinstance(resource_id, bytes):
+            resource_id = resource_id.decode('utf-8')
+        counts[resource_id] = int(count)
+
+    try:
+        upsert_downloads(counts)
+        model.Session.commit()
+    except Exception:
+        model.Session.rollback()
+        # Put the counts back so they are not lost
+        pipe = redis.pipeline()
+        for resource_id, count in counts.items():
+            pipe.hincrby(PENDING_KEY, resource_id, count)
+        pipe.delete(flushing_key)
+        pipe.execute()
+        raise
+
+    redis.delete(flushing_key)
+    log.info('Flushed %d downloads of %d resources.',
+             sum(counts.values()), len(counts))
+
+    _update_packages_stats(list(counts))
+    return counts
+
+
+def _update_packages_stats(resource_ids):
+    if not resource_ids:
+        return
+    package_ids = [package_id for (package_id,) in
+                   model.Session.query(model.Resource.package_id)
+                   .filter(model.Resource.id.in_(resource_ids))
+                   .distinct()]
+    try:
+        queue_packages_stats_update(package_ids)
+    except Exception as e:
+        log.error('Failed to update stats for datasets %s: %s', package_ids, e)
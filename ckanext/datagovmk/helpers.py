@@ -19,20 +19,25 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import os
 import json
+import time
+import threading
+from collections import namedtuple
 import ckan.authz as authz
 
 from ckan.plugins import toolkit
 from ckan.lib import search, i18n
 from datetime import datetime
 from ckan.common import config
-from ckanext.datagovmk.model.stats import (get_stats_for_package,
-                                           get_stats_for_resource,
-                                           get_total_package_downloads)
+from ckanext.datagovmk.model.stats import (get_stats_for_packages,
+                                           get_stats_for_resources,
+                                           get_total_downloads_for_packages)
 
 from logging import getLogger
 from ckanext.datagovmk.model.user_authority import UserAuthority
 from ckan.lib import helpers as core_helpers
 from ckanext.datagovmk.model.most_active_organizations import MostActiveOrganizations
+from ckanext.datagovmk.model.most_active_organizations import get_version as get_most_active_organizations_version
+from ckanext.datagovmk.cache import related_datasets_cache, organization_titles_cache
 
 
 log = getLogger(__name__)
@@ -70,12 +75,25 @@ def get_recently_updated_datasets(limit=5):
             pkgs.append(package)
         return pkgs
 
+MostActiveOrganization = namedtuple(
+    'MostActiveOrganization',
+    ['org_id', 'org_name', 'org_display_name', 'display_name'])
+
+_most_active_orgs = {'version': None, 'loaded': 0, 'rows': None, 'by_lang': {}}
+_most_active_orgs_lock = threading.Lock()
+
+
 def get_most_active_organizations(limit=5):
     '''
     Returns most active organizations based on when new resource has been
     added to a dataset, or when an existing resource has been updated (new
     file has been added).
 
+    The organizations are cached in the process, with the display name for
+    the current language already decoded. The cache is reloaded when the
+    refresh job bumps the version stamp in Redis, or after
+    ``ckanext.datagovmk.most_active_orgs.cache_ttl`` seconds.
+
     :param limit: Number of organizations to be returned. Default is 5.
     :type limit: integer
 
@@ -83,13 +101,35 @@ def get_most_active_organizations(limit=5):
     :rtype: list
 
     '''
-    orgs = MostActiveOrganizations.get_all(limit=limit)
+    version = get_most_active_organizations_version()
+    ttl = int(config.get('ckanext.datagovmk.most_active_orgs.cache_ttl', 300))
+
+    with _most_active_orgs_lock:
+        cache = _most_active_orgs
+        if cache['rows'] is None or cache['version'] != version or \
+                cache['loaded'] + ttl < time.time():
+            cache['rows'] = [(org.org_id, org.org_name, org.org_display_name)
+                             for org in MostActiveOrganizations.get_all(limit=None)]
+            cache['version'] = version
+            cache['loaded'] = time.time()
+            cache['by_lang'] = {}
 
-    return orgs
+        lang = i18n.get_lang()
+        orgs = cache['by_lang'].get(lang)
+        if orgs is None:
+            orgs = cache['by_lang'][lang] = [
+                MostActiveOrganization(org_id, org_name, org_display_name,
+                                       get_translated(org_display_name))
+                for org_id, org_name, org_display_name in cache['rows']]
+
+    return orgs[:limit]
 
 
 def get_related_datasets(id, limit=3):
-    """ Return related datasets for a specific dataset
+    """ Return related datasets for a specific dataset. The result is cached
+    per dataset, limit and language, and the cache is invalidated whenever a
+    dataset or a group changes (see
+    :py:func:`ckanext.datagovmk.cache.related_datasets_cache`).
 
     :param id: Package (dataset) id
     :type id: string
@@ -102,9 +142,15 @@ def get_related_datasets(id, limit=3):
 
     """
 
-    related_datasets = toolkit.get_action('datagovmk_get_related_datasets')(
-        data_dict={'id': id, 'limit': limit}
-    )
+    cache = related_datasets_cache()
+    key = '{0}:{1}:{2}'.format(id, limit, core_helpers.lang())
+
+    related_datasets = cache.get(key)
+    if related_datasets is None:
+        related_datasets = toolkit.get_action('datagovmk_get_related_datasets')(
+            data_dict={'id': id, 'limit': limit}
+        )
+        cache.set(key, related_datasets)
 
     return related_datasets
 
@@ -118,8 +164,7 @@ def get_groups():
     '''
     data_dict = {
         'sort': 'package_count',
-        'all_fields': True,
-        'include_extras': True
+        'summary': True
     }
     groups = _get_action('group_list', {}, data_dict)
     # groups = [group for group in groups if group.get('package_count') > 0]
@@ -127,6 +172,31 @@ def get_groups():
     return groups
 
 
+def _request_memo(name):
+    """Returns a dict that lives for the duration of the current request, to
+    memoize the values the templates ask for repeatedly. Outside of a request
+    a new (throwaway) dict is returned.
+    """
+    try:
+        memo = getattr(toolkit.g, '_datagovmk_memo', None)
+        if memo is None:
+            memo = {}
+            toolkit.g._datagovmk_memo = memo
+    except (RuntimeError, TypeError, AttributeError):
+        return {}
+    return memo.setdefault(name, {})
+
+
+def _memoized_bulk(name, fetch, ids, default):
+    memo = _request_memo(name)
+    missing = [_id for _id in ids if _id not in memo]
+    if missing:
+        fetched = fetch(missing)
+        for _id in missing:
+            memo[_id] = fetched.get(_id, default)
+    return dict((_id, memo[_id]) for _id in ids)
+
+
 def get_dataset_stats(dataset_id):
     """Returns stats for the specified dataset.
 
@@ -143,8 +213,8 @@ def get_dataset_stats(dataset_id):
 
     """
 
-    stats = get_stats_for_package(dataset_id)
-    return stats
+    return _memoized_bulk('package_stats', get_stats_for_packages,
+                          [dataset_id], {})[dataset_id]
 
 
 def get_resource_stats(resource_id):
@@ -163,8 +233,8 @@ def get_resource_stats(resource_id):
     :rtype: dictionary
 
     """
-    stats = get_stats_for_resource(resource_id)
-    return stats
+    return _memoized_bulk('resource_stats', get_stats_for_resources,
+                          [resource_id], {})[resource_id]
 
 
 def get_package_total_downloads(package_id):
@@ -178,7 +248,8 @@ def get_package_total_downloads(package_id):
     :rtype: integer
 
     """
-    return get_total_package_downloads(package_id)
+    return _memoized_bulk('package_downloads', get_total_downloads_for_packages,
+                          [package_id], 0)[package_id]
 
 
 def get_storage_path_for(dirname):
@@ -254,15 +325,75 @@ def translate_field(data_dict, field_name):
 
 def get_org_title(id):
     """ Gets the translated title of the organization
-    :param id: the id of the organization
+    :param id: the id or name of the organization
     :type id: str
     returns: the translated title of the organization
     :rtype: str
     """
 
-    org = toolkit.get_action('organization_show')(data_dict={'id': id})
+    return get_org_titles([id]).get(id, id)
+
 
-    return translate_field(org, 'title')
+def get_org_titles(items):
+    """ Gets the translated titles of many organizations at once. The titles
+    are cached, organizations missing from the cache are loaded with a single
+    query.
+
+    :param items: ids or names of the organizations, or facet items (dicts
+        with the organization name under ``name``)
+    :type items: list
+    :returns: the translated title per id or name, organizations that do not
+        exist are left out
+    :rtype: dict
+    """
+    keys = [item.get('name') if isinstance(item, dict) else item
+            for item in items or []]
+    keys = [key for key in keys if key]
+
+    cache = organization_titles_cache()
+    titles = {}
+    missing = []
+    for key in keys:
+        entry = cache.get(key)
+        if entry is None:
+            missing.append(key)
+        else:
+            titles[key] = entry
+
+    if missing:
+        for key, entry in _load_org_titles(missing).items():
+            cache.set(key, entry)
+            titles[key] = entry
+
+    lang = i18n.get_lang()
+    return dict((key, entry['title_translated'].get(lang) or entry['title'])
+                for key, entry in titles.items())
+
+
+def _load_org_titles(keys):
+    from ckan import model
+    from sqlalchemy import and_, or_
+
+    query = model.Session.query(model.Group.id, model.Group.name,
+                                model.Group.title, model.GroupExtra.value).\
+        outerjoin(model.GroupExtra,
+                  and_(model.GroupExtra.group_id == model.Group.id,
+                       model.GroupExtra.key == 'title_translated',
+                       model.GroupExtra.state == 'active')).\
+        filter(model.Group.is_organization == True).\
+        filter(or_(model.Group.name.in_(keys), model.Group.id.in_(keys)))
+
+    entries = {}
+    for org_id, org_name, title, title_translated in query:
+        try:
+            title_translated = json.loads(title_translated) if title_translated else {}
+        except ValueError:
+            title_translated = {}
+        if not isinstance(title_translated, dict):
+            title_translated = {}
+        entry = {'title': title or org_name, 'title_translated': title_translated}
+        entries[org_id] = entries[org_name] = entry
+    return entries
 
 
 def get_org_description(id):
@@ -354,8 +485,8 @@ def get_site_statistics(user):
     }
 
     stats['dataset_count'] = toolkit.get_action('package_search')({}, data_dict)['count']
-    stats['group_count'] = len(toolkit.get_action('group_list')({}, {}))
-    stats['organization_count'] = len(toolkit.get_action('organization_list')({}, {}))
+    stats['group_count'] = len(toolkit.get_action('group_list')({}, {'summary': True}))
+    stats['organization_count'] = len(toolkit.get_action('organization_list')({}, {'summary': True}))
 
     return stats
     
@@ -15,7 +15,13 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from sqlalchemy import or_
+
+from ckan import model
+
 import ckanext.datagovmk.utils as utils
+from ckanext.datagovmk.model.sort_organizations import SortOrganizations
+from ckanext.datagovmk.model.sort_groups import SortGroups
 
 
 def import_spatial_data(package_dict):
@@ -42,4 +48,49 @@ def import_spatial_data(package_dict):
         if not has_spatial:
             if not package_dict.get('extras'):
                 package_dict['extras'] = []
-            package_dict['extras'].append(spatial_extra)
\ No newline at end of file
+            package_dict['extras'].append(spatial_extra)
+
+
+def update_sort_package_counts(package_ids=None, group_ids=None):
+    """Updates the number of datasets kept in the sort tables of the
+    organizations and groups. Without arguments all of them are recomputed.
+    The caller commits.
+
+    :param list package_ids: ids or names of datasets, the organizations and
+        groups they belong, or used to belong, to are updated.
+    :param list group_ids: ids or names of the organizations and groups to
+        update.
+
+    """
+    if package_ids is None and group_ids is None:
+        SortOrganizations.update_package_counts()
+        SortGroups.update_package_counts()
+        return
+
+    # The pending changes of the current action have to be counted
+    model.Session.flush()
+
+    ids = set()
+    if group_ids:
+        ids.update(group_id for (group_id,) in
+                   model.Session.query(model.Group.id).filter(
+                       or_(model.Group.id.in_(group_ids),
+                           model.Group.name.in_(group_ids))))
+    if package_ids:
+        packages = model.Session.query(model.Package.id,
+                                       model.Package.owner_org).filter(
+            or_(model.Package.id.in_(package_ids),
+                model.Package.name.in_(package_ids))).all()
+        ids.update(org_id for (_, org_id) in packages if org_id)
+        # Memberships are not removed, only marked as deleted, so they also
+        # tell the organizations and groups the datasets were moved out of.
+        ids.update(group_id for (group_id,) in
+                   model.Session.query(model.Member.group_id).filter(
+                       model.Member.table_name == 'package',
+                       model.Member.table_id.in_(
+                           [package_id for (package_id, _) in packages])
+                   ).distinct())
+
+    ids = list(ids)
+    SortOrganizations.update_package_counts(ids)
+    SortGroups.update_package_counts(ids)
@@ -16,6 +16,8 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import datetime
+import json
+import logging
 
 import ckan.logic as logic
 from ckan import model
@@ -23,7 +25,7 @@ from ckan.model.meta import metadata, mapper, Session
 from ckan.model.types import make_uuid
 from ckan.model.domain_object import DomainObject
 
-from sqlalchemy import types, ForeignKey, Column, Table, desc
+from sqlalchemy import types, ForeignKey, Column, Table, desc, func, and_
 
 __all__ = [
     'MostActiveOrganizations',
@@ -33,6 +35,12 @@ __all__ = [
 
 most_active_organizations_table = None
 
+log = logging.getLogger(__name__)
+
+# Bumped whenever the stored organizations change, so the processes caching
+# them know to reload.
+VERSION_KEY = 'ckanext-datagovmk:most-active-organizations:version'
+
 
 class MostActiveOrganizations(DomainObject):
 
@@ -41,6 +49,89 @@ class MostActiveOrganizations(DomainObject):
         obj = Session.query(cls).autoflush(False)
         return obj.limit(limit).all()
 
+    @classmethod
+    def compute(cls):
+        """Returns the organizations with public datasets, ordered by the
+        time a resource of their datasets was last created or modified, the
+        most recent first. Computed with a single aggregate query.
+
+        :returns: tuples of organization id, name, translated title (JSON)
+            and the time of the last resource change.
+        :rtype: list
+        """
+        last_modified = func.max(func.coalesce(model.Resource.last_modified,
+                                               model.Resource.created))
+        catalogs = Session.query(model.PackageExtra.package_id).filter(
+            model.PackageExtra.key == 'org_catalog_enabled',
+            func.lower(model.PackageExtra.value) == 'true',
+            model.PackageExtra.state == 'active')
+        query = Session.query(model.Group.id, model.Group.name,
+                              model.GroupExtra.value, last_modified).\
+            join(model.Package, model.Package.owner_org == model.Group.id).\
+            outerjoin(model.Resource,
+                      and_(model.Resource.package_id == model.Package.id,
+                           model.Resource.state == 'active')).\
+            outerjoin(model.GroupExtra,
+                      and_(model.GroupExtra.group_id == model.Group.id,
+                           model.GroupExtra.key == 'title_translated',
+                           model.GroupExtra.state == 'active')).\
+            filter(model.Group.state == 'active',
+                   model.Group.is_organization == True,
+                   model.Package.state == 'active',
+                   model.Package.private == False,
+                   model.Package.type == 'dataset',
+                   ~model.Package.id.in_(catalogs)).\
+            group_by(model.Group.id, model.Group.name, model.GroupExtra.value).\
+            order_by(last_modified.desc().nullslast(), model.Group.name)
+        return query.all()
+
+    @classmethod
+    def refresh(cls):
+        """Recomputes the most active organizations and replaces the stored
+        ones in a single transaction.
+        """
+        rows = cls.compute()
+        try:
+            Session.query(cls).delete(synchronize_session=False)
+            Session.bulk_save_objects([
+                cls(org_id=org_id, org_name=org_name,
+                    org_display_name=_title_translated(title))
+                for org_id, org_name, title, _last_modified in rows])
+            Session.commit()
+        except Exception:
+            Session.rollback()
+            raise
+        bump_version()
+        return len(rows)
+
+
+def get_version():
+    """Returns the version stamp of the stored organizations, or ``None``
+    when Redis is not available.
+    """
+    from ckan.lib.redis import connect_to_redis
+    try:
+        return connect_to_redis().get(VERSION_KEY)
+    except Exception as e:
+        log.debug('Failed to read the most active organizations version: %s', e)
+        return None
+
+
+def bump_version():
+    from ckan.lib.redis import connect_to_redis
+    try:
+        connect_to_redis().incr(VERSION_KEY)
+    except Exception as e:
+        log.warning('Failed to bump the most active organizations version: %s', e)
+
+
+def _title_translated(value):
+    # Stored the way the organization's title_translated was dumped before
+    try:
+        return json.dumps(json.loads(value)) if value else json.dumps(None)
+    except ValueError:
+        return json.dumps(None)
+
 most_active_organizations_table = Table(
     'most_active_organizations',
     metadata,
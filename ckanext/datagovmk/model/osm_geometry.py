@@ -0,0 +1,82 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import datetime
+
+from ckan import model
+from ckan.model.meta import metadata, mapper, Session
+from ckan.model.domain_object import DomainObject
+
+from sqlalchemy import types, Column, Table
+
+__all__ = ['OsmGeometry', 'osm_geometry_table', 'setup']
+
+osm_geometry_table = None
+
+
+class OsmGeometry(DomainObject):
+    """Geometry of an OSM relation, as fetched from the Overpass API or
+    seeded from the gazetteer.
+    """
+
+    @classmethod
+    def get(cls, relation_id):
+        return Session.query(cls).autoflush(False).\
+            filter_by(relation_id=str(relation_id)).first()
+
+    @classmethod
+    def get_all(cls):
+        return Session.query(cls).autoflush(False).\
+            order_by(cls.relation_id).all()
+
+    @classmethod
+    def store(cls, relation_id, geometry, fetched=None):
+        """Stores the geometry in its own transaction, independent of the
+        current session, so it can be called in the middle of an action.
+        """
+        values = {
+            'relation_id': str(relation_id),
+            'geometry': geometry,
+            'fetched': fetched or datetime.datetime.utcnow(),
+        }
+        with model.meta.engine.begin() as connection:
+            connection.execute(osm_geometry_table.delete().where(
+                osm_geometry_table.c.relation_id == values['relation_id']))
+            connection.execute(osm_geometry_table.insert().values(**values))
+
+    def is_fresh(self, ttl):
+        if not ttl:
+            return True
+        return self.fetched + ttl > datetime.datetime.utcnow()
+
+
+osm_geometry_table = Table(
+    'osm_geometry',
+    metadata,
+    Column('relation_id', types.UnicodeText, primary_key=True),
+    Column('geometry', types.UnicodeText),
+    Column('fetched', types.DateTime, default=datetime.datetime.utcnow),
+)
+
+mapper(
+    OsmGeometry,
+    osm_geometry_table,
+)
+
+
+def setup():
+    metadata.create_all(model.meta.engine)
@@ -0,0 +1,103 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import datetime
+
+from ckan import model
+from ckan.model.meta import metadata, mapper, Session
+from ckan.model.domain_object import DomainObject
+
+from sqlalchemy import types, Column, Table, func
+
+__all__ = ['OutdatedNotification', 'outdated_notification_table', 'setup']
+
+outdated_notification_table = None
+
+
+class OutdatedNotification(DomainObject):
+    """Records when the maintainers of an outdated dataset were last
+    notified, and for which due date.
+    """
+
+    @classmethod
+    def get_all(cls):
+        """Returns the notifications per dataset id.
+
+        :rtype: dict
+        """
+        return dict((notification.dataset_id, notification)
+                    for notification in Session.query(cls).autoflush(False))
+
+    @classmethod
+    def record(cls, due_dates, notified_at=None):
+        """Records that the datasets were notified.
+
+        :param due_dates: the due date of the update, per dataset id.
+        :type due_dates: dict
+        """
+        if not due_dates:
+            return
+        notified_at = notified_at or datetime.datetime.utcnow()
+        table = outdated_notification_table
+        with model.meta.engine.begin() as connection:
+            connection.execute(table.delete().where(
+                table.c.dataset_id.in_(list(due_dates))))
+            connection.execute(table.insert(), [
+                {'dataset_id': dataset_id, 'last_notified_at': notified_at,
+                 'due_date': due_date}
+                for dataset_id, due_date in due_dates.items()])
+
+    @classmethod
+    def get_stats(cls, since):
+        """Returns the number of notified datasets, in total and since the
+        given time, and the time of the last notification.
+
+        :rtype: dict
+        """
+        total, last_notified_at = Session.query(
+            func.count(cls.dataset_id), func.max(cls.last_notified_at)).one()
+        recent = Session.query(func.count(cls.dataset_id)).\
+            filter(cls.last_notified_at >= since).scalar()
+        return {
+            'notified': total,
+            'notified_recently': recent,
+            'last_notified_at': last_notified_at.isoformat() if last_notified_at else None,
+        }
+
+    def is_suppressed(self, due_date, since):
+        """Whether the dataset was already notified for the same due date
+        after ``since``.
+        """
+        return self.due_date == due_date and self.last_notified_at >= since
+
+
+outdated_notification_table = Table(
+    'outdated_dataset_notification',
+    metadata,
+    Column('dataset_id', types.UnicodeText, primary_key=True),
+    Column('last_notified_at', types.DateTime),
+    Column('due_date', types.DateTime),
+)
+
+mapper(
+    OutdatedNotification,
+    outdated_notification_table,
+)
+
+
+def setup():
+    metadata.create_all(model.meta.engine)
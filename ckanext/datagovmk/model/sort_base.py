@@ -0,0 +1,163 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import ckan.logic as logic
+import ckan.lib.helpers as h
+
+from ckan import model
+from ckan.model.meta import Session
+
+from sqlalchemy import func
+
+from ckanext.datagovmk.model.stats import escape_like
+
+
+__all__ = ['SortMixin']
+
+
+class SortMixin(object):
+    """ The queries shared by the sort tables of the organizations and the
+    groups. The classes using it set ``_sort_table``, ``_id_field`` (the
+    column with the id of the organization or group) and implement
+    ``_package_count``.
+    """
+
+    _sort_table = None
+    _id_field = None
+
+    @classmethod
+    def _package_count(cls, table):
+        """ Returns the scalar subquery counting the public datasets of the
+        organization or group of a row of ``table``.
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def get(cls, id=None, **kwargs):
+        query = Session.query(cls).autoflush(False)
+        return cls._filter(query, id=id, **kwargs)
+
+    @classmethod
+    def get_summary(cls, **kwargs):
+        """ Same as :py:meth:`get`, but each row also carries the name,
+        title, image and number of public datasets of the organization or
+        group, so lists can be built without an organization_show or
+        group_show per row. The rows can also be ordered by
+        ``package_count``.
+        """
+        query = Session.query(cls, model.Group.name, model.Group.title,
+                              model.Group.image_url, cls.package_count).\
+            autoflush(False).\
+            join(model.Group, model.Group.id == getattr(cls, cls._id_field)).\
+            filter(model.Group.state == 'active')
+
+        return cls._filter(query, **kwargs)
+
+    @classmethod
+    def _filter(cls, query, id=None, **kwargs):
+        q = kwargs.pop('q', None)
+        limit = kwargs.pop('limit', None)
+        offset = kwargs.pop('offset', None)
+        order_by = kwargs.pop('order_by', None)
+        non_empty = kwargs.pop('non_empty', False)
+
+        query = query.filter(*[getattr(cls, key) == value
+                               for key, value in kwargs.items()])
+
+        if id:
+            query = query.filter(cls.id == id)
+
+        if non_empty:
+            query = query.filter(cls.package_count > 0)
+
+        if q:
+            query = query.filter(cls._title_column().ilike(
+                u'%{0}%'.format(escape_like(q)), escape='\\'))
+
+        if order_by is not None:
+            query = query.order_by(cls._order_by(order_by))
+
+        if limit:
+            query = query.limit(limit)
+
+        if offset:
+            query = query.offset(offset)
+
+        return query
+
+    @classmethod
+    def _title_column(cls):
+        lang = h.lang()
+        if lang == 'mk':
+            return cls.title_mk
+        elif lang == 'en':
+            return cls.title_en
+        return cls.title_sq
+
+    @classmethod
+    def _order_by(cls, order_by):
+        """ Turns a sort like ``title_mk asc`` into an order by clause. The
+        titles are compared lower-cased, which is indexed. Blank sorts and
+        unknown fields fall back to the title in the current language.
+        """
+        parts = (order_by or '').split()
+        field = parts[0] if parts else 'title'
+        descending = len(parts) > 1 and parts[1].lower() == 'desc'
+
+        if field == 'package_count':
+            column = cls.package_count
+        elif field in ('title_mk', 'title_en', 'title_sq'):
+            column = func.lower(getattr(cls, field))
+        else:
+            column = func.lower(cls._title_column())
+
+        return column.desc() if descending else column.asc()
+
+    @classmethod
+    def update_package_counts(cls, ids=None):
+        """ Recomputes the number of public datasets of the organizations or
+        groups. The caller commits.
+
+        :param ids: ids of the organizations or groups to update, all of
+            them when not given
+        :type ids: list
+        """
+        table = cls._sort_table
+        statement = table.update().values(
+            package_count=cls._package_count(table))
+        if ids is not None:
+            if not ids:
+                return
+            statement = statement.where(table.c[cls._id_field].in_(ids))
+        Session.execute(statement)
+
+    @classmethod
+    def update(cls, filter, data):
+        obj = Session.query(cls).filter_by(**filter)
+        obj.update(data)
+        Session.commit()
+
+        return obj.first()
+
+    @classmethod
+    def delete(cls, filter):
+        obj = Session.query(cls).filter_by(**filter).first()
+        if obj:
+            Session.delete(obj)
+            Session.commit()
+        else:
+            raise logic.NotFound
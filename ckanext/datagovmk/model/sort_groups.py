@@ -15,15 +15,16 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-import ckan.logic as logic
-import ckan.lib.helpers as h
-
 from ckan import model
-from ckan.model.meta import metadata, mapper, Session
+from ckan.model.meta import metadata, mapper
 from ckan.model.types import make_uuid
 from ckan.model.domain_object import DomainObject
 
-from sqlalchemy import types, ForeignKey, Column, Table, or_, text
+from sqlalchemy import select, types, ForeignKey, Column, Table, Index, func
+
+from ckanext.datagovmk.model.sort_base import SortMixin
+from ckanext.datagovmk.model.stats import (ensure_column, ensure_index,
+                                           ensure_title_search_indexes)
 
 
 __all__ = [
@@ -40,79 +41,32 @@ sort_groups_table = Table(
            ForeignKey('group.id', ondelete='CASCADE')),
     Column('title_mk', types.UnicodeText),
     Column('title_en', types.UnicodeText),
-    Column('title_sq', types.UnicodeText)
-
+    Column('title_sq', types.UnicodeText),
+    Column('package_count', types.Integer, nullable=False, default=0,
+           server_default='0')
 )
 
+sort_groups_package_count_index = Index(
+    'idx_sort_groups_package_count', sort_groups_table.c.package_count)
 
-class SortGroups(DomainObject):
 
-    @classmethod
-    def get(cls, id=None, **kwargs):
-        q = kwargs.get('q')
-        limit = kwargs.get('limit')
-        offset = kwargs.get('offset')
-        order_by = kwargs.get('order_by')
-        current_lang = h.lang()
-
-        kwargs.pop('q', None)
-        kwargs.pop('limit', None)
-        kwargs.pop('offset', None)
-        kwargs.pop('order_by', None)
-
-        query = Session.query(cls).autoflush(False)
-        query = query.filter_by(**kwargs)
-
-        if id:
-            query = query.filter(
-                or_(cls.id == id, cls.id == id)
-            )
-
-        if q:
-            q = q
-            if current_lang == 'mk':
-                query = query.filter(
-                    or_(cls.title_mk.contains(q),
-                        cls.title_mk.ilike("%{}%".format(q)))
-                )
-            elif current_lang == 'en':
-                query = query.filter(
-                    or_(cls.title_en.contains(q),
-                        cls.title_en.ilike("%{}%".format(q)))
-                )
-            else:
-                query = query.filter(
-                    or_(cls.title_sq.contains(q),
-                        cls.title_sq.ilike("%{}%".format(q)))
-                )
-
-        if order_by:
-            query = query.order_by(text(order_by))
-
-        if limit:
-            query = query.limit(limit)
-
-        if offset:
-            query = query.offset(offset)
-
-        return query
-
-    @classmethod
-    def update(cls, filter, data):
-        obj = Session.query(cls).filter_by(**filter)
-        obj.update(data)
-        Session.commit()
+class SortGroups(SortMixin, DomainObject):
 
-        return obj.first()
+    _sort_table = sort_groups_table
+    _id_field = 'group_id'
 
     @classmethod
-    def delete(cls, filter):
-        obj = Session.query(cls).filter_by(**filter).first()
-        if obj:
-            Session.delete(obj)
-            Session.commit()
-        else:
-            raise logic.NotFound
+    def _package_count(cls, table):
+        return select([func.count(model.Member.id)]).\
+            select_from(model.Member.__table__.join(
+                model.Package.__table__,
+                model.Package.id == model.Member.table_id)).\
+            where(model.Member.group_id == table.c.group_id).\
+            where(model.Member.table_name == 'package').\
+            where(model.Member.state == 'active').\
+            where(model.Package.state == 'active').\
+            where(model.Package.private == False).\
+            as_scalar()
 
 
 mapper(
@@ -123,3 +77,8 @@ mapper(
 
 def setup():
     metadata.create_all(model.meta.engine)
+    ensure_column('sort_groups', 'package_count', 'INTEGER NOT NULL DEFAULT 0',
+                  model.meta.engine)
+    ensure_index(sort_groups_package_count_index, model.meta.engine)
+    ensure_title_search_indexes('sort_groups', ['title_mk', 'title_en', 'title_sq'],
+                                model.meta.engine)
@@ -19,16 +19,24 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 Helpers and tools to check and use the stats tables from ckanext-googleanalytics.
 """
 
+import logging
+from contextlib import contextmanager
+
 from sqlalchemy import Table, Column, Integer, String, MetaData
 from sqlalchemy.sql import select, text, exists, update, insert
 from sqlalchemy import func
 from sqlalchemy.engine import reflection
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 import ckan.model as model
 
+log = logging.getLogger(__name__)
 
 TABLES = {}
 
+# Download totals per package, preloaded by preloaded_package_downloads
+_PRELOADED_DOWNLOADS = None
+
 global _STATS_CHECKED
 _STATS_CHECKED = False
 
@@ -62,6 +70,75 @@ def ensure_column(table_name, column_name, column_type, engine):
         })
 
 
+def ensure_index(index, engine):
+    """Ensure that the index exists on its table. If not, create it.
+
+    :param index: the index to check for.
+    :type index: sqlalchemy.Index
+    :param engine: configured SQLAlchemy engine.
+    :type engine: sqlachemy.engine.Engine
+
+    """
+
+    insp = reflection.Inspector.from_engine(engine)
+    names = [idx['name'] for idx in insp.get_indexes(index.table.name)]
+    if index.name not in names:
+        index.create(engine)
+
+
+def ensure_title_search_indexes(table_name, column_names, engine):
+    """Ensure that the title columns of the table can be searched and sorted
+    using indexes: an index on the lower-cased value of each column for
+    sorting and, on PostgreSQL, a trigram index for ``ILIKE '%q%'``
+    searches. The trigram indexes are skipped when the ``pg_trgm`` extension
+    cannot be created.
+
+    :param table_name: the table with the title columns.
+    :type table_name: string
+    :param column_names: the names of the title columns.
+    :type column_names: list
+    :param engine: configured SQLAlchemy engine.
+    :type engine: sqlachemy.engine.Engine
+
+    """
+
+    trigram = False
+    if engine.dialect.name == 'postgresql':
+        try:
+            engine.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            trigram = True
+        except Exception as e:
+            log.warning('Could not create the pg_trgm extension, searching '
+                        '%s will not use an index: %s', table_name, e)
+
+    for column_name in column_names:
+        params = {'table_name': table_name, 'column_name': column_name}
+        engine.execute('CREATE INDEX IF NOT EXISTS '
+                       'idx_%(table_name)s_%(column_name)s_lower '
+                       'ON %(table_name)s (lower(%(column_name)s))' % params)
+        if trigram:
+            engine.execute('CREATE INDEX IF NOT EXISTS '
+                           'idx_%(table_name)s_%(column_name)s_trgm '
+                           'ON %(table_name)s USING gin '
+                           '(%(column_name)s gin_trgm_ops)' % params)
+
+
+def escape_like(value, escape='\\'):
+    """Escapes the wildcards of ``LIKE`` patterns in the value.
+
+    :param value: the value to escape.
+    :type value: string
+    :param escape: the escape character used in the ``LIKE`` expression.
+    :type escape: string
+
+    :returns: the escaped value.
+    :rtype: string
+
+    """
+    return value.replace(escape, escape * 2).\
+        replace('%', escape + '%').replace('_', escape + '_')
+
+
 def _setup_stats_tables():
     """Setup the tables for stats. This depends on ckanext-googleanalytics to create the tables in CKAN.
     """
@@ -123,19 +200,32 @@ def get_stats_for_package(package_id):
     :rtype: dictionary
 
     """
+    return get_stats_for_packages([package_id]).get(package_id, {})
 
-    if not is_stats_available():
+
+def get_stats_for_packages(package_ids):
+    """Retrieve stats for multiple packages in a single query.
+
+    :param package_ids: the ids of the packages to retrieve stats for.
+    :type package_ids: list
+
+    :returns: the package stats (see :py:func:`get_stats_for_package`) per
+      package id. Packages without stats are not in the result.
+    :rtype: dictionary
+
+    """
+
+    package_ids = list(set(package_ids))
+    if not package_ids or not is_stats_available():
         return {}
     package_stats = TABLES['package_stats']
     results = model.Session.execute(select([package_stats.c.package_id,
                                             package_stats.c.visits_recently,
                                             package_stats.c.visits_ever]).\
-                                    where(package_stats.c.package_id == package_id)).\
-                                    fetchmany(1)
-    if results:
-        stats_tuple = results[0]
-        return {'id': stats_tuple[0], 'visits_recently': stats_tuple[1], 'visits_ever': stats_tuple[2]}
-    return {}
+                                    where(package_stats.c.package_id.in_(package_ids)))
+    return dict((row[0], {'id': row[0], 'visits_recently': row[1], 'visits_ever': row[2]})
+                for row in results)
+
 
 def get_stats_for_resource(resource_id):
     """Retrieve stats for the resource.
@@ -153,20 +243,32 @@ def get_stats_for_resource(resource_id):
     :rtype: dictionary
 
     """
+    return get_stats_for_resources([resource_id]).get(resource_id, {})
 
-    if not is_stats_available():
+
+def get_stats_for_resources(resource_ids):
+    """Retrieve stats for multiple resources in a single query.
+
+    :param resource_ids: the ids of the resources to retrieve stats for.
+    :type resource_ids: list
+
+    :returns: the resource stats (see :py:func:`get_stats_for_resource`) per
+      resource id. Resources without stats are not in the result.
+    :rtype: dictionary
+
+    """
+
+    resource_ids = list(set(resource_ids))
+    if not resource_ids or not is_stats_available():
         return {}
     resource_stats = TABLES['resource_stats']
     results = model.Session.execute(select([resource_stats.c.resource_id,
                                             resource_stats.c.visits_recently,
                                             resource_stats.c.visits_ever,
                                             resource_stats.c.downloads]).\
-                                    where(resource_stats.c.resource_id == resource_id)).\
-                                    fetchmany(1)
-    if results:
-        stats_tuple = results[0]
-        return {'id': stats_tuple[0], 'visits_recently': stats_tuple[1], 'visits_ever': stats_tuple[2], 'downloads': stats_tuple[3]}
-    return {}
+                                    where(resource_stats.c.resource_id.in_(resource_ids)))
+    return dict((row[0], {'id': row[0], 'visits_recently': row[1], 'visits_ever': row[2], 'downloads': row[3]})
+                for row in results)
 
 
 def increment_downloads(resource_id):
@@ -179,17 +281,45 @@ def increment_downloads(resource_id):
     """
     if not is_stats_available():
         return
+    upsert_downloads({resource_id: 1})
+    model.Session.commit()
+
+
+def upsert_downloads(counts):
+    """Adds the given number of downloads to the resources, in a single
+    ``INSERT ... ON CONFLICT DO UPDATE`` statement. The caller is responsible
+    for committing the session.
+
+    :param counts: number of downloads to add, per resource id.
+    :type counts: dict
+
+    """
+    if not is_stats_available() or not counts:
+        return
     resource_stats = TABLES['resource_stats']
+
+    if model.meta.engine.dialect.name != 'postgresql':
+        for resource_id, count in counts.items():
+            _increment_downloads_by(resource_stats, resource_id, count)
+        return
+
+    stmt = pg_insert(resource_stats).values([
+        {'resource_id': resource_id, 'visits_recently': 0, 'visits_ever': 0,
+         'downloads': count}
+        for resource_id, count in counts.items()])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[resource_stats.c.resource_id],
+        set_={'downloads': func.coalesce(resource_stats.c.downloads, 0) +
+              stmt.excluded.downloads})
+    model.Session.execute(stmt)
+
+
+def _increment_downloads_by(resource_stats, resource_id, count):
     ret = model.Session.query(exists().where(resource_stats.c.resource_id == resource_id)).scalar()
     if not ret:
-        model.Session.execute(insert(resource_stats).values(resource_id=resource_id, visits_recently=0, visits_ever=0, downloads=1))
+        model.Session.execute(insert(resource_stats).values(resource_id=resource_id, visits_recently=0, visits_ever=0, downloads=count))
     else:
-        result = model.Session.query(resource_stats).filter_by(resource_id=resource_id).first()
-        if result[3] is None:
-            model.Session.execute(resource_stats.update(resource_stats.c.resource_id==resource_id).values(downloads=1))
-        else:
-            model.Session.execute(resource_stats.update(resource_stats.c.resource_id==resource_id).values(downloads=resource_stats.c.downloads+1))
-    model.Session.commit()
+        model.Session.execute(resource_stats.update(resource_stats.c.resource_id==resource_id).values(downloads=func.coalesce(resource_stats.c.downloads, 0)+count))
 
 
 def get_total_package_downloads(package_id):
@@ -205,6 +335,8 @@ def get_total_package_downloads(package_id):
 
     """
 
+    if _PRELOADED_DOWNLOADS is not None:
+        return _PRELOADED_DOWNLOADS.get(package_id, 0)
     if not is_stats_available():
         return 0
     resource_stats = TABLES['resource_stats']
@@ -213,3 +345,53 @@ def get_total_package_downloads(package_id):
 
     result = model.Session.query(func.sum(resource_stats.c.downloads)).filter(resource_stats.c.resource_id.in_(subq)).scalar()
     return result or 0
+
+
+def get_total_downloads_for_packages(package_ids):
+    """Retrieve the total number of downloads for multiple packages in a
+    single query.
+
+    :param package_ids: the package (dataset) ids.
+    :type package_ids: list
+
+    :returns: the total number of downloads of all resources of the package,
+        per package id. Every requested package id is in the result.
+    :rtype: dictionary
+
+    """
+
+    package_ids = list(set(package_ids))
+    totals = dict((package_id, 0) for package_id in package_ids)
+    if not package_ids or not is_stats_available():
+        return totals
+    totals.update(_query_total_downloads(package_ids))
+    return totals
+
+
+def _query_total_downloads(package_ids=None):
+    resource_stats = TABLES['resource_stats']
+
+    query = model.Session.query(model.Resource.package_id,
+                                func.sum(resource_stats.c.downloads)).\
+        join(resource_stats, resource_stats.c.resource_id == model.Resource.id)
+    if package_ids is not None:
+        query = query.filter(model.Resource.package_id.in_(package_ids))
+    query = query.group_by(model.Resource.package_id)
+    return dict((package_id, int(downloads or 0)) for package_id, downloads in query)
+
+
+@contextmanager
+def preloaded_package_downloads():
+    """Loads the total number of downloads of all packages with a single
+    aggregate query, and serves :py:func:`get_total_package_downloads` from
+    it until the end of the ``with`` block. Meant for bulk operations such as
+    rebuilding the search index; downloads counted meanwhile are not seen.
+
+    """
+    global _PRELOADED_DOWNLOADS
+    previous = _PRELOADED_DOWNLOADS
+    _PRELOADED_DOWNLOADS = _query_total_downloads() if is_stats_available() else {}
+    try:
+        yield _PRELOADED_DOWNLOADS
+    finally:
+        _PRELOADED_DOWNLOADS = previous
@@ -0,0 +1,267 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Digest emails for the outdated datasets.
+
+The notifications are grouped per recipient, so every maintainer gets one
+email listing all of their outdated datasets, and sent over a single SMTP
+connection, at most ``ckanext.datagovmk.notifications.rate`` messages per
+second.
+"""
+
+import time
+import smtplib
+from collections import OrderedDict
+from email.header import Header
+from email.mime.text import MIMEText
+from email import utils as email_utils
+from html import escape
+from logging import getLogger
+from urllib.parse import urlparse
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+
+log = getLogger(__name__)
+
+
+class NotificationDigest(object):
+    """Collects the outdated datasets per recipient.
+    """
+
+    def __init__(self):
+        self.recipients = OrderedDict()
+
+    def add(self, user, dataset_url, dataset_update_url, dataset_title,
+            dataset_id=None):
+        email = (user.get('email') or '').strip()
+        if not email:
+            return
+        recipient = self.recipients.setdefault(email.lower(), {
+            'email': email,
+            'username': user.get('username') or email,
+            'datasets': OrderedDict(),
+        })
+        recipient['datasets'][dataset_url] = {
+            'dataset_id': dataset_id,
+            'dataset_url': dataset_url,
+            'dataset_update_url': dataset_update_url,
+            'dataset_title': dataset_title,
+        }
+
+    def __len__(self):
+        return len(self.recipients)
+
+    def __iter__(self):
+        for recipient in self.recipients.values():
+            yield recipient['email'], recipient['username'], \
+                list(recipient['datasets'].values())
+
+
+class UserCache(object):
+    """Caches ``user_show`` for the duration of a run.
+    """
+
+    def __init__(self):
+        self._users = {}
+
+    def get(self, user_id):
+        if user_id not in self._users:
+            try:
+                self._users[user_id] = toolkit.get_action('user_show')(
+                    {'ignore_auth': True}, {'id': user_id})
+            except toolkit.ObjectNotFound:
+                self._users[user_id] = None
+        return self._users[user_id]
+
+
+def get_mail_from():
+    """Returns the sender address of the notifications: ``smtp.mail_from``,
+    falling back to ``error_email_from`` and to ``ckan@<site host>``.
+
+    :rtype: string
+    """
+    mail_from = config.get('smtp.mail_from') or config.get('error_email_from')
+    if not mail_from:
+        host = urlparse(config.get('ckan.site_url') or '').hostname
+        mail_from = 'ckan@{0}'.format(host or 'localhost')
+    return mail_from
+
+
+class SMTPSender(object):
+    """Sends emails over a single SMTP connection, configured with CKAN's
+    ``smtp.*`` settings. Use it as a context manager.
+
+    :param dry_run: only log the emails, don't connect to the SMTP server.
+    :type dry_run: bool
+    :param rate: maximal number of emails sent per second. ``0`` disables
+        the rate limiting.
+    :type rate: float
+    """
+
+    def __init__(self, dry_run=False, rate=None):
+        self.dry_run = dry_run
+        if rate is None:
+            rate = float(config.get('ckanext.datagovmk.notifications.rate', 5))
+        self.interval = 1.0 / rate if rate else 0
+        self.sent = []
+        self._connection = None
+        self._last_sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connect(self):
+        # The same settings as ckan.lib.mailer: when ``smtp.test_server`` is
+        # set, the other ``smtp.*`` connection settings are ignored.
+        if 'smtp.test_server' in config:
+            server = config['smtp.test_server']
+            starttls = False
+            user = password = None
+        else:
+            server = config.get('smtp.server', 'localhost')
+            starttls = toolkit.asbool(config.get('smtp.starttls'))
+            user = config.get('smtp.user')
+            password = config.get('smtp.password')
+
+        connection = smtplib.SMTP(server)
+        connection.ehlo()
+        if starttls:
+            if not connection.has_extn('STARTTLS'):
+                raise smtplib.SMTPException(
+                    'SMTP server does not support STARTTLS')
+            connection.starttls()
+            connection.ehlo()
+        if user:
+            connection.login(user, password)
+        return connection
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except smtplib.SMTPException:
+                pass
+            self._connection = None
+
+    def _throttle(self):
+        wait = self._last_sent + self.interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_sent = time.time()
+
+    def send(self, email, subject, body):
+        mail_from = get_mail_from()
+        msg = MIMEText(body, 'html', 'utf-8')
+        msg['Subject'] = Header(subject, 'utf-8')
+        msg['From'] = u'{0} <{1}>'.format(
+            config.get('ckan.site_title', 'CKAN'), mail_from)
+        msg['To'] = email
+        msg['Date'] = email_utils.formatdate(time.time())
+        reply_to = config.get('smtp.reply_to')
+        if reply_to:
+            msg['Reply-to'] = reply_to
+
+        if self.dry_run:
+            log.info('Dry run, not sending "%s" to %s', subject, email)
+            self.sent.append(msg)
+            return
+
+        self._throttle()
+        for attempt in (1, 2):
+            if self._connection is None:
+                self._connection = self._connect()
+            try:
+                self._connection.sendmail(mail_from, [email], msg.as_string())
+                break
+            except smtplib.SMTPServerDisconnected:
+                self._connection = None
+                if attempt == 2:
+                    raise
+        self.sent.append(msg)
+
+
+def _format_datasets(datasets):
+    return u'\n'.join(
+        u'<li><a href="{0}">{1}</a> (<a href="{2}">{2}</a>)</li>'.format(
+            escape(dataset['dataset_url']), escape(dataset['dataset_title']),
+            escape(dataset['dataset_update_url']))
+        for dataset in datasets)
+
+
+def render_digest(username, datasets):
+    """Returns the subject and body of the notification email for the
+    outdated datasets of one recipient.
+
+    :rtype: tuple
+    """
+    from ckanext.datagovmk.commands import _load_resource_from_path
+
+    site_title = config.get('ckan.site_title', 'CKAN')
+    if len(datasets) == 1:
+        dataset = datasets[0]
+        subject = u'CKAN: Потсетување за ажурирање на податочниот сет „{title}“ | '\
+            u'Kujtesë për përditësimin e të dhënave "{title}" | '\
+            u'Reminder to update dataset "{title}"'.format(title=dataset['dataset_title'])
+        body = _load_resource_from_path(
+            'ckanext.datagovmk:templates/datagovmk/outdated_dataset_email.html').format(
+                username=username, site_title=site_title, **dataset)
+        return subject, body
+
+    subject = u'CKAN: Потсетување за ажурирање на {count} податочни сетови | '\
+        u'Kujtesë për përditësimin e {count} të dhënave | '\
+        u'Reminder to update {count} datasets'.format(count=len(datasets))
+    body = _load_resource_from_path(
+        'ckanext.datagovmk:templates/datagovmk/outdated_datasets_digest_email.html').format(
+            username=username, site_title=site_title,
+            datasets=_format_datasets(datasets))
+    return subject, body
+
+
+def send_digests(digest, dry_run=False, sender=None):
+    """Sends one email per recipient in the digest.
+
+    :param digest: the collected notifications.
+    :type digest: NotificationDigest
+    :param dry_run: only log the emails, don't send them.
+    :type dry_run: bool
+
+    :returns: the number of recipients, sent and failed emails, and the ids
+        of the datasets included in at least one sent email.
+    :rtype: dict
+    """
+    result = {'recipients': len(digest), 'sent': 0, 'failed': 0,
+              'notified_datasets': set()}
+    sender = sender or SMTPSender(dry_run=dry_run)
+    with sender:
+        for email, username, datasets in digest:
+            subject, body = render_digest(username, datasets)
+            try:
+                sender.send(email, subject, body)
+                result['sent'] += 1
+                result['notified_datasets'].update(
+                    dataset['dataset_id'] for dataset in datasets
+                    if dataset.get('dataset_id'))
+            except Exception as e:
+                log.error('Failed to send the outdated datasets notification to %s: %s', email, e)
+                sender.close()
+                result['failed'] += 1
+    return result
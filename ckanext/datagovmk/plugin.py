@@ -25,7 +25,8 @@ from ckan.logic import get_action
 from ckanext.datagovmk import actions
 from ckanext.datagovmk import auth
 import ckanext.datagovmk.cli as cli
-from ckanext.datagovmk.utils import populate_location_name_from_spatial_uri
+from ckanext.datagovmk.utils import (populate_location_name_from_spatial_uri,
+                                     get_update_schedule)
 from ckanext.datagovmk import monkey_patch
 from ckan.lib import email_notifications
 from ckan.lib import base
@@ -38,6 +39,8 @@ from ckanext.datagovmk.views import (bulk_download,
                                      override_stats)
 
 
+SOLR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
 # monkey_patch.activity_streams()
 monkey_patch.validators()
 
@@ -126,7 +129,7 @@ class DatagovmkPlugin(plugins.SingletonPlugin, DefaultTranslation):
             'datagovmk_get_resource_stats':
                 helpers.get_resource_stats,
             'datagovmk_total_downloads':
-                helpers.get_total_package_downloads,
+                helpers.get_package_total_downloads,
             'datagovmk_get_related_datasets':
                 helpers.get_related_datasets,
             'datagovmk_get_user_id':
@@ -135,6 +138,8 @@ class DatagovmkPlugin(plugins.SingletonPlugin, DefaultTranslation):
                 helpers.get_last_authority_for_user,
             'datagovmk_get_org_title':
                 helpers.get_org_title,
+            'datagovmk_get_org_titles':
+                helpers.get_org_titles,
             'datagovmk_get_org_description':
                 helpers.get_org_description,
             'datagovmk_get_org_catalog':
@@ -160,12 +165,17 @@ class DatagovmkPlugin(plugins.SingletonPlugin, DefaultTranslation):
         return {
             'datagovmk_get_related_datasets': actions.get_related_datasets,
             'datagovmk_prepare_zip_resources': actions.prepare_zip_resources,
+            'datagovmk_zip_resources_status': actions.zip_resources_status,
             'datagovmk_increment_downloads_for_resource': actions.increment_downloads_for_resource,
             'package_create': actions.add_spatial_data(package_create),
             'package_update': actions.add_spatial_data(package_update),
+            'package_delete': actions.package_delete,
             'resource_create': actions.resource_create,
             'resource_update': actions.resource_update,
             'datagovmk_start_script': actions.start_script,
+            'datagovmk_cache_stats': actions.cache_stats,
+            'datagovmk_outdated_notifications_stats':
+                actions.outdated_notifications_stats,
             'user_create': actions.user_create,
             'user_update': actions.user_update,
             'user_activity_list': actions.user_activity_list,
@@ -184,7 +194,12 @@ class DatagovmkPlugin(plugins.SingletonPlugin, DefaultTranslation):
             'group_list': actions.group_list,
             'group_delete': actions.group_delete,
             'group_create': actions.group_create,
-            'group_update': actions.group_update
+            'group_update': actions.group_update,
+            'member_create': actions.member_create,
+            'member_delete': actions.member_delete,
+            'bulk_update_private': actions.bulk_update_private,
+            'bulk_update_public': actions.bulk_update_public,
+            'bulk_update_delete': actions.bulk_update_delete
         }
 
     # IAuthFunctions
@@ -194,6 +209,9 @@ class DatagovmkPlugin(plugins.SingletonPlugin, DefaultTranslation):
             'datagovmk_get_related_datasets': auth.get_related_datasets,
             'datagovmk_get_groups': helpers.get_groups,
             'datagovmk_start_script': auth.start_script,
+            'datagovmk_cache_stats': auth.cache_stats,
+            'datagovmk_outdated_notifications_stats':
+                auth.outdated_notifications_stats,
         }
 
     def update_config_schema(self, schema):
@@ -226,14 +244,40 @@ class DatagovmkPlugin(plugins.SingletonPlugin, DefaultTranslation):
             pkg_dict['title_en'] = titles_json.get('en', '').lower()
             pkg_dict['title_mk'] = titles_json.get('mk', '').lower()
             pkg_dict['title_sq'] = titles_json.get('sq', '').lower()
-        stats = actions.get_package_stats(pkg_dict['id'])
+        # The dataset being indexed is already dictized, don't run
+        # package_show for it again.
+        validated_data_dict = pkg_dict.get('validated_data_dict')
+        data_dict = json.loads(validated_data_dict) if validated_data_dict else None
+        stats = actions.get_package_stats(pkg_dict['id'], data_dict)
         if stats:
             pkg_dict['extras_file_size'] = str(stats.get('file_size') or '0').rjust(24, '0')
             pkg_dict['extras_total_downloads'] = str(stats.get('total_downloads') or '0').rjust(24, '0')
 
+        if data_dict:
+            last_modified, next_update_due = get_update_schedule(data_dict)
+            if last_modified:
+                pkg_dict['last_resource_modified'] = last_modified.strftime(SOLR_DATE_FORMAT)
+            if next_update_due:
+                pkg_dict['next_update_due'] = next_update_due.strftime(SOLR_DATE_FORMAT)
+
         populate_location_name_from_spatial_uri(pkg_dict)
         return pkg_dict
 
+    def after_create(self, context, pkg_dict):
+        actions._update_sort_package_counts(package_ids=[pkg_dict['id']],
+                                            commit=False)
+        return pkg_dict
+
+    def after_update(self, context, pkg_dict):
+        actions._update_sort_package_counts(package_ids=[pkg_dict['id']],
+                                            commit=False)
+        return pkg_dict
+
+    def after_delete(self, context, pkg_dict):
+        actions._update_sort_package_counts(package_ids=[pkg_dict['id']],
+                                            commit=False)
+        return pkg_dict
+
     def before_view(self, pkg_dict):
         return pkg_dict
 
@@ -0,0 +1,80 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Streaming of all datasets from the search index.
+"""
+
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+
+def iter_datasets(fq=None, batch_size=BATCH_SIZE, include_private=False,
+                  include_catalogs=False):
+    '''
+    Yields the fully dictized datasets (as ``package_show`` returns them)
+    from the search index.
+
+    The index is paged with a Solr cursor sorted on its unique key
+    (``index_id``, as cursors require), so every page costs the same
+    regardless of how deep it is, and the dictized datasets are taken from
+    the indexed ``validated_data_dict`` instead of calling ``package_show``
+    for every dataset.
+
+    :param fq: additional filter queries.
+    :type fq: list
+    :param batch_size: number of datasets fetched from Solr at once.
+    :type batch_size: int
+    :param include_private: include the private datasets.
+    :type include_private: bool
+    :param include_catalogs: include the datasets marked as catalogs.
+    :type include_catalogs: bool
+    '''
+    from ckan.lib.search.common import make_connection
+    from ckan.plugins.toolkit import config
+
+    filters = [
+        '+site_id:"{0}"'.format(config.get('ckan.site_id')),
+        '+dataset_type:dataset',
+        '+state:active',
+    ]
+    if not include_private:
+        filters.append('+capacity:public')
+    if not include_catalogs:
+        filters.append('-extras_org_catalog_enabled:true')
+    filters.extend(fq or [])
+
+    connection = make_connection()
+    cursor = '*'
+    while True:
+        results = connection.search(q='*:*', fq=filters,
+                                    fl='id,validated_data_dict',
+                                    sort='index_id asc', rows=batch_size,
+                                    cursorMark=cursor)
+        for doc in results.docs:
+            try:
+                yield json.loads(doc['validated_data_dict'])
+            except (KeyError, ValueError) as e:
+                log.warning('Dataset %s has no valid indexed data: %s',
+                            doc.get('id'), e)
+        next_cursor = results.nextCursorMark
+        if not results.docs or next_cursor == cursor:
+            break
+        cursor = next_cursor
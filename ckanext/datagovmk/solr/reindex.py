@@ -0,0 +1,255 @@
+"""
+Copyright (c) 2018 Keitaro AB
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+"""Parallel rebuild of the search index.
+
+The ids of the datasets are split in chunks which are indexed by a pool of
+forked worker processes. The workers send the documents to Solr in batches
+instead of one request per dataset, and Solr is committed once at the end.
+"""
+
+import os
+import time
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_BATCH_SIZE = 50
+
+
+class BufferedSolrConnection(object):
+    '''
+    Wraps a pysolr connection and buffers the added documents, sending them
+    to Solr in batches of ``batch_size``. Commits requested with the added
+    documents are ignored, the caller commits at the end.
+
+    A batch that fails is retried one document at a time. A document that
+    still fails is recorded in ``failed`` when ``force`` is set, otherwise
+    the error is raised.
+    '''
+
+    def __init__(self, connection_factory, batch_size=DEFAULT_BATCH_SIZE,
+                 force=False):
+        self._connection_factory = connection_factory
+        self._connection = None
+        self.batch_size = batch_size
+        self.force = force
+        self.docs = []
+        self.failed = []
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = self._connection_factory()
+        return self._connection
+
+    def add(self, docs, commit=False, **kwargs):
+        self.docs.extend(docs)
+        if len(self.docs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        docs, self.docs = self.docs, []
+        if not docs:
+            return
+        try:
+            self.connection.add(docs=docs, commit=False)
+        except Exception as e:
+            log.warning('Failed to index a batch of %d datasets, indexing '
+                        'them one by one: %s', len(docs), e)
+            for doc in docs:
+                try:
+                    self.connection.add(docs=[doc], commit=False)
+                except Exception as e:
+                    log.error('Failed to index dataset %s: %s',
+                              doc.get('id'), e)
+                    if not self.force:
+                        raise
+                    self.failed.append(doc.get('id'))
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+@contextmanager
+def buffered_solr_adds(batch_size=DEFAULT_BATCH_SIZE, force=False):
+    '''
+    Makes CKAN's package index send the documents to Solr in batches for the
+    duration of the ``with`` block. The last batch is sent on exit.
+    '''
+    from ckan.lib.search import index
+
+    make_connection = index.make_connection
+    connection = BufferedSolrConnection(make_connection, batch_size, force)
+    index.make_connection = lambda *args, **kwargs: connection
+    try:
+        yield connection
+        connection.flush()
+    finally:
+        index.make_connection = make_connection
+
+
+def get_package_ids():
+    from ckan import model
+    return [package_id for (package_id,) in
+            model.Session.query(model.Package.id)
+            .filter(model.Package.state != 'deleted')
+            .order_by(model.Package.id)]
+
+
+def index_packages(package_ids, force=False, batch_size=DEFAULT_BATCH_SIZE):
+    '''
+    Indexes the given datasets, without committing.
+
+    :param package_ids: the ids of the datasets to index.
+    :type package_ids: list
+    :param force: continue when a dataset fails to index.
+    :type force: bool
+    :param batch_size: number of documents sent to Solr at once.
+    :type batch_size: int
+
+    :returns: the number of indexed datasets and the ids of the datasets
+        that failed to index.
+    :rtype: tuple
+    '''
+    from ckan import model
+    from ckan.lib.search.index import PackageSearchIndex
+    from ckan.plugins import toolkit
+
+    package_index = PackageSearchIndex()
+    failed = []
+    with buffered_solr_adds(batch_size, force) as connection:
+        for package_id in package_ids:
+            context = {'model': model, 'ignore_auth': True, 'validate': False,
+                       'use_cache': False}
+            try:
+                package = toolkit.get_action('package_show')(
+                    context, {'id': package_id})
+                package_index.index_package(package, defer_commit=True)
+            except Exception as e:
+                if not force:
+                    raise
+                log.error('Failed to index dataset %s: %s', package_id, e)
+                failed.append(package_id)
+    model.Session.remove()
+    failed.extend(connection.failed)
+    return len(package_ids) - len(failed), failed
+
+
+def _init_worker():
+    # The forked workers must not share the database connections of the
+    # parent process.
+    from ckan import model
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def _index_chunk(args):
+    from ckanext.datagovmk.utils import get_spatial_memo_stats
+
+    package_ids, force, batch_size = args
+    indexed, failed = index_packages(package_ids, force=force,
+                                     batch_size=batch_size)
+    return indexed, failed, os.getpid(), get_spatial_memo_stats()
+
+
+def _sum_stats(stats_by_process):
+    total = {}
+    for stats in stats_by_process.values():
+        for key, value in stats.items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def rebuild(workers=1, chunk_size=DEFAULT_CHUNK_SIZE,
+            batch_size=DEFAULT_BATCH_SIZE, force=False, progress=None):
+    '''
+    Rebuilds the search index of all datasets, without clearing it first,
+    and commits once at the end.
+
+    :param workers: number of worker processes. With ``1`` the datasets are
+        indexed in the current process.
+    :type workers: int
+    :param chunk_size: number of datasets handed to a worker at once.
+    :type chunk_size: int
+    :param batch_size: number of documents sent to Solr at once.
+    :type batch_size: int
+    :param force: continue when a dataset fails to index.
+    :type force: bool
+    :param progress: called with the number of processed and total datasets
+        and the elapsed seconds after every chunk.
+    :type progress: function
+
+    :returns: the number of indexed datasets, the ids of the datasets that
+        failed to index and the statistics of the memoized spatial lookups
+        (see :py:func:`ckanext.datagovmk.utils.get_spatial_memo_stats`).
+    :rtype: tuple
+    '''
+    from ckan import model
+    from ckan.lib import search
+    from ckanext.datagovmk.utils import clear_spatial_memo
+
+    started = time.time()
+    clear_spatial_memo()
+    package_ids = get_package_ids()
+    total = len(package_ids)
+    chunks = [(package_ids[i:i + chunk_size], force, batch_size)
+              for i in range(0, total, chunk_size)]
+    model.Session.remove()
+
+    done = 0
+    indexed = 0
+    failed = []
+    memo_stats = {}
+
+    if workers > 1:
+        pool = multiprocessing.get_context('fork').Pool(
+            workers, initializer=_init_worker)
+        results = pool.imap_unordered(_index_chunk, chunks)
+    else:
+        pool = None
+        results = (_index_chunk(chunk) for chunk in chunks)
+
+    try:
+        for chunk_indexed, chunk_failed, pid, stats in results:
+            memo_stats[pid] = stats
+            done += chunk_indexed + len(chunk_failed)
+            indexed += chunk_indexed
+            failed.extend(chunk_failed)
+            if progress:
+                progress(done, total, time.time() - started)
+    except Exception:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    search.commit()
+    memo_stats = _sum_stats(memo_stats)
+    log.info('Indexed %d datasets in %.1fs, %d failed', indexed,
+             time.time() - started, len(failed))
+    log.info('Spatial lookups: %d memoized, %d resolved in %.1fs, '
+             'saved about %.1fs', memo_stats.get('hits', 0),
+             memo_stats.get('misses', 0), memo_stats.get('resolve_seconds', 0),
+             memo_stats.get('saved_seconds', 0))
+    return indexed, failed, memo_stats
@@ -34,3 +34,113 @@ def update_package_stats(package_id):
     package = toolkit.get_action('package_show')(context_, {'id': package_id})
     package_index.index_package(package, defer_commit=False)
     log.info('Search indexed %s', package['name'])
+
+
+PENDING_KEY = 'ckanext-datagovmk:reindex:pending'
+WINDOW_KEY = 'ckanext-datagovmk:reindex:window'
+
+
+def update_packages_stats(package_ids):
+    '''
+    Updates the search index for the given packages, with a single soft
+    commit at the end.
+    '''
+    from ckan import model
+    from ckan.lib.search.common import make_connection
+    from ckan.lib.search.index import PackageSearchIndex
+    from ckan.plugins import toolkit
+    package_index = PackageSearchIndex()
+    context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
+                'use_cache': False, 'validate': False}
+    indexed = 0
+    for package_id in package_ids:
+        try:
+            package = toolkit.get_action('package_show')(dict(context_),
+                                                         {'id': package_id})
+            package_index.index_package(package, defer_commit=True)
+            indexed += 1
+        except Exception as e:
+            log.error('Failed to index %s: %s', package_id, e)
+    if indexed:
+        make_connection().commit(softCommit=True)
+    log.info('Search indexed %d packages', indexed)
+    return indexed
+
+
+def queue_packages_stats_update(package_ids):
+    '''
+    Schedules a search index update for the given packages.
+
+    With ``ckanext.datagovmk.reindex.async`` enabled the package ids are
+    collected in Redis and indexed by a background job that runs at most
+    once per ``ckanext.datagovmk.reindex.window`` seconds, so a package
+    changed many times within the window is indexed only once. Otherwise
+    the packages are indexed right away.
+    '''
+    from ckan.plugins import toolkit
+    from ckan.plugins.toolkit import config
+
+    package_ids = [package_id for package_id in package_ids if package_id]
+    if not package_ids:
+        return
+
+    if toolkit.asbool(config.get('ckanext.datagovmk.reindex.async', False)):
+        try:
+            _queue_packages(package_ids)
+            return
+        except Exception as e:
+            log.warning('Failed to queue the reindex, indexing now: %s', e)
+
+    update_packages_stats(package_ids)
+
+
+def queue_package_stats_update(package_id):
+    '''
+    Schedules a search index update for a given package, see
+    :py:func:`queue_packages_stats_update`.
+    '''
+    queue_packages_stats_update([package_id])
+
+
+def _queue_packages(package_ids):
+    from ckan.lib.redis import connect_to_redis
+    from ckan.plugins import toolkit
+    from ckan.plugins.toolkit import config
+
+    window = int(config.get('ckanext.datagovmk.reindex.window', 5))
+    redis = connect_to_redis()
+    redis.sadd(PENDING_KEY, *package_ids)
+    # Only one job is waiting at a time, the key expires on its own in case
+    # the job never runs.
+    if redis.set(WINDOW_KEY, '1', nx=True, ex=window + 300):
+        toolkit.enqueue_job(
+            reindex_pending_packages_job, [window],
+            title='datagovmk reindex packages',
+            queue=config.get('ckanext.datagovmk.reindex.queue', 'default'))
+
+
+def reindex_pending_packages_job(window=0):
+    '''
+    Background job indexing all queued packages, see
+    :py:func:`queue_packages_stats_update`.
+    '''
+    import time
+    from ckan.lib.redis import connect_to_redis
+
+    if window:
+        time.sleep(window)
+
+    redis = connect_to_redis()
+    # Packages queued from now on are handled by the next job
+    redis.delete(WINDOW_KEY)
+
+    package_ids = set()
+    while True:
+        batch = redis.spop(PENDING_KEY, 500)
+        if not batch:
+            break
+        package_ids.update(package_id.decode('utf-8')
+                           if isinstance(package_id, bytes) else package_id
+                           for package_id in batch)
+
+    return update_packages_stats(sorted(package_ids))
@@ -11,6 +11,10 @@ from ckanext.c3charts.model.featured_charts \
     import setup as setup_featured_charts_table
 from ckanext.datagovmk.model.most_active_organizations \
     import setup as setup_most_active_organizations_table
+from ckanext.datagovmk.model.osm_geometry \
+    import setup as setup_osm_geometry_table
+from ckanext.datagovmk.model.outdated_notification \
+    import setup as setup_outdated_notification_table
 
 @pytest.fixture
 def dgm_setup():
@@ -19,4 +23,6 @@ def dgm_setup():
     setup_user_authority_dataset_table()
     setup_featured_charts_table()
     setup_most_active_organizations_table()
+    setup_osm_geometry_table()
+    setup_outdated_notification_table()
     rebuild()
@@ -16,13 +16,21 @@ GNU Affero General Public License for more details.
 You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import os
 import cgi
+import time
+import datetime
+import tempfile
+import threading
+import zipfile
 from distutils.command.upload import upload
 import pytest
 from io import StringIO, BytesIO
 
 from flask import request
+import pysolr
 import requests
+import rq
 
 from ckan import model
 from ckan import plugins
@@ -30,11 +38,23 @@ from ckan.plugins import toolkit
 from ckan.tests import helpers as test_helpers
 from ckan.tests import factories
 from ckan.common import config
+from ckan.lib.redis import connect_to_redis
 
 from ckanext.datagovmk import actions
+from ckanext.datagovmk import bundle
+from ckanext.datagovmk.helpers import get_storage_path_for
+from ckanext.datagovmk import utils
+from ckanext.datagovmk import downloads
+from ckanext.datagovmk import commands
+from ckanext.datagovmk.solr import stats as solr_stats
+from ckanext.datagovmk.solr import reindex
+from ckanext.datagovmk.solr.datasets import iter_datasets
 from ckanext.datagovmk.tests.helpers import create_dataset
 from ckanext.datagovmk.model.user_authority import UserAuthority
-from ckanext.datagovmk.model.stats import increment_downloads
+from ckanext.datagovmk.model.osm_geometry import OsmGeometry
+from ckanext.datagovmk.model.sort_organizations import SortOrganizations as SortOrganizationsModel
+from ckanext.datagovmk.model.sort_groups import SortGroups as SortGroupsModel
+from ckanext.datagovmk.model.stats import increment_downloads, preloaded_package_downloads
 from ckanext.datagovmk.tests import factories as dgm_factories
 from ckanext.datagovmk.tests.fixtures import dgm_setup
 
@@ -73,6 +93,330 @@ def test_prepare_zip_resources():
     assert 'zip_id' in result
 
 
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+def test_prepare_zip_resources_uploaded_from_disk(monkeypatch):
+    dataset = create_dataset()
+    test_file = _create_fs('application/json', '{"title": "uploaded"}')
+    resource = factories.Resource(package_id=dataset['id'], upload=test_file)
+
+    def _no_http(*args, **kwargs):
+        raise AssertionError('Uploaded resources must not be fetched over HTTP')
+    monkeypatch.setattr('ckanext.datagovmk.bundle.requests.get', _no_http)
+
+    result = actions.prepare_zip_resources({}, {'resources': [resource['id']]})
+
+    file_path, _ = bundle.get_archive_path(result['zip_id'].split('::')[0])
+    with zipfile.ZipFile(file_path) as zip:
+        assert zip.namelist() == ['test.json']
+        assert zip.read('test.json') == b'{"title": "uploaded"}'
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+def test_prepare_zip_resources_cached(monkeypatch):
+    dataset = create_dataset()
+    test_file = _create_fs('application/json', '{"title": "cached"}')
+    resource = factories.Resource(package_id=dataset['id'], upload=test_file)
+    data_dict = {'resources': [resource['id']]}
+
+    result = actions.prepare_zip_resources({}, data_dict)
+    file_path, cached = bundle.get_archive_path(result['zip_id'].split('::')[0])
+    assert cached
+
+    def _no_build(*args, **kwargs):
+        raise AssertionError('Cached archive must not be rebuilt')
+    monkeypatch.setattr(bundle, 'build_zip_archive', _no_build)
+
+    assert actions.prepare_zip_resources({}, data_dict) == result
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+def test_prepare_zip_resources_private_not_cached():
+    org = factories.Organization()
+    dataset = create_dataset(owner_org=org['id'], private=True)
+    test_file = _create_fs('application/json', '{"title": "private"}')
+    resource = factories.Resource(package_id=dataset['id'], upload=test_file)
+
+    result = bundle.bundle_resources([resource])
+    file_path, cached = bundle.get_archive_path(result['zip_id'].split('::')[0])
+
+    assert file_path
+    assert not cached
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+@test_helpers.change_config('ckanext.datagovmk.zip.async', True)
+def test_prepare_zip_resources_async(monkeypatch):
+    dataset = create_dataset()
+    test_file = _create_fs('application/json', '{"title": "async"}')
+    resource = factories.Resource(package_id=dataset['id'], upload=test_file)
+
+    # Run the job right away, in this process
+    sync_queue = rq.Queue(is_async=False, connection=connect_to_redis())
+
+    def _enqueue(fn, args=None, kwargs=None, title=None, queue=None, rq_kwargs=None):
+        return sync_queue.enqueue_call(fn, args=args, kwargs=kwargs, **(rq_kwargs or {}))
+    monkeypatch.setattr(toolkit, 'enqueue_job', _enqueue)
+
+    result = actions.prepare_zip_resources({}, {'resources': [resource['id']], 'async': True})
+    assert result['zip_id'] is None
+
+    status = actions.zip_resources_status({}, {'id': result['job_id']})
+
+    assert status['status'] == 'finished'
+    assert status['resources_total'] == 1
+    assert status['resources_done'] == 1
+    assert status['bytes_done'] == len('{"title": "async"}')
+    assert bundle.get_archive_path(status['zip_id'].split('::')[0])[0]
+
+
+@pytest.mark.ckan_config('ckan.site_url', 'http://data.example.com')
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+def test_build_zip_archive_sends_api_key_to_site_only(monkeypatch, tmpdir):
+    sysadmin = factories.Sysadmin()
+    sent_headers = {}
+
+    def _fetch(resource, headers, limits, deadline):
+        sent_headers[resource['id']] = headers
+        return None
+    monkeypatch.setattr(bundle, 'fetch_resource', _fetch)
+
+    resources = [
+        {'id': 'site', 'url': 'http://data.example.com/dataset/a/resource/b/download/c.csv'},
+        {'id': 'external', 'url': 'http://data.example.com.evil.org/c.csv'},
+    ]
+    bundle.build_zip_archive(str(tmpdir.join('test.zip')), resources)
+
+    apikey = model.User.get(sysadmin['id']).apikey
+    assert sent_headers['site'] == {'Authorization': apikey}
+    assert sent_headers['external'] == {}
+
+
+def _write_archive(dir_name, file_name, content=b'0123456789'):
+    path = os.path.join(get_storage_path_for(dir_name), file_name)
+    with open(path, 'wb') as archive:
+        archive.write(content)
+    return path
+
+
+@pytest.mark.usefixtures("with_plugins")
+def test_download_zip_range_and_conditional(app):
+    file_name = 'a' * 40 + '.zip'
+    _write_archive(bundle.CACHE_DIR, file_name)
+    url = '/dataset/download/zip/{0}::dataset'.format(file_name)
+
+    response = app.get(url)
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == '10'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=dataset.zip'
+    etag = response.headers['ETag']
+    response.close()
+
+    response = app.get(url, headers={'Range': 'bytes=2-5'})
+    assert response.status_code == 206
+    assert response.data == b'2345'
+    assert response.headers['Content-Range'] == 'bytes 2-5/10'
+    response.close()
+
+    response = app.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    response.close()
+
+
+@pytest.mark.ckan_config('ckanext.datagovmk.zip.x_accel_redirect', '/protected/')
+@pytest.mark.usefixtures("with_plugins")
+def test_download_zip_x_accel_redirect(app):
+    file_name = 'b' * 40 + '.zip'
+    _write_archive(bundle.CACHE_DIR, file_name)
+
+    response = app.get('/dataset/download/zip/{0}::dataset'.format(file_name))
+
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == \
+        '/protected/{0}/{1}'.format(bundle.CACHE_DIR, file_name)
+    assert response.data == b''
+
+
+@pytest.mark.usefixtures("with_plugins")
+def test_download_zip_removes_temp_archive(app):
+    file_name = 'c' * 32 + '.zip'
+    path = _write_archive(bundle.TEMP_DIR, file_name)
+    url = '/dataset/download/zip/{0}'.format(file_name)
+
+    # Partial downloads keep the archive for the rest of the file
+    response = app.get(url, headers={'Range': 'bytes=0-4'})
+    assert response.status_code == 206
+    response.close()
+    assert os.path.isfile(path)
+
+    response = app.get(url)
+    assert response.data == b'0123456789'
+    response.close()
+    assert not os.path.isfile(path)
+    assert app.get(url).status_code == 404
+
+
+def test_sweep_temp_archives():
+    old = _write_archive(bundle.TEMP_DIR, 'd' * 32 + '.zip')
+    os.utime(old, (time.time() - bundle.TEMP_MAX_AGE - 1,
+                   time.time() - bundle.TEMP_MAX_AGE - 1))
+    recent = _write_archive(bundle.TEMP_DIR, 'e' * 32 + '.zip')
+
+    bundle.sweep_temp_archives()
+
+    assert not os.path.isfile(old)
+    assert os.path.isfile(recent)
+
+
+class _FakeResponse(object):
+    def __init__(self, chunks, content_type='text/plain', content_length=None):
+        self.chunks = chunks
+        self.headers = {'Content-Type': content_type}
+        if content_length is not None:
+            self.headers['Content-Length'] = str(content_length)
+
+    def iter_content(self, chunk_size):
+        for chunk in self.chunks:
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _bundle_limits(**limits):
+    result = {'timeout': 5, 'max_resource_size': 10, 'max_workers': 2,
+              'deadline': 60}
+    result.update(limits)
+    return result
+
+
+def _remote_resource(id, url='http://example.com/data.txt'):
+    return {'id': id, 'url': url, 'url_type': None, 'name': id,
+            'format': 'TXT'}
+
+
+def test_fetch_resource(monkeypatch):
+    monkeypatch.setattr(bundle.requests, 'get',
+                        lambda *args, **kwargs: _FakeResponse([b'12345', b'678']))
+
+    fileobj = bundle.fetch_resource(_remote_resource('a'), {}, _bundle_limits(),
+                                    time.time() + 60)
+
+    assert fileobj.read() == b'12345678'
+
+
+def test_fetch_resource_size_limit_content_length(monkeypatch):
+    def _get(*args, **kwargs):
+        return _FakeResponse(iter(()), content_length=11)
+    monkeypatch.setattr(bundle.requests, 'get', _get)
+
+    assert bundle.fetch_resource(_remote_resource('a'), {}, _bundle_limits(),
+                                 time.time() + 60) is None
+
+
+def test_fetch_resource_size_limit_streamed(monkeypatch):
+    # No Content-Length, the limit is enforced while streaming
+    monkeypatch.setattr(bundle.requests, 'get',
+                        lambda *args, **kwargs: _FakeResponse([b'123456', b'78901']))
+
+    assert bundle.fetch_resource(_remote_resource('a'), {}, _bundle_limits(),
+                                 time.time() + 60) is None
+
+
+def test_fetch_resource_deadline(monkeypatch):
+    monkeypatch.setattr(bundle.requests, 'get',
+                        lambda *args, **kwargs: _FakeResponse([b'123']))
+
+    assert bundle.fetch_resource(_remote_resource('a'), {}, _bundle_limits(),
+                                 time.time() - 1) is None
+
+
+def test_write_entry_spooled_file(tmpdir):
+    fileobj = tempfile.SpooledTemporaryFile(max_size=bundle.SPOOL_SIZE)
+    fileobj.write(b'spooled')
+
+    with zipfile.ZipFile(str(tmpdir.join('test.zip')), 'w') as zip:
+        assert bundle._write_entry(zip, 'test.txt', fileobj) == len(b'spooled')
+
+    with zipfile.ZipFile(str(tmpdir.join('test.zip'))) as zip:
+        assert zip.read('test.txt') == b'spooled'
+
+
+@pytest.mark.ckan_config('ckanext.datagovmk.zip.max_workers', '2')
+@pytest.mark.usefixtures("with_plugins")
+def test_build_zip_archive_bounded_concurrency(monkeypatch, tmpdir):
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def _get(url, *args, **kwargs):
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        return _FakeResponse([url.encode('utf-8')])
+    monkeypatch.setattr(bundle.requests, 'get', _get)
+
+    resources = [_remote_resource(str(i), 'http://example.com/{0}'.format(i))
+                 for i in range(6)]
+    archived = bundle.build_zip_archive(str(tmpdir.join('test.zip')), resources)
+
+    assert sorted(archived) == sorted(r['id'] for r in resources)
+    assert running[1] == 2
+
+
+@pytest.mark.ckan_config('ckanext.datagovmk.zip.deadline', '0.2')
+@pytest.mark.usefixtures("with_plugins")
+def test_build_zip_archive_deadline(monkeypatch, tmpdir):
+    def _get(url, *args, **kwargs):
+        if url.endswith('slow'):
+            time.sleep(1)
+        return _FakeResponse([b'data'])
+    monkeypatch.setattr(bundle.requests, 'get', _get)
+
+    fetched = []
+    fetch_resource = bundle.fetch_resource
+
+    def _fetch_resource(*args, **kwargs):
+        fileobj = fetch_resource(*args, **kwargs)
+        fetched.append(fileobj)
+        return fileobj
+    monkeypatch.setattr(bundle, 'fetch_resource', _fetch_resource)
+
+    resources = [_remote_resource('fast', 'http://example.com/fast'),
+                 _remote_resource('slow', 'http://example.com/slow')]
+    archived = bundle.build_zip_archive(str(tmpdir.join('test.zip')), resources)
+
+    assert archived == ['fast']
+    # The resource fetched after the deadline is not leaked
+    time.sleep(1.5)
+    assert len(fetched) == 2
+    assert all(fileobj.closed for fileobj in fetched)
+
+
+@pytest.mark.usefixtures("with_plugins")
+def test_build_zip_archive_local_file(monkeypatch, tmpdir):
+    path = tmpdir.join('local.txt')
+    path.write(b'local data', mode='wb')
+    resource = {'id': 'local', 'url': 'http://example.com/local.txt',
+                'url_type': 'upload', 'name': 'local', 'format': 'TXT',
+                'mimetype': 'text/plain'}
+
+    def _no_http(*args, **kwargs):
+        raise AssertionError('Local files must not be fetched over HTTP')
+    monkeypatch.setattr(bundle.requests, 'get', _no_http)
+    monkeypatch.setattr(bundle, 'get_local_path', lambda resource: str(path))
+
+    file_path = str(tmpdir.join('test.zip'))
+    assert bundle.build_zip_archive(file_path, [resource]) == ['local']
+
+    with zipfile.ZipFile(file_path) as zip:
+        assert zip.read('local.txt') == b'local data'
+
+
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
 def test_add_spatial_data():
     package_create = toolkit.get_action('package_create')
@@ -102,6 +446,74 @@ def test_add_spatial_data():
     assert result.get('extras')[0].get('key') == 'spatial'
 
 
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
+def test_get_geojson_cached(monkeypatch):
+    calls = []
+
+    def _post(*args, **kwargs):
+        calls.append(kwargs.get('timeout'))
+        raise requests.exceptions.Timeout()
+
+    monkeypatch.setattr(utils.requests, 'post', _post)
+    monkeypatch.setattr(utils, '_osm_circuit_breaker', utils._CircuitBreaker())
+    OsmGeometry.store('1001', '{"type": "Polygon"}')
+    OsmGeometry.store('1002', '{"type": "Point"}',
+                      fetched=datetime.datetime(2000, 1, 1))
+
+    assert utils._get_geojson('1001') == '{"type": "Polygon"}'
+    assert calls == []
+    # Expired, served stale when Overpass is not available
+    assert utils._get_geojson('1002') == '{"type": "Point"}'
+    assert calls == [5.0]
+
+    assert utils._get_geojson('1003') is None
+    assert utils._get_geojson('1004') is None
+    # The circuit breaker is open after 3 failures
+    assert utils._get_geojson('1005') is None
+    assert len(calls) == 3
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
+def test_get_geojson_cache_lookup_fails(monkeypatch):
+    def _get(cls, relation_id):
+        model.Session.execute('SELECT * FROM no_such_table')
+
+    monkeypatch.setattr(OsmGeometry, 'get', classmethod(_get))
+    monkeypatch.setattr(utils, 'get_osm_gazetteer', lambda: {'1001': {'type': 'Polygon'}})
+
+    assert utils._get_geojson('1001') == '{"type": "Polygon"}'
+    # The session is still usable
+    assert model.Session.execute('SELECT 1').scalar() == 1
+
+    dataset = create_dataset()
+    assert model.Package.get(dataset['id']).state == 'active'
+
+
+def test_populate_location_name_memoized(monkeypatch):
+    calls = []
+
+    def _name_from_code(code):
+        calls.append(code)
+        return 'Name ' + code
+
+    monkeypatch.setitem(utils.helper_functions,
+                        'mk_dcatap_spatial_name_from_code', _name_from_code)
+    utils.clear_spatial_memo()
+
+    for code in ['MK-01', 'MK-02', 'MK-01', 'MK-01']:
+        pkg_dict = {'spatial_uri': code}
+        utils.populate_location_name_from_spatial_uri(pkg_dict)
+        assert pkg_dict['extras_spatial_location_name'] == 'Name ' + code
+
+    assert calls == ['MK-01', 'MK-02']
+    stats = utils.get_spatial_memo_stats()
+    assert (stats['hits'], stats['misses']) == (2, 2)
+
+    utils.clear_spatial_memo()
+    utils.populate_location_name_from_spatial_uri({'spatial_uri': 'MK-01'})
+    assert calls == ['MK-01', 'MK-02', 'MK-01']
+
+
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
 def test_resource_create_invalid_url():
     dataset = create_dataset()
@@ -359,6 +771,21 @@ def test_get_package_stats():
     assert result['total_downloads'] == 3
 
 
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
+def test_get_package_stats_preloaded():
+    dataset = create_dataset()
+    resource = factories.Resource(package_id=dataset['id'], url='http://www.google.com')
+    increment_downloads(resource['id'])
+
+    with preloaded_package_downloads():
+        increment_downloads(resource['id'])
+        pkg_dict = dict(dataset, resources=[{'size': 10}, {'size': None}])
+        result = actions.get_package_stats(dataset['id'], pkg_dict)
+
+    assert result == {'file_size': 10, 'total_downloads': 1}
+    assert actions.get_package_stats(dataset['id'])['total_downloads'] == 2
+
+
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
 def test_increment_downloads_for_resource():
     dataset = create_dataset()
@@ -366,6 +793,24 @@ def test_increment_downloads_for_resource():
     result = actions.increment_downloads_for_resource({}, {'resource_id': resource['id']})
     assert result == 'success'
 
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "clean_redis")
+@pytest.mark.ckan_config("ckanext.datagovmk.downloads.buffered", "true")
+def test_increment_downloads_for_resource_buffered():
+    dataset = create_dataset()
+    resource = factories.Resource(package_id=dataset.get('id'), url='http://www.google.com')
+
+    # The first download flushes right away, the next ones wait for the
+    # flush interval.
+    for _ in range(3):
+        actions.increment_downloads_for_resource({}, {'resource_id': resource['id']})
+    assert actions.get_package_stats(dataset['id'])['total_downloads'] == 1
+
+    assert downloads.flush_downloads() == {resource['id']: 2}
+    assert actions.get_package_stats(dataset['id'])['total_downloads'] == 3
+    assert downloads.flush_downloads() == {}
+
+
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
 def test_resource_show_mk():
     dataset = create_dataset()
@@ -556,7 +1001,7 @@ def test_update_package_stats():
     increment_downloads(resource['id'])
     increment_downloads(resource['id'])
 
-    actions.update_package_stats(dataset['id'])
+    solr_stats.update_package_stats(dataset['id'])
 
     solr_base_url = config['solr_url']
     url = '{0}/select?q=*:*&fq=id:{1}&wt=json'.format(solr_base_url, dataset['id'])
@@ -567,3 +1012,240 @@ def test_update_package_stats():
     assert response.get('numFound') == 1
     assert response.get('docs')[0].get('extras_total_downloads') == '000000000000000000000002'
     assert response.get('docs')[0].get('extras_file_size') == '000000000000000000000605'
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "clean_redis")
+@pytest.mark.ckan_config("ckanext.datagovmk.reindex.async", "true")
+def test_queue_package_stats_update(monkeypatch):
+    dataset = create_dataset()
+    dataset2 = create_dataset()
+    jobs = []
+    monkeypatch.setattr(toolkit, 'enqueue_job',
+                        lambda fn, args=None, **kwargs: jobs.append((fn, args)))
+
+    solr_stats.queue_package_stats_update(dataset['id'])
+    solr_stats.queue_package_stats_update(dataset['id'])
+    solr_stats.queue_packages_stats_update([dataset['id'], dataset2['id']])
+
+    assert len(jobs) == 1
+    assert solr_stats.reindex_pending_packages_job(0) == 2
+    assert solr_stats.reindex_pending_packages_job(0) == 0
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "dgm_setup", "with_plugins")
+def test_reindex_datasets_in_batches(monkeypatch):
+    create_dataset()
+    dataset2 = create_dataset()
+    create_dataset()
+    batches = []
+    add = pysolr.Solr.add
+
+    def _add(self, docs, *args, **kwargs):
+        batches.append(len(docs))
+        return add(self, docs, *args, **kwargs)
+
+    monkeypatch.setattr(pysolr.Solr, 'add', _add)
+
+    indexed, failed, memo_stats = reindex.rebuild(chunk_size=2, batch_size=2)
+
+    assert (indexed, failed) == (3, [])
+    assert batches == [2, 1]
+    result = toolkit.get_action('package_search')({}, {'q': 'id:"{0}"'.format(dataset2['id'])})
+    assert result['count'] == 1
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "dgm_setup", "with_plugins")
+def test_reindex_datasets_failed_batch(monkeypatch):
+    create_dataset()
+    broken = create_dataset()
+    create_dataset()
+    connections = []
+    add = pysolr.Solr.add
+
+    def _add(self, docs, *args, **kwargs):
+        connections.append(id(self))
+        if any(doc['id'] == broken['id'] for doc in docs):
+            raise pysolr.SolrError('Broken document')
+        return add(self, docs, *args, **kwargs)
+
+    monkeypatch.setattr(pysolr.Solr, 'add', _add)
+
+    with pytest.raises(pysolr.SolrError):
+        reindex.rebuild(chunk_size=3, batch_size=3)
+
+    del connections[:]
+    indexed, failed, memo_stats = reindex.rebuild(chunk_size=3, batch_size=3,
+                                                  force=True)
+
+    assert (indexed, failed) == (2, [broken['id']])
+    assert len(connections) == 4
+    # The batch and its retries share one connection
+    assert len(set(connections)) == 1
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "dgm_setup", "with_plugins")
+def test_iter_datasets():
+    datasets = [create_dataset() for _ in range(3)]
+    factories.Resource(package_id=datasets[0]['id'], url='http://www.google.com')
+    org = factories.Organization()
+    private = create_dataset(owner_org=org['id'], private=True)
+
+    result = list(iter_datasets(batch_size=2))
+
+    assert sorted(d['id'] for d in result) == sorted(d['id'] for d in datasets)
+    assert [len(d['resources']) for d in result if d['id'] == datasets[0]['id']] == [1]
+
+    result = list(iter_datasets(batch_size=2, include_private=True))
+
+    assert sorted(d['id'] for d in result) == sorted(
+        d['id'] for d in datasets + [private])
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+def test_get_related_datasets_without_groups_and_tags():
+    dataset = create_dataset()
+    create_dataset()
+
+    result = actions.get_related_datasets({}, {'id': dataset['id']})
+
+    assert result == []
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "dgm_setup", "with_plugins", "with_request_context")
+def test_get_related_datasets_ranking():
+    group = factories.Group()
+    dataset = create_dataset(groups=[{'id': group['id']}], tags=[{'name': 'dog'}])
+    same_group = create_dataset(groups=[{'id': group['id']}])
+    same_tag = create_dataset(tags=[{'name': 'dog'}])
+    same_tag2 = create_dataset(tags=[{'name': 'dog'}])
+    create_dataset(tags=[{'name': 'cat'}])
+
+    result = actions.get_related_datasets({}, {'id': dataset['id'], 'limit': 10})
+
+    ids = [d['id'] for d in result]
+    assert ids[0] == same_group['id']
+    assert sorted(ids[1:]) == sorted([same_tag['id'], same_tag2['id']])
+    assert dataset['id'] not in ids
+
+    result = actions.get_related_datasets({}, {'id': dataset['id'], 'limit': 2})
+
+    assert len(result) == 2
+    assert result[0]['id'] == same_group['id']
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+def test_organization_list_summary():
+    request.environ['CKAN_LANG'] = 'en'
+    org_b = factories.Organization(title_translated={'en': 'B org', 'mk': 'Б', 'sq': 'B'})
+    org_a = factories.Organization(title_translated={'en': 'A org', 'mk': 'А', 'sq': 'A'})
+    create_dataset(owner_org=org_a['id'])
+    create_dataset(owner_org=org_a['id'])
+
+    result = toolkit.get_action('organization_list')({}, {'summary': True})
+
+    assert [org['id'] for org in result] == [org_a['id'], org_b['id']]
+    assert result[0]['title'] == 'A org'
+    assert result[0]['name'] == org_a['name']
+    assert result[0]['package_count'] == 2
+    assert result[1]['package_count'] == 0
+
+    group = factories.Group()
+    factories.Group()
+    create_dataset(groups=[{'id': group['id']}])
+
+    result = toolkit.get_action('group_list')(
+        {}, {'summary': True, 'sort': 'package_count'})
+
+    assert [g['id'] for g in result] == [group['id']]
+    assert result[0]['package_count'] == 1
+
+    result = toolkit.get_action('group_list')({}, {'summary': True, 'sort': ' '})
+
+    assert len(result) == 2
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
+def test_sort_package_counts():
+    def _counts():
+        model.Session.expire_all()
+        return (SortOrganizationsModel.get(org_id=org['id']).one().package_count,
+                SortGroupsModel.get(group_id=group['id']).one().package_count)
+
+    org = factories.Organization()
+    group = factories.Group()
+    dataset = create_dataset(owner_org=org['id'], groups=[{'id': group['id']}])
+    create_dataset(owner_org=org['id'])
+    assert _counts() == (2, 1)
+
+    other = create_dataset()
+    context = {'user': factories.Sysadmin()['name']}
+    toolkit.get_action('member_create')(dict(context), {
+        'id': group['id'], 'object': other['id'], 'object_type': 'package',
+        'capacity': 'public'})
+    assert _counts() == (2, 2)
+
+    # Private datasets are not counted
+    create_dataset(owner_org=org['id'], groups=[{'id': group['id']}], private=True)
+    assert _counts() == (2, 2)
+
+    toolkit.get_action('package_delete')(dict(context), {'id': dataset['name']})
+    assert _counts() == (1, 1)
+
+    model.Session.execute(SortGroupsModel.__table__.update().values(package_count=0))
+    model.Session.commit()
+    commands.update_package_counts()
+    assert _counts() == (1, 1)
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
+def test_sort_package_counts_failure_does_not_break_package_create(monkeypatch):
+    def _fail(*args, **kwargs):
+        raise Exception('No package_count column')
+    monkeypatch.setattr(actions.l, 'update_sort_package_counts', _fail)
+
+    dataset = create_dataset()
+
+    assert model.Package.get(dataset['id']).state == 'active'
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+def test_organization_list_search_and_sort():
+    request.environ['CKAN_LANG'] = 'en'
+    for title in ('beta', 'Alpha', '50% off'):
+        factories.Organization(title_translated={'en': title, 'mk': title, 'sq': title})
+
+    def _titles(**data_dict):
+        data_dict['summary'] = True
+        return [org['title'] for org in
+                toolkit.get_action('organization_list')({}, data_dict)]
+
+    assert _titles() == ['50% off', 'Alpha', 'beta']
+    assert _titles(sort='title_en desc') == ['beta', 'Alpha', '50% off']
+    # Blank and unknown sorts fall back to the title
+    assert _titles(sort=' ') == ['50% off', 'Alpha', 'beta']
+    assert _titles(sort='unknown desc') == ['beta', 'Alpha', '50% off']
+    assert _titles(q='ALP') == ['Alpha']
+    assert _titles(q='%') == ['50% off']
+    assert _titles(q='_') == []
+
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
+def test_create_sort_organizations_and_groups():
+    org = factories.Organization(title_translated={'en': 'Org', 'mk': u'Орг', 'sq': 'Org sq'})
+    factories.Organization()
+    group = factories.Group()
+    create_dataset(owner_org=org['id'], groups=[{'id': group['id']}])
+
+    model.Session.execute(SortOrganizationsModel.__table__.delete())
+    model.Session.execute(SortGroupsModel.__table__.delete())
+    model.Session.commit()
+
+    assert commands.create_sort_organizations() == 2
+    # Running it again replaces the rows
+    assert commands.create_sort_organizations() == 2
+    assert commands.create_sort_groups() == 1
+
+    assert SortOrganizationsModel.get().count() == 2
+    sort_org = SortOrganizationsModel.get(org_id=org['id']).one()
+    assert (sort_org.title_mk, sort_org.title_en, sort_org.package_count) == (u'Орг', 'Org', 1)
+    assert SortGroupsModel.get(group_id=group['id']).one().package_count == 1
@@ -19,6 +19,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
 import pytest
+from datetime import datetime, timedelta
 
 from flask import request
 
@@ -31,8 +32,14 @@ from ckanext.datagovmk.tests.helpers import create_dataset, set_lang
 from ckanext.datagovmk.model.user_authority import UserAuthority
 from ckanext.googleanalytics.dbutil import update_package_visits
 from ckanext.datagovmk.commands import fetch_most_active_orgs
+from ckanext.datagovmk.utils import get_update_schedule
 from ckanext.datagovmk.tests import factories as dgm_factories
 from ckanext.datagovmk.tests.fixtures import dgm_setup
+from ckanext.datagovmk import cache as dgm_cache
+from ckanext.datagovmk.cache import related_datasets_cache
+from ckanext.datagovmk.model.outdated_notification import OutdatedNotification
+from ckanext.datagovmk.model.most_active_organizations import MostActiveOrganizations
+from ckanext.datagovmk.notifications import NotificationDigest, SMTPSender, send_digests
 
 
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
@@ -55,7 +62,7 @@ def test_get_recently_updated_datasets():
 
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
 @test_helpers.change_config('ckan.auth.create_unowned_dataset', False)
-def test_get_most_active_organizations():
+def test_get_most_active_organizations(monkeypatch):
     user = dgm_factories.User()
     organization = factories.Organization()
     dataset = dgm_factories.Dataset(
@@ -103,6 +110,12 @@ def test_get_most_active_organizations():
 
     assert len(result) == 7
 
+    # Served from the process cache until the next refresh
+    monkeypatch.setattr(MostActiveOrganizations, 'get_all', classmethod(
+        lambda cls, limit=5: pytest.fail('Not cached')))
+    result = helpers.get_most_active_organizations(limit=3)
+    assert [org.org_id for org in result][:1] == [organization['id']]
+
 
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
 def test_get_related_datasets():
@@ -132,6 +145,45 @@ def test_get_related_datasets():
     assert len(result) == 2
 
 
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+def test_get_related_datasets_cached():
+    dataset = create_dataset(tags=[{'name': 'dog'}])
+    dataset2 = create_dataset(tags=[{'name': 'dog'}])
+    cache = related_datasets_cache()
+
+    helpers.get_related_datasets(dataset['id'])
+    hits = cache.stats()['hits']
+    result = helpers.get_related_datasets(dataset['id'])
+
+    assert result[0]['id'] == dataset2['id']
+    assert cache.stats()['hits'] == hits + 1
+
+    dataset3 = create_dataset(tags=[{'name': 'dog'}])
+    result = helpers.get_related_datasets(dataset['id'])
+
+    assert result[0]['id'] == dataset3['id']
+
+    helpers.toolkit.get_action('package_delete')(
+        {'user': factories.Sysadmin()['name']}, {'id': dataset3['id']})
+    result = helpers.get_related_datasets(dataset['id'])
+
+    assert dataset3['id'] not in [d['id'] for d in result]
+
+
+@pytest.mark.ckan_config('ckanext.datagovmk.cache.backend', 'memory')
+def test_related_datasets_cache_ttl(monkeypatch):
+    monkeypatch.setattr(dgm_cache, '_caches', {})
+    assert related_datasets_cache().ttl == 300
+
+    monkeypatch.setattr(dgm_cache, '_caches', {})
+    monkeypatch.setitem(dgm_cache.config, 'ckanext.datagovmk.cache.backend', 'redis')
+    assert related_datasets_cache().ttl == 3600
+
+    monkeypatch.setattr(dgm_cache, '_caches', {})
+    monkeypatch.setitem(dgm_cache.config, 'ckanext.datagovmk.cache.related_datasets.ttl', '60')
+    assert related_datasets_cache().ttl == 60
+
+
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
 def test_get_groups():
 
@@ -187,6 +239,29 @@ def test_get_package_total_downloads():
     assert result == 2
 
 
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins", "with_request_context")
+def test_stats_memoized_in_request(monkeypatch):
+    dataset = create_dataset()
+    resource = factories.Resource(package_id=dataset['id'], url='http://google.com')
+
+    increment_downloads(resource['id'])
+
+    assert helpers.get_package_total_downloads(dataset['id']) == 1
+    assert helpers.get_resource_stats(resource['id'])['downloads'] == 1
+    assert helpers.get_dataset_stats(dataset['id']) == {}
+
+    def _fail(ids):
+        raise AssertionError('Stats are not memoized')
+
+    monkeypatch.setattr(helpers, 'get_stats_for_packages', _fail)
+    monkeypatch.setattr(helpers, 'get_stats_for_resources', _fail)
+    monkeypatch.setattr(helpers, 'get_total_downloads_for_packages', _fail)
+
+    assert helpers.get_package_total_downloads(dataset['id']) == 1
+    assert helpers.get_resource_stats(resource['id'])['downloads'] == 1
+    assert helpers.get_dataset_stats(dataset['id']) == {}
+
+
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
 def test_get_storage_path_for():
     result = helpers.get_storage_path_for("pictures")
@@ -291,6 +366,34 @@ def test_get_org_title_sq():
     assert result == u'titulli i shqiptar'
 
 
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
+def test_get_org_titles():
+    title_translated = {
+        'en': 'title on english',
+        'mk': u'наслов на македонски',
+        'sq': 'titulli i shqiptar'
+    }
+    org = factories.Organization(title_translated=title_translated)
+    other_org = factories.Organization(title='Other organization')
+    items = [{'name': org['name']}, {'name': other_org['name']},
+             {'name': 'missing-org'}]
+
+    set_lang('mk')
+    result = helpers.get_org_titles(items)
+    assert result == {org['name']: u'наслов на македонски',
+                      other_org['name']: 'Other organization'}
+
+    set_lang('sq')
+    assert helpers.get_org_titles([org['id']]) == {
+        org['id']: u'titulli i shqiptar'}
+
+    title_translated['sq'] = 'titulli i ri'
+    helpers.toolkit.get_action('organization_patch')(
+        {'ignore_auth': True, 'user': ''},
+        {'id': org['id'], 'title_translated': title_translated})
+    assert helpers.get_org_titles(items)[org['name']] == 'titulli i ri'
+
+
 @pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
 def test_get_org_description_mk():
     description_translated = {
@@ -424,3 +527,95 @@ def test_get_site_statistics():
     assert stats['dataset_count'] == 2
     assert stats['organization_count'] == 1
     assert stats.get('group_count') == 1
+
+
+def test_get_update_schedule():
+    dataset = {
+        'frequency': 'http://publications.europa.eu/resource/authority/frequency/WEEKLY',
+        'resources': [
+            {'created': '2020-01-01T10:00:00', 'last_modified': '2020-02-01T10:00:00'},
+            {'created': '2020-01-15T10:00:00', 'last_modified': None},
+        ]
+    }
+
+    last_modified, next_update_due = get_update_schedule(dataset)
+    assert last_modified == datetime(2020, 2, 1, 10)
+    assert next_update_due == datetime(2020, 2, 8, 10)
+
+    dataset['frequency'] = 'IRREG'
+    assert get_update_schedule(dataset) == (datetime(2020, 2, 1, 10), None)
+    assert get_update_schedule({'frequency': 'WEEKLY', 'resources': []}) == (None, None)
+
+
+def test_send_notification_digests(monkeypatch):
+    monkeypatch.setattr('ckanext.datagovmk.notifications.render_digest',
+                        lambda username, datasets: (
+                            'subject', ','.join(d['dataset_title'] for d in datasets)))
+    digest = NotificationDigest()
+    for title in ['a', 'b', 'a']:
+        digest.add({'email': 'User@example.com', 'username': 'user'},
+                   'http://x/' + title, 'http://x/edit/' + title, title,
+                   dataset_id='id-' + title)
+    digest.add({'email': 'other@example.com'}, 'http://x/c', 'http://x/edit/c', 'c',
+               dataset_id='id-c')
+    digest.add({'email': ''}, 'http://x/d', 'http://x/edit/d', 'd', dataset_id='id-d')
+
+    sender = SMTPSender(dry_run=True, rate=0)
+    result = send_digests(digest, sender=sender)
+
+    assert result == {'recipients': 2, 'sent': 2, 'failed': 0,
+                      'notified_datasets': {'id-a', 'id-b', 'id-c'}}
+    assert [(m['To'], m.get_payload(decode=True).decode('utf-8')) for m in sender.sent] == [
+        ('User@example.com', 'a,b'), ('other@example.com', 'c')]
+
+
+
+@pytest.mark.ckan_config("smtp.test_server", "localhost:6675")
+@pytest.mark.ckan_config("smtp.server", "smtp.example.com")
+@pytest.mark.ckan_config("smtp.user", "user")
+@pytest.mark.ckan_config("smtp.mail_from", "")
+@pytest.mark.ckan_config("error_email_from", "errors@example.com")
+@pytest.mark.ckan_config("ckan.site_title", "Site")
+def test_smtp_sender_uses_ckan_mailer_settings(monkeypatch):
+    connections = []
+
+    class _SMTP(object):
+        def __init__(self, server):
+            self.server = server
+            self.messages = []
+            connections.append(self)
+
+        def ehlo(self):
+            pass
+
+        def login(self, user, password):
+            raise AssertionError('smtp.user must be ignored with smtp.test_server')
+
+        def sendmail(self, mail_from, to, message):
+            self.messages.append((mail_from, to))
+
+        def quit(self):
+            pass
+
+    monkeypatch.setattr('ckanext.datagovmk.notifications.smtplib.SMTP', _SMTP)
+
+    with SMTPSender(rate=0) as sender:
+        sender.send('user@example.com', 'subject', 'body')
+
+    assert [c.server for c in connections] == ['localhost:6675']
+    assert connections[0].messages == [('errors@example.com', ['user@example.com'])]
+    assert sender.sent[0]['From'] == 'Site <errors@example.com>'
+
+@pytest.mark.usefixtures("clean_db", "dgm_setup", "with_plugins")
+def test_outdated_notification_ledger():
+    due_date = datetime(2020, 2, 8, 10)
+    OutdatedNotification.record({'dataset-1': due_date})
+    notification = OutdatedNotification.get_all()['dataset-1']
+
+    assert notification.is_suppressed(due_date, datetime(2020, 1, 1))
+    assert not notification.is_suppressed(datetime(2020, 3, 8, 10), datetime(2020, 1, 1))
+    assert not notification.is_suppressed(due_date, datetime.utcnow() + timedelta(days=1))
+
+    OutdatedNotification.record({'dataset-1': due_date, 'dataset-2': None})
+    stats = OutdatedNotification.get_stats(datetime(2020, 1, 1))
+    assert (stats['notified'], stats['notified_recently']) == (2, 2)
@@ -20,13 +20,19 @@ import csv
 from io import BytesIO, StringIO
 import json
 import codecs
+import os
 import re
+import time
+import threading
+from datetime import timedelta
 from logging import getLogger
+from dateutil import parser
 
 from rdflib.namespace import Namespace, RDF, XSD, SKOS, RDFS
 from rdflib import Literal, URIRef, BNode, Graph
 from ckanext.dcat.utils import resource_uri
 from ckan.model.license import LicenseRegister
+from ckan.model.meta import Session
 from ckanext.dcat.processors import RDFSerializer
 from ckan.common import config
 from ckan.lib.helpers import helper_functions
@@ -40,6 +46,7 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
 from smtplib import SMTPRecipientsRefused
 from ckan.plugins.toolkit import _
+from ckanext.datagovmk.cache import get_cache
 
 
 log = getLogger(__name__)
@@ -59,6 +66,41 @@ SPDX = Namespace('http://spdx.org/rdf/terms#')
 
 
 _DEFAULT_OSM_OVERPASS_URL = "https://lz4.overpass-api.de/api/interpreter"
+_DEFAULT_OSM_GAZETTEER = os.path.join(os.path.dirname(__file__), 'osm_gazetteer.json')
+
+
+class _CircuitBreaker(object):
+    """Stops calling a failing remote service for ``cooldown`` seconds after
+    ``threshold`` consecutive failures.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self.open_until > time.time()
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0
+
+    def failure(self, threshold, cooldown):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= threshold:
+                log.warning('Remote service failed %d times, not calling it '
+                            'for %d seconds', self.failures, cooldown)
+                self.open_until = time.time() + cooldown
+                self.failures = 0
+
+
+_osm_circuit_breaker = _CircuitBreaker()
+_spatial_memo_timing = {'resolve_seconds': 0.0}
+_MISSING = object()
+_osm_gazetteer = None
 
 
 def export_resource_to_rdf(resource_dict, dataset_dict, _format='xml'):
@@ -354,7 +396,7 @@ def populate_location_name_from_spatial_uri(package_dict):
     """
     if package_dict.get('spatial_uri'):
         try:
-            name = _get_helper('mk_dcatap_spatial_name_from_code')(package_dict['spatial_uri'])
+            name = _spatial_name_from_code(package_dict['spatial_uri'])
             if name:
                 package_dict['extras_spatial_location_name'] = name
         except Exception as e:
@@ -374,19 +416,29 @@ def _fetch_osm_relation(relation_id):
     """Fetches the Openstreetmap data for the given relation. The important
     data fetched is the bounding box.
 
-    Uses the OSM overpass API.
+    Uses the OSM overpass API, with a strict timeout. After a number of
+    consecutive failures the API is not called for a while (circuit breaker).
     """
+    if _osm_circuit_breaker.is_open():
+        log.debug('Overpass API is not available, not fetching relation %s', relation_id)
+        return None
+
     overpass_interpeter_url = config.get('ckanext.datagovmk.osm_overpass_url', _DEFAULT_OSM_OVERPASS_URL)
+    timeout = float(config.get('ckanext.datagovmk.osm_overpass_timeout', 5))
+    threshold = int(config.get('ckanext.datagovmk.osm_overpass_max_failures', 3))
+    cooldown = int(config.get('ckanext.datagovmk.osm_overpass_cooldown', 300))
     overpass_query = "[out:json];(relation(id:{relation_id})[boundary=administrative];);out bb;".format(relation_id=relation_id)
     try:
-        resp = requests.post(overpass_interpeter_url, data=overpass_query)
+        resp = requests.post(overpass_interpeter_url, data=overpass_query, timeout=timeout)
         if resp and resp.status_code == 200:
-            return resp.json()
+            data = resp.json()
+            _osm_circuit_breaker.success()
+            return data
         log.warning('Unable to fetch geometry data from openstreetmap. Remote server responded with error: %d - %s', resp.status_code, resp.text)
-        return None
     except Exception as e:
         log.warning(e)
-        return None
+    _osm_circuit_breaker.failure(threshold, cooldown)
+    return None
 
 
 def _fetch_geom(resource):
@@ -423,25 +475,147 @@ def _fetch_geom(resource):
 
 def _get_geojson(resource):
     """Retrieves the GeoJSON 5-point Polygon geom for the specified resource.
+
+    The geometries are cached in the ``osm_geometry`` table for
+    ``ckanext.datagovmk.osm_geometry_ttl`` days. Relations not in the cache
+    are looked up in the gazetteer before calling the Overpass API, and when
+    the API is not available the expired cached geometry is used.
     """
+    from ckanext.datagovmk.model.osm_geometry import OsmGeometry
+
+    ttl = timedelta(days=int(config.get('ckanext.datagovmk.osm_geometry_ttl', 30)))
+    # The lookup runs in a savepoint so a failed query does not abort the
+    # transaction of the action calling it.
+    savepoint = Session.begin_nested()
+    try:
+        cached = OsmGeometry.get(resource)
+        savepoint.commit()
+    except Exception as e:
+        savepoint.rollback()
+        log.warning('Failed to read the OSM geometry cache: %s', e)
+        cached = None
+
+    if cached is not None and cached.is_fresh(ttl):
+        return cached.geometry
+
+    if cached is None:
+        geometry = get_osm_gazetteer().get(str(resource))
+        if geometry:
+            geojson_value = json.dumps(geometry)
+            _store_geojson(resource, geojson_value)
+            return geojson_value
+
     geojson_dict = _fetch_geom(resource)
     if geojson_dict:
-        return json.dumps(geojson_dict)
+        geojson_value = json.dumps(geojson_dict)
+        _store_geojson(resource, geojson_value)
+        return geojson_value
+
+    if cached is not None:
+        return cached.geometry
     return None
 
 
+def _store_geojson(resource, geojson_value):
+    from ckanext.datagovmk.model.osm_geometry import OsmGeometry
+    try:
+        OsmGeometry.store(resource, geojson_value)
+    except Exception as e:
+        log.warning('Failed to cache the OSM geometry for %s: %s', resource, e)
+
+
+def get_osm_gazetteer():
+    """Returns the gazetteer with the geometries of OSM relations, keyed by
+    relation id. The gazetteer is read from the JSON file set in
+    ``ckanext.datagovmk.osm_gazetteer``, by default the one bundled with
+    the extension.
+
+    :rtype: dict
+    """
+    global _osm_gazetteer
+    if _osm_gazetteer is None:
+        path = config.get('ckanext.datagovmk.osm_gazetteer', _DEFAULT_OSM_GAZETTEER)
+        try:
+            with codecs.open(path, 'r', 'utf-8') as gazetteer_file:
+                _osm_gazetteer = json.load(gazetteer_file)
+        except Exception as e:
+            log.warning('Failed to load the OSM gazetteer from %s: %s', path, e)
+            _osm_gazetteer = {}
+    return _osm_gazetteer
+
+
 def _get_helper(helper):
     return helper_functions.get(helper)
 
 
 def _code_to_spatial_uri(code):
-    code_to_uri = _get_helper('mk_dcatap_spatial_uri_from_code')
-    if code_to_uri:
-        uri = code_to_uri(code)
-        return uri or code
-    return code
+    if not _get_helper('mk_dcatap_spatial_uri_from_code'):
+        return code
+    return _memoized_spatial('uri', code, _resolve_spatial_uri)
+
+
+def _resolve_spatial_uri(code):
+    uri = _get_helper('mk_dcatap_spatial_uri_from_code')(code)
+    return uri or code
+
+
+def _spatial_name_from_code(code):
+    return _memoized_spatial('name', code, _resolve_spatial_name)
+
+
+def _resolve_spatial_name(code):
+    return _get_helper('mk_dcatap_spatial_name_from_code')(code)
+
+
+def _spatial_codes_cache():
+    # Always process-local, the lookups are cheaper than a Redis round-trip
+    return get_cache('spatial_codes', maxsize=1000, ttl=24 * 3600,
+                     backend='memory')
+
+
+def _memoized_spatial(kind, code, resolve):
+    """Resolves the spatial code with ``resolve``, memoizing the result in
+    the ``spatial_codes`` cache.
+    """
+    cache = _spatial_codes_cache()
+    key = u'{0}:{1}'.format(kind, code)
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+    started = time.time()
+    value = resolve(code)
+    _spatial_memo_timing['resolve_seconds'] += time.time() - started
+    cache.set(key, value)
+    return value
+
+
+def clear_spatial_memo():
+    """Clears the memoized spatial code to URI and name lookups, e.g. after
+    the spatial vocabulary changed, and resets their statistics.
+    """
+    cache = _spatial_codes_cache()
+    cache.clear()
+    cache.reset_stats()
+    _spatial_memo_timing['resolve_seconds'] = 0.0
 
 
+def get_spatial_memo_stats():
+    """Returns the hits and misses of the memoized spatial lookups in this
+    process, the time spent resolving the misses and the estimated time the
+    hits saved.
+
+    :rtype: dict
+    """
+    stats = _spatial_codes_cache().stats()
+    resolve_seconds = _spatial_memo_timing['resolve_seconds']
+    average = resolve_seconds / stats['misses'] if stats['misses'] else 0
+    return {
+        'hits': stats['hits'],
+        'misses': stats['misses'],
+        'resolve_seconds': resolve_seconds,
+        'saved_seconds': stats['hits'] * average,
+    }
+
 
 def send_email(to_name, to_email, subject, content):
     """ This function sends e-mail
@@ -467,4 +641,72 @@ def send_email(to_name, to_email, subject, content):
         return {
             'success': False,
             'message': _('An error occured while sending the email. Try again.')
-        }
\ No newline at end of file
+        }
+
+
+PERIODICITY = {
+    'ANNUAL': timedelta(days=365),
+    'ANNUAL_2': timedelta(days=365/2),
+    'ANNUAL_3': timedelta(days=365/3),
+    'BIENNIAL': timedelta(days=2*365),
+    'BIMONTHLY': timedelta(days=2*30),
+    'BIWEEKLY': timedelta(weeks=2),
+    'CONT': timedelta(minutes=1),
+    'DAILY': timedelta(days=1),
+    'DAILY_2': timedelta(days=2),
+    'MONTHLY': timedelta(days=4*30),
+    'MONTHLY_2': timedelta(days=15),
+    'MONTHLY_3': timedelta(days=10),
+    'QUARTERLY': timedelta(days=3*30),
+    'TRIENNIAL': timedelta(days=3*365),
+    'UPDATE_CONT': timedelta(minutes=1),
+    'WEEKLY': timedelta(weeks=1),
+    'WEEKLY_2': timedelta(weeks=0.5),
+    'WEEKLY_3': timedelta(weeks=3),
+}
+
+IGNORE_PERIODICITY = {'IRREG', 'OTHER', 'UNKNOWN', 'NEVER'}
+
+
+def get_last_modified(dataset):
+    """Returns the latest modification (or creation) time of the resources
+    of the dataset, ``None`` if it has no resources.
+    """
+    resources = dataset.get('resources')
+    if resources:
+        last_modified = []
+        for resource in resources:
+            lm = resource.get('last_modified') or resource.get('created')
+            if lm:
+                last_modified.append(parser.parse(lm))
+
+        return max(last_modified)
+    return None
+
+
+def get_update_schedule(dataset):
+    """Returns when the resources of the dataset were last modified and, for
+    datasets scheduled for periodic updates, when the next update is due.
+
+    :param dataset: the dictized dataset.
+    :type dataset: dict
+
+    :returns: the last modification time of the resources and the due time
+        of the next update, each ``None`` if not known.
+    :rtype: tuple
+    """
+    try:
+        last_modified = get_last_modified(dataset)
+    except Exception as e:
+        log.debug('Failed to get the last modified time of dataset %s: %s', dataset.get('id'), e)
+        last_modified = None
+    if not last_modified:
+        return None, None
+
+    frequency = (dataset.get('frequency') or '').split('/')[-1]
+    if not frequency or frequency in IGNORE_PERIODICITY:
+        return last_modified, None
+    periodicity = PERIODICITY.get(frequency.upper())
+    if not periodicity:
+        return last_modified, None
+    return last_modified, last_modified + periodicity
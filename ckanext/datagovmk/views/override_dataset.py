@@ -9,7 +9,7 @@ from functools import partial
 from six.moves.urllib.parse import urlencode
 from datetime import datetime
 
-from flask import Blueprint, make_response
+from flask import Blueprint, make_response, send_file
 
 from ckan.common import asbool
 import ckan.lib.base as base
@@ -29,7 +29,7 @@ from ckan.views.dataset import (drill_down_url,
                                 _setup_template_variables,
                                 _get_pkg_template)
 
-from ckanext.datagovmk.helpers import get_storage_path_for
+from ckanext.datagovmk.bundle import get_archive_path, touch_archive
 
 NotFound = logic.NotFound
 NotAuthorized = logic.NotAuthorized
@@ -303,27 +303,63 @@ def datetime_to_utc(dt):
 
 
 def download_zip(zip_id):
-    response = make_response()
-
+    """Sends the ZIP archive prepared by the ``datagovmk_prepare_zip_resources``
+    action.
+
+    The file is streamed from the disk in chunks, with ``Content-Length`` and
+    support for ``Range`` requests. If ``ckanext.datagovmk.zip.x_accel_redirect``
+    is configured, the cached archives are handed over to nginx with an
+    ``X-Accel-Redirect`` header instead. Archives that are not cached are
+    removed once the whole file has been sent.
+
+    :param zip_id: the archive file name and the dataset name, separated
+        with ``::``.
+    :type zip_id: str
+    """
     if not zip_id:
         abort(404, toolkit._('Resource data not found'))
-    file_name, package_name = zip_id.split('::')
-    file_path = get_storage_path_for('temp-datagovmk/' + file_name)
+    file_name, _sep, package_name = zip_id.partition('::')
+    file_path, cached = get_archive_path(file_name)
 
-    if not os.path.isfile(file_path):
+    if not file_path:
         abort(404, toolkit._('Resource data not found'))
 
     if not package_name:
         package_name = 'resources'
     package_name += '.zip'
 
-    with open(file_path, 'r') as f:
-        response.stream.write(f.read())
-
-    response.headers['Content-Type'] = 'application/octet-stream'
-    response.headers['Content-disposition'] =\
-        'attachment; filename=' + package_name
-    os.remove(file_path)
+    x_accel_redirect = config.get('ckanext.datagovmk.zip.x_accel_redirect')
+    if cached:
+        touch_archive(file_path)
+        if x_accel_redirect:
+            storage_path = os.path.join(config.get('ckan.storage_path'),
+                                        'storage')
+            response = make_response()
+            response.headers['X-Accel-Redirect'] = '{0}/{1}'.format(
+                x_accel_redirect.rstrip('/'),
+                os.path.relpath(file_path, storage_path))
+            response.headers['Content-Type'] = 'application/octet-stream'
+            response.headers['Content-Disposition'] =\
+                'attachment; filename=' + package_name
+            return response
+
+    response = send_file(file_path,
+                         mimetype='application/octet-stream',
+                         as_attachment=True,
+                         attachment_filename=package_name,
+                         conditional=True)
+    # A partial response is likely followed by requests for the rest of the
+    # file, the archives left behind are removed by sweep_temp_archives.
+    if not cached and response.status_code != 206:
+        response.call_on_close(partial(_remove_archive, file_path))
+    return response
+
+
+def _remove_archive(file_path):
+    try:
+        os.remove(file_path)
+    except OSError as e:
+        log.debug('Failed to remove archive %s: %s', file_path, e)
 
 
 override_dataset.add_url_rule('/', view_func=override_search, methods=["GET"])
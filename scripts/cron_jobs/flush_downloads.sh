@@ -0,0 +1,4 @@
+CONFIG_FILE_LOCATION=$1
+
+# Every 5 minutes
+ckan -c $CONFIG_FILE_LOCATION datagovmk flush_downloads
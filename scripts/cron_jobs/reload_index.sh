@@ -1,3 +1,3 @@
 CONFIG_FILE_LOCATION=$1
 
-paster --plugin=ckan search-index rebuild -r -c $CONFIG_FILE_LOCATION
+ckan -c $CONFIG_FILE_LOCATION datagovmk reindex --workers 4